@@ -5,12 +5,19 @@
 import asyncio
 import shutil
 import textwrap
+from urllib.parse import urlparse
 from tabulate import tabulate
 from providers.Hianime.Scraper.searchAnimedetails import searchAnimeandetails, getAnimeDetails
 from providers.Hianime.Scraper.searchEpisodedetails import getanimepisode
 from providers.Hianime.Scraper.getEpisodestreams import serverextractor, streams
-from providers.Hianime.Downloader.downloader import m3u8_parsing, downloading
-from config.hianime import subtitle
+from providers.Hianime.Downloader.downloader import m3u8_parsing, downloading, probe_playlist
+from providers.Hianime.Downloader.planner import plan_batch, format_bytes, format_seconds
+from providers.Hianime.Downloader.streamer import streaming
+from config.hianime import subtitle, quality, server_race, server_race_grace, consume_data, batch_lookahead
+from config.logging_config import get_logger
+from utils import tracing
+
+logger = get_logger("bin.pyanime")
 
 # Asthetics only!!! Don't give a damn about this!!!
 def separator(type):
@@ -47,6 +54,26 @@ def clean_result(omit, results):
     max_col_width = max(10, columns // max_cols_in_row)
     return cleaned_results, max_col_width
 
+def select_episodes(episode_list, selection):
+    """Episodes matching a selection like "1", "1,2", "1-10" or "1-3,7" (empty or "all" selects everything)"""
+    selection = selection.strip()
+    if not selection or selection.lower() == "all":
+        return list(episode_list)
+    numbers = set()
+    for part in selection.split(','):
+        if '-' in part:
+            start, end = map(int, part.split('-'))
+            numbers.update(range(start, end + 1))
+        elif part.strip():
+            numbers.add(int(part))
+    return [ep for ep in episode_list if int(ep["No"]) in numbers]
+
+def normalize_watch_link(value):
+    """Turn an anime URL, watch link or slug ("one-piece-100") into the "/watch/<slug>" form the scrapers use"""
+    path = urlparse(value.strip()).path if "://" in value else value.strip()
+    slug = path.rstrip('/').split('/')[-1].split('?')[0]
+    return f"/watch/{slug}"
+
 def choose_servers(servers, needs):
     valid_types = ['sub', 'dub', 'raw']
     if needs not in valid_types:
@@ -76,32 +103,129 @@ def choose_servers(servers, needs):
             print(f"Primary '{needs}' not available — falling back to '{fb}'.")
             return fallback_servers
 
-async def download_episode_async(episode, anime_title, needs):
-    """Async function to download a single episode"""
+def _refresh_playlist(server, episode, height):
+    """The same variant of a server with fresh signed URLs, for when the old ones expire mid-download"""
+    media = streams(server, episode)
+    if not media:
+        return None
+    segments, _, _ = m3u8_parsing(media, height)
+    return segments
+
+def _resolve_server(server, episode, quality=quality):
+    media = streams(server, episode)
+    if not media:
+        return None
+    segments, name, subs = m3u8_parsing(media, quality=quality)
+    if not segments:
+        return None
+    height = segments.get("height")
+    segments["refresh"] = lambda: _refresh_playlist(server, episode, height)
+    return {"server": server, "media": media, "segments": segments, "title": name, "subs": subs}
+
+async def _race_candidate(server, episode, quality=quality):
+    """Resolve one server and measure how fast its first segments come in"""
+    candidate = await asyncio.to_thread(_resolve_server, server, episode, quality)
+    if not candidate:
+        return None
+    try:
+        candidate['throughput'] = await probe_playlist(candidate['segments'])
+    except Exception as e:
+        logger.warning("Probe of server %s failed: %s", server.get('label'), e)
+        candidate['throughput'] = 0.0
+    return candidate
+
+async def race_servers(servers, episode, quality=quality):
+    """
+    Resolve candidate servers concurrently and keep the one with the best throughput.
+
+    Losers are cancelled once the first candidate finishes and its grace period is over. Cancelling
+    stops their throughput probes only: a server still being resolved (a blocking scrape in a worker
+    thread) runs to completion in the background and its result is dropped.
+    """
+    tasks = [asyncio.create_task(_race_candidate(server, episode, quality)) for server in servers[:max(1, server_race)]]
+    finished = []
+    pending = set(tasks)
+    loop = asyncio.get_running_loop()
+    deadline = None
+
+    while pending:
+        remaining = None if deadline is None else max(0, deadline - loop.time())
+        done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            break
+        for task in done:
+            try:
+                candidate = task.result()
+            except Exception as e:
+                logger.warning("Server candidate failed for episode %s: %s", episode['No'], e)
+                continue
+            if candidate:
+                finished.append(candidate)
+                logger.info("Server %s: %.0f KB/s", candidate['server']['label'], candidate['throughput'] / 1024)
+        if finished and deadline is None:
+            # The others only get a short grace period, anything slower loses anyway
+            deadline = loop.time() + server_race_grace
+
+    # Resolutions already handed to a thread can't be interrupted, only the tasks waiting on them are
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.info("Cancelled %d slower server(s) for episode %s", len(pending), episode['No'])
+
+    if not finished:
+        return None, []
+    finished.sort(key=lambda candidate: candidate['throughput'], reverse=True)
+    return finished[0], finished[1:]
+
+@tracing.traced(describe=lambda episode, anime_title, needs, *args, **kwargs: {"anime": anime_title, "episode": episode.get('No')})
+async def resolve_episode(episode, anime_title, needs, quality=quality):
+    """Find the fastest server, resolve its streams and fetch the media playlist for an episode"""
     try:
         servers = serverextractor(episode)
         selected_servers = choose_servers(servers, needs)
         if not selected_servers:
             print(f"No servers found for episode {episode['Episode ID']}. Skipping.")
-            return 1
-        
-        media = streams(selected_servers[0], episode)
-        segments, name, subs = m3u8_parsing(media)
+            return None
 
-        if not segments:
+        best, alternates = await race_servers(selected_servers, episode, quality)
+        if not best:
             print(f"Failed to parse m3u8 for episode {episode['No']}. Skipping.")
-            return 1
-        
-        separator("=")
-        print(f"Downloading Episode {episode['No']}: {name}")
-        
-        # Extract base URL from media link if available
-        base_url = None
-        if 'link' in media and 'file' in media['link'] and media['link']['file'].startswith('http'):
-            base_url = '/'.join(media['link']['file'].split('/')[:-1]) + '/'
-            
-        # Use async downloading with subtitle data and base URL
-        code = await downloading(segments, f"{episode['No']}. {name}", anime_title, subs, base_url)
+            return None
+
+        if len(selected_servers) > 1:
+            print(f"Episode {episode['No']}: using {best['server']['label']} ({format_bytes(best['throughput'])}/s)")
+
+        return {
+            "episode": episode,
+            "media": best['media'],
+            "segments": best['segments'],
+            "alternates": alternates,
+            "title": best['title'],
+            "name": f"{episode['No']}. {best['title']}",
+            "anime": anime_title,
+            "needs": needs,
+            "subs": best['subs'],
+        }
+
+    except Exception as e:
+        print(f"Error resolving episode {episode['No']}: {e}")
+        return None
+
+async def download_episode_async(job, download_slot=None, lookahead=None):
+    """Async function to download a single resolved episode"""
+    episode = job['episode']
+
+    def announce(stage):
+        if stage == "segments":
+            separator("=")
+            print(f"Downloading Episode {episode['No']}: {job['title']}")
+
+    try:
+        # Use async downloading with the parsed playlist and subtitle data
+        alternates = [alternate['segments'] for alternate in job.get('alternates', [])]
+        code = await downloading(job['segments'], job['name'], job['anime'], job['subs'], alternates=alternates,
+                                 on_stage=announce, download_slot=download_slot, lookahead=lookahead,
+                                 episode_id=episode['Episode ID'], needs=job['needs'])
         
         if code == 1:
             print()
@@ -116,17 +240,81 @@ async def download_episode_async(episode, anime_title, needs):
         print(f"Error downloading episode {episode['No']}: {e}")
         return 1
 
+async def stream_episode_async(job):
+    """Async function to play a single resolved episode through the local streaming proxy"""
+    episode = job['episode']
+    separator("=")
+    print(f"Streaming Episode {episode['No']}: {job['title']}")
+    try:
+        code = await streaming(job['segments'], job['name'], job['anime'], job['subs'])
+    except Exception as e:
+        print(f"Error streaming episode {episode['No']}: {e}")
+        return 1
+    if code != 0:
+        print(f"{hex_to_rgb('#FF0000','Failed to stream!!!')} Check for {hex_to_rgb('#73FF2E','pyanime.log')} in parent directory.")
+    return code
+
+def print_plan(plan):
+    rows = []
+    for job in plan['kept'] + plan['dropped']:
+        estimate = job['estimate']
+        status = "in library" if estimate['exists'] else ("download" if job in plan['kept'] else "no space")
+        rows.append({
+            "Episode": wrap_text_with_color(job['name'], "#1fa1d9", 40),
+            "Duration": format_seconds(estimate['duration']),
+            "Size": format_bytes(estimate['bytes']),
+            "ETA": format_seconds(estimate['eta']),
+            "Status": status,
+        })
+    print(hex_to_rgb("#fc861e","Download Plan:"))
+    print()
+    print(tabulate(rows, headers="keys", tablefmt="grid"))
+    print(f"Total: {format_bytes(plan['bytes'])} | Duration: {format_seconds(plan['duration'])} | "
+          f"ETA: {format_seconds(plan['eta'])} | Free: {format_bytes(plan['target_free'])}")
+    print()
+
 async def download_episodes_batch(selected_episodes, anime_title, needs):
     """Download multiple episodes with controlled concurrency"""
+    print(hex_to_rgb("#fc861e","Resolving episodes..."))
+    print()
+
+    failed_count = 0
+    jobs = []
+    for episode in selected_episodes:
+        job = await resolve_episode(episode, anime_title, needs)
+        if job:
+            jobs.append(job)
+        else:
+            failed_count += 1
+
+    if consume_data == "stream":
+        success_count = 0
+        for job in jobs:
+            if await stream_episode_async(job) == 0:
+                success_count += 1
+            else:
+                failed_count += 1
+        return success_count, failed_count
+
+    # Estimate sizes up front so we don't die halfway through on a full disk
+    plan = await plan_batch(jobs)
+    print_plan(plan)
+    if plan['dropped']:
+        print(f"{hex_to_rgb('#FF0000', str(len(plan['dropped'])))} episode(s) won't fit on disk and will be skipped.")
+        failed_count += len(plan['dropped'])
+
     print(hex_to_rgb("#fc861e","Starting batch download..."))
     print()
     
     success_count = 0
-    failed_count = 0
     
-    # Download episodes one by one to avoid overwhelming servers
-    for episode in selected_episodes:
-        result = await download_episode_async(episode, anime_title, needs)
+    # Download episodes one by one to avoid overwhelming servers, an episode is
+    # concatenated and muxed in the background while the next one downloads.
+    # Only the next batch_lookahead episodes prepare ahead of the one downloading.
+    download_slot = asyncio.Semaphore(1)
+    lookahead = asyncio.Semaphore(1 + max(0, batch_lookahead))
+    results = await asyncio.gather(*[download_episode_async(job, download_slot, lookahead) for job in plan['kept']])
+    for result in results:
         if result == 0:
             success_count += 1
         else:
@@ -134,7 +322,7 @@ async def download_episodes_batch(selected_episodes, anime_title, needs):
     
     # Summary
     separator("=")
-    print(f"Download Summary:")
+    print("Download Summary:")
     print(f"  ✅ Successful: {hex_to_rgb('#73FF2E', str(success_count))}")
     print(f"  ❌ Failed: {hex_to_rgb('#FF0000', str(failed_count))}")
     
@@ -239,14 +427,7 @@ async def main():
     separator('=')
     selection = input("Enter the episode number to select Hint:[1 / 1,2 / 1-10 ]: ")
     if selection:
-        selected_episodes = []        
-        if '-' in selection:
-            start, end = map(int, selection.split('-'))
-            selected_episodes = [ep for ep in episode_list if start <= int(ep["No"]) <= end]
-        elif ',' in selection:
-            selected_episodes = [ep for ep in episode_list if int(ep["No"]) in map(int, selection.split(','))]
-        else:
-            selected_episodes = [ep for ep in episode_list if int(ep["No"]) == int(selection)]
+        selected_episodes = select_episodes(episode_list, selection)
 
     separator('=')
     print(hex_to_rgb("#fc861e","Selected Episodes:"))
@@ -267,7 +448,7 @@ async def main():
 
     separator('=')
     if subtitle == None:
-        needs = input(f"Sub or Dub? [sub/dub]: ").strip().lower()
+        needs = input("Sub or Dub? [sub/dub]: ").strip().lower()
     else:
         needs = subtitle
 
@@ -286,5 +467,6 @@ async def main():
     separator("=")
 
 if __name__ == "__main__":
+    tracing.enable_from_config()
     # Run the async main function
     asyncio.run(main())
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pyanime_cli.py - Non-interactive command line for scripted and bulk runs.
+#
+#   python -m bin.pyanime_cli search "one piece" [--json]
+#   python -m bin.pyanime_cli list one-piece-100 [--json]
+#   python -m bin.pyanime_cli download one-piece-100 -e 1-12 --needs sub --quality 720p --parallel 8
+#   python -m bin.pyanime_cli download --file worklist.txt --json      (or --file - to read stdin)
+#   python -m bin.pyanime_cli library [--anime TITLE] [--state corrupt] [--json]
+#   python -m bin.pyanime_cli download ... --trace trace.json   (open the trace in https://ui.perfetto.dev)
+#
+# --json, --provider and --trace go before or after the command.
+#
+# A work list has one series per line: LINK [EPISODES] [sub|dub|raw], "#" starts a comment.
+#
+# Exit codes: 0 everything downloaded, 1 some episodes failed, 2 nothing to do / bad input.
+
+import argparse
+import asyncio
+import contextlib
+import json
+import shlex
+import sys
+from providers.Hianime.Downloader.downloader import downloading, output_path, clip_name
+from providers.Hianime.Downloader.playlist import parse_window
+from providers.Hianime.Downloader.planner import plan_batch
+from bin.pyanime import resolve_episode, select_episodes, normalize_watch_link
+from config.hianime import subtitle, quality, parallel, download_window, batch_lookahead
+from config.logging_config import get_logger
+from utils.library import get_library
+from utils.bandwidth import get_shaper, parse_rate
+from utils import tracing
+
+logger = get_logger("bin.pyanime_cli")
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+# Status records always go to the real stdout, even while progress output is redirected
+_records = sys.stdout
+
+
+def _provider(name):
+    """Scraper entry points of a provider, imported on demand"""
+    if name == "hianime":
+        from providers.Hianime.Scraper.searchAnimedetails import searchAnimeandetails, getAnimeDetails
+        from providers.Hianime.Scraper.searchEpisodedetails import getanimepisode
+        return {"search": searchAnimeandetails, "details": getAnimeDetails, "episodes": getanimepisode,
+                "link": normalize_watch_link, "download": True}
+    from providers.Animekai.Scraper.searchAnimedetails import searchAnimeandetails, getAnimeDetails
+    from providers.Animekai.Scraper.searchEpisodedetails import getanimepisode
+    # The Animekai downloader isn't wired up to stream resolution yet, so it can search and list only
+    return {"search": searchAnimeandetails, "details": getAnimeDetails, "episodes": getanimepisode,
+            "link": lambda value: value.strip(), "download": False}
+
+
+def _emit(record, as_json, text):
+    if as_json:
+        _records.write(json.dumps(record, ensure_ascii=False) + "\n")
+        _records.flush()
+    else:
+        print(text)
+
+
+def search(args):
+    provider = _provider(args.provider)
+    results = provider["search"](args.query) or []
+    for anime in results:
+        record = {
+            "no": anime.get("No"),
+            "title": anime.get("Title"),
+            "type": anime.get("Type"),
+            "episodes": anime.get("Episodes"),
+            "subs": anime.get("Subs"),
+            "dubs": anime.get("Dubs"),
+            "link": anime.get("Imp", {}).get("Watch Link"),
+        }
+        _emit(record, args.json, f"{record['no']:>3}. {record['title']} [{record['type']}, "
+                                 f"sub {record['subs']} / dub {record['dubs']}]  {record['link']}")
+    return EXIT_OK if results else EXIT_USAGE
+
+
+def list_episodes(args):
+    provider = _provider(args.provider)
+    episodes = provider["episodes"](provider["link"](args.link)) or []
+    for episode in episodes:
+        record = {"no": episode.get("No"), "title": episode.get("Title"), "id": episode.get("Episode ID")}
+        _emit(record, args.json, f"{record['no']:>4}. {record['title']}")
+    return EXIT_OK if episodes else EXIT_USAGE
+
+
+def library(args):
+    entries = get_library().episodes(args.anime, args.state)
+    for entry in entries:
+        record = {key: entry[key] for key in ("anime", "name", "episode_id", "needs", "variant", "size", "duration",
+                                              "state", "path")}
+        duration = f"{entry['duration'] / 60:.0f} min" if entry["duration"] else "?"
+        _emit(record, args.json, f"{entry['anime']} / {entry['name']} [{entry['state']}, "
+                                 f"{entry['variant'] or '?'}, {duration}]")
+    return EXIT_OK if entries else EXIT_USAGE
+
+
+def _read_worklist(path, default_episodes, default_needs):
+    """Work list entries from a file ("-" for stdin)"""
+    handle = sys.stdin if path == "-" else open(path, 'r', encoding='utf-8')
+    entries = []
+    try:
+        for number, line in enumerate(handle, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            fields = shlex.split(line)
+            entry = {"link": fields[0], "episodes": default_episodes, "needs": default_needs}
+            for field in fields[1:]:
+                if field in ("sub", "dub", "raw"):
+                    entry["needs"] = field
+                else:
+                    entry["episodes"] = field
+            entry["line"] = number
+            entries.append(entry)
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+    return entries
+
+
+async def _download_series(provider, entry, args, summary, download_slot, lookahead):
+    link = provider["link"](entry["link"])
+    details = provider["details"](link)
+    title = details.get("title") if details else None
+    episodes = provider["episodes"](link) if title else []
+    try:
+        selected = select_episodes(episodes or [], entry["episodes"])
+    except ValueError:
+        selected = []
+    if not selected:
+        logger.error("Nothing to download for %s (episodes %s)", entry["link"], entry["episodes"])
+        _emit({"link": entry["link"], "status": "not found"}, args.json,
+              f"{entry['link']}: no matching anime/episodes")
+        summary["not_found"] += 1
+        return
+
+    jobs = []
+    for episode in selected:
+        job = await resolve_episode(episode, title, entry["needs"], args.quality or quality)
+        if job:
+            jobs.append(job)
+        else:
+            summary["failed"] += 1
+            _emit({"anime": title, "episode": episode["No"], "status": "failed", "reason": "resolve"}, args.json,
+                  f"{title} episode {episode['No']}: could not resolve a stream")
+    if not jobs:
+        return
+
+    plan = await plan_batch(jobs, parallel=args.parallel or parallel)
+    for job in plan["dropped"]:
+        summary["failed"] += 1
+        _emit({"anime": title, "episode": job["episode"]["No"], "status": "failed", "reason": "disk space"},
+              args.json, f"{title} episode {job['episode']['No']}: not enough disk space")
+
+    window = args.window or download_window
+
+    async def download_job(job):
+        alternates = [alternate["segments"] for alternate in job["alternates"]]
+        code = await downloading(job["segments"], job["name"], job["anime"], job["subs"], alternates=alternates,
+                                 window=window, download_slot=download_slot, lookahead=lookahead,
+                                 episode_id=job["episode"]["Episode ID"], needs=job["needs"],
+                                 parallel=args.parallel or parallel)
+        status = "done" if code == 0 else "failed"
+        summary[status] += 1
+        name = clip_name(job["name"], *parse_window(window)) if window else job["name"]
+        _emit({"anime": title, "episode": job["episode"]["No"], "status": status,
+               "path": output_path(name, job["anime"]) if code == 0 else None},
+              args.json, f"{title} episode {job['episode']['No']}: {status}")
+
+    await asyncio.gather(*[download_job(job) for job in plan["kept"]])
+
+
+async def _download_all(provider, entries, args):
+    summary = {"done": 0, "failed": 0, "not_found": 0}
+    # Segments of one episode at a time, ffmpeg work of earlier episodes runs alongside
+    download_slot = asyncio.Semaphore(1)
+    # and only the next batch_lookahead episodes fetch subtitles and check disk space meanwhile
+    lookahead = asyncio.Semaphore(1 + max(0, batch_lookahead))
+    # One event loop for every series: the proxy scores, mirror ranking and probe
+    # history built up on the first series are reused by the next ones
+    for entry in entries:
+        try:
+            await _download_series(provider, entry, args, summary, download_slot, lookahead)
+        except Exception as e:
+            logger.error("Series %s failed: %s", entry["link"], e, exc_info=True)
+            summary["failed"] += 1
+            _emit({"link": entry["link"], "status": "failed", "reason": str(e)}, args.json,
+                  f"{entry['link']}: {e}")
+    return summary
+
+
+def download(args):
+    provider = _provider(args.provider)
+    if not provider["download"]:
+        _emit({"status": "unsupported", "provider": args.provider}, args.json,
+              f"Downloading from {args.provider} is not supported yet")
+        return EXIT_USAGE
+
+    entries = [{"link": link, "episodes": args.episodes, "needs": args.needs} for link in args.links]
+    if args.file:
+        entries += _read_worklist(args.file, args.episodes, args.needs)
+    if not entries:
+        _emit({"status": "nothing to do"}, args.json, "Nothing to download, pass links or --file")
+        return EXIT_USAGE
+
+    if args.limit:
+        get_shaper().set_local(parse_rate(args.limit))
+
+    # Progress bars go to stderr so stdout only carries the status records
+    with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+        summary = asyncio.run(_download_all(provider, entries, args))
+
+    _emit({"summary": summary}, args.json,
+          f"Done: {summary['done']}, failed: {summary['failed']}, not found: {summary['not_found']}")
+    if summary["failed"] or (summary["not_found"] and summary["done"]):
+        return EXIT_FAILED
+    if summary["not_found"]:
+        return EXIT_USAGE
+    return EXIT_OK
+
+
+def main(argv=None):
+    global _records
+    _records = sys.stdout
+    def add_common(target, default):
+        # default=SUPPRESS on the commands keeps them from resetting a value given before the command
+        target.add_argument("--provider", choices=["hianime", "animekai"], default=default("hianime"))
+        target.add_argument("--json", action="store_true", default=default(False), help="Print one JSON object per line")
+        target.add_argument("--trace", metavar="FILE", default=default(None),
+                            help="Write a Chrome/Perfetto trace of the run to FILE on exit")
+
+    # --provider, --json and --trace are accepted before and after the command
+    common = argparse.ArgumentParser(add_help=False)
+    add_common(common, lambda value: argparse.SUPPRESS)
+    parser = argparse.ArgumentParser(prog="pyanime_cli", description="Non-interactive pyanime")
+    add_common(parser, lambda value: value)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    search_parser = commands.add_parser("search", help="Search anime by title", parents=[common])
+    search_parser.add_argument("query")
+
+    list_parser = commands.add_parser("list", help="List the episodes of an anime", parents=[common])
+    list_parser.add_argument("link", help="Anime URL, watch link or slug (e.g. one-piece-100)")
+
+    library_parser = commands.add_parser("library", help="List downloaded episodes", parents=[common])
+    library_parser.add_argument("--anime", help="Only this anime (exact title)")
+    library_parser.add_argument("--state", choices=["complete", "partial", "corrupt", "unverified"])
+
+    download_parser = commands.add_parser("download", help="Download episodes of one or more anime", parents=[common])
+    download_parser.add_argument("links", nargs="*", help="Anime URLs, watch links or slugs")
+    download_parser.add_argument("-e", "--episodes", default="all", help="Episodes: 1 / 1,2 / 1-10 / all")
+    download_parser.add_argument("--needs", default=subtitle or "sub", choices=["sub", "dub", "raw"])
+    download_parser.add_argument("-q", "--quality", help=f"e.g. 1080p/720p/360p (default {quality})")
+    download_parser.add_argument("-p", "--parallel", type=int, help=f"Concurrent segment downloads (default {parallel})")
+    download_parser.add_argument("-f", "--file", help='Work list file, "-" for stdin')
+    download_parser.add_argument("--window", help='Only download a time window, e.g. "60" or "1:30-2:00"')
+    download_parser.add_argument("--limit", help='Bandwidth for this run, e.g. "2M" or "500K" (default: shared limit)')
+
+    args = parser.parse_args(argv)
+    if args.trace:
+        tracing.enable(args.trace)
+    else:
+        tracing.enable_from_config()
+    try:
+        if args.command == "search":
+            return search(args)
+        if args.command == "list":
+            return list_episodes(args)
+        if args.command == "library":
+            return library(args)
+        return download(args)
+    except KeyboardInterrupt:
+        return EXIT_FAILED
+    except (OSError, ValueError) as e:
+        _emit({"status": "error", "reason": str(e)}, args.json, f"Error: {e}")
+        return EXIT_USAGE
+
+
+if __name__ == "__main__":
+    sys.exit(main())
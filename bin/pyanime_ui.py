@@ -3,6 +3,7 @@
 # pyanime_ui.py - PyQt6 GUI for pyanime
 
 import sys
+import time
 import asyncio
 import qasync
 from pathlib import Path
@@ -10,13 +11,16 @@ from PyQt6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout
                            QWidget, QLabel, QLineEdit, QPushButton, QTableWidget, 
                            QTableWidgetItem, QTextEdit, QProgressBar, QComboBox,
                            QMessageBox, QSplitter, QTabWidget, QGroupBox, QScrollArea)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QDateTime
+from PyQt6.QtCore import Qt, QThread, pyqtSignal, QDateTime, QTimer
 
 from providers.Hianime.Scraper.searchAnimedetails import searchAnimeandetails, getAnimeDetails
 from providers.Hianime.Scraper.searchEpisodedetails import getanimepisode
 from providers.Hianime.Scraper.getEpisodestreams import serverextractor, streams
 from providers.Hianime.Downloader.downloader import m3u8_parsing, downloading, set_progress_emitter, ProgressEmitter
 from config.hianime import subtitle
+from utils.library import get_library, COMPLETE
+from utils.bandwidth import get_shaper, parse_rate, format_rate
+from utils import metrics, tracing
 
 
 class SearchWorker(QThread):
@@ -90,11 +94,8 @@ class DownloadWorker(QThread):
             if not segments:
                 return 1
 
-            base_url = None
-            if isinstance(media, dict) and 'link' in media and 'file' in media['link'] and media['link']['file'].startswith('http'):
-                base_url = '/'.join(media['link']['file'].split('/')[:-1]) + '/'
-
-            code = await downloading(segments, f"{episode['No']}. {name}", anime_title, subs, base_url)
+            code = await downloading(segments, f"{episode['No']}. {name}", anime_title, subs,
+                                     episode_id=episode['Episode ID'], needs=needs)
 
             return code
 
@@ -372,6 +373,16 @@ class PyAnimeGUI(QMainWindow):
 
         left_panel.addTab(episodes_widget, "Episodes")
 
+        self.metrics_table = QTableWidget(0, 2)
+        self.metrics_table.setHorizontalHeaderLabels(["Metric", "Value"])
+        self.metrics_table.horizontalHeader().setStretchLastSection(True)
+        self.metrics_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        left_panel.addTab(self.metrics_table, "Metrics")
+        self._last_metrics = None
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.refresh_metrics)
+        self.metrics_timer.start(2000)
+
         splitter.addWidget(left_panel)
 
         right_panel = QWidget()
@@ -391,6 +402,15 @@ class PyAnimeGUI(QMainWindow):
             self.audio_combo.setCurrentText(subtitle)
         sub_dub_layout.addWidget(self.audio_combo)
         sub_dub_layout.addStretch()
+        sub_dub_layout.addWidget(QLabel("Speed limit:"))
+        self.limit_input = QLineEdit()
+        self.limit_input.setPlaceholderText("e.g. 2M, off, auto")
+        self.limit_input.setMaximumWidth(120)
+        self.limit_input.returnPressed.connect(self.apply_limit)
+        sub_dub_layout.addWidget(self.limit_input)
+        limit_button = QPushButton("Apply")
+        limit_button.clicked.connect(self.apply_limit)
+        sub_dub_layout.addWidget(limit_button)
         download_layout.addLayout(sub_dub_layout)
 
         self.download_button = QPushButton("Download Selected Episodes")
@@ -522,7 +542,7 @@ class PyAnimeGUI(QMainWindow):
         if not episodes:
             return
 
-        headers = ["No", "Title", "Episode Name", "Japanese Name"]
+        headers = ["No", "Title", "Episode Name", "Japanese Name", "Library"]
         self.episodes_table.setColumnCount(len(headers))
         self.episodes_table.setHorizontalHeaderLabels(headers)
         self.episodes_table.setRowCount(len(episodes))
@@ -532,6 +552,9 @@ class PyAnimeGUI(QMainWindow):
             self.episodes_table.setItem(row, 1, QTableWidgetItem(episode.get('Title', '')))
             self.episodes_table.setItem(row, 2, QTableWidgetItem(episode.get('Episode Name', '')))
             self.episodes_table.setItem(row, 3, QTableWidgetItem(episode.get('Japanese Name', '')))
+            states = {entry['state'] for entry in get_library().find(episode.get('Episode ID'))}
+            state = COMPLETE if COMPLETE in states else next(iter(states), '')
+            self.episodes_table.setItem(row, 4, QTableWidgetItem(state))
 
         self.episodes_table.resizeColumnsToContents()
 
@@ -558,6 +581,48 @@ class PyAnimeGUI(QMainWindow):
         except Exception as e:
             QMessageBox.warning(self, "Selection Error", f"Invalid selection format: {e}")
 
+    def refresh_metrics(self):
+        snapshot = metrics.snapshot()
+        now = time.monotonic()
+        segments = snapshot.get("pyanime_segments_total", {}).get("ok", 0)
+        received = snapshot.get("pyanime_segment_bytes_total", {}).get("", 0)
+        rows = []
+        if self._last_metrics:
+            then, last_segments, last_received = self._last_metrics
+            rows.append(("Segments/s", f"{(segments - last_segments) / (now - then):.1f}"))
+            rows.append(("Download speed", format_rate(int((received - last_received) / (now - then))) if received > last_received else "idle"))
+        self._last_metrics = (now, segments, received)
+
+        for name, values in snapshot.items():
+            label = name.removeprefix("pyanime_")
+            for labels, value in sorted(values.items()):
+                key = f"{label} {{{labels}}}" if labels else label
+                if isinstance(value, dict):
+                    rows.append((key, f"{value['count']} x, avg {value['avg']:.3f}s"))
+                else:
+                    rows.append((key, f"{value:.2f}" if isinstance(value, float) else str(value)))
+
+        self.metrics_table.setRowCount(len(rows))
+        for row, (key, value) in enumerate(rows):
+            self.metrics_table.setItem(row, 0, QTableWidgetItem(key))
+            self.metrics_table.setItem(row, 1, QTableWidgetItem(value))
+
+    def apply_limit(self):
+        value = self.limit_input.text().strip()
+        shaper = get_shaper()
+        try:
+            if value == "auto":
+                shaper.set_override(None)
+            elif value in shaper.profiles:
+                shaper.set_override(value)
+            elif value:
+                shaper.set_override(parse_rate(value))
+        except ValueError as e:
+            QMessageBox.warning(self, "Speed Limit", str(e))
+            return
+        rate, source = shaper.resolve()
+        self.log(f"Bandwidth limit: {format_rate(rate)} ({source})")
+
     def start_download(self):
         if not self.selected_episodes:
             QMessageBox.warning(self, "Warning", "No episodes selected")
@@ -594,6 +659,7 @@ class PyAnimeGUI(QMainWindow):
 
 
 def main():
+    tracing.enable_from_config()
     app = QApplication(sys.argv)
 
     loop = qasync.QEventLoop(app)
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pyanimed.py - Headless download daemon working through the persistent job queue, plus a thin CLI to manage it.
+#
+#   python -m bin.pyanimed run [-w WORKERS] [--trace FILE]
+#   python -m bin.pyanimed enqueue LINK [-e 1-12] [--needs sub] [--priority N] [--window 60]
+#   python -m bin.pyanimed status [--watch]
+#   python -m bin.pyanimed pause|resume|retry [ID]
+#   python -m bin.pyanimed priority ID N
+#   python -m bin.pyanimed remove ID
+#   python -m bin.pyanimed follow LINK [--needs sub] [--backfill 1-3] | unfollow LINK | watchlist | sync
+#   python -m bin.pyanimed verify [--deep]
+#   python -m bin.pyanimed limit [2M | off | day | auto]
+
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+from tabulate import tabulate
+from providers.Hianime.Scraper.searchAnimedetails import getAnimeDetails
+from providers.Hianime.Scraper.searchEpisodedetails import getanimepisode, fetch_episode_list
+from providers.Hianime.Scraper import watchlist
+from providers.Hianime.Downloader.downloader import downloading, segment_cache_path
+from bin.pyanime import resolve_episode, select_episodes, normalize_watch_link, hex_to_rgb
+from config.hianime import (subtitle, download_window, jobs_db, daemon_workers, job_attempts, job_poll,
+                            watchlist_interval, metrics_port)
+from config.logging_config import get_logger
+from utils.jobqueue import JobQueue, QUEUED, RUNNING, PAUSED, DONE, FAILED
+from utils.library import get_library, CORRUPT, UNVERIFIED
+from utils.bandwidth import get_shaper, parse_rate, format_rate
+from utils.budget import get_budget
+from utils import metrics, tracing
+
+logger = get_logger("bin.pyanimed")
+
+STATE_COLORS = {QUEUED: "#ffea00", RUNNING: "#1fa1d9", PAUSED: "#fc861e", DONE: "#73FF2E", FAILED: "#FF0000"}
+
+
+async def process_job(queue, job):
+    """Resolve and download one claimed job, returns True when the episode is in the library"""
+    with tracing.span("job", id=job['id'], anime=job['anime'], episode=job['episode'].get('No')):
+        return await _process_job(queue, job)
+
+
+async def _process_job(queue, job):
+    episode = job['episode']
+    resolved = await resolve_episode(episode, job['anime'], job['needs'])
+    if not resolved:
+        queue.fail(job['id'], "Could not resolve a stream")
+        return False
+
+    alternates = [alternate['segments'] for alternate in resolved['alternates']]
+    code = await downloading(
+        resolved['segments'], resolved['name'], resolved['anime'], resolved['subs'],
+        alternates=alternates,
+        window=job['options'].get('window', download_window),
+        work_dir=segment_cache_path(resolved['name'], resolved['anime']),
+        on_stage=lambda stage: queue.set_stage(job['id'], stage),
+        episode_id=episode['Episode ID'], needs=job['needs'])
+    if code != 0:
+        queue.fail(job['id'], "Download failed, see pyanime.log")
+        return False
+
+    queue.finish(job['id'])
+    return True
+
+
+async def _watch_state(queue, job_id):
+    """Return once the job has been paused or removed from outside the daemon"""
+    while True:
+        await asyncio.sleep(2)
+        job = await asyncio.to_thread(queue.get, job_id)
+        if job is None or job['state'] != RUNNING:
+            return job['state'] if job else None
+
+
+async def worker(number, queue, stop):
+    while not stop.is_set():
+        job = await asyncio.to_thread(queue.claim)
+        if job is None:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=job_poll)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        logger.info("Worker %d took job %d: %s episode %s (stage %s, attempt %d)", number, job['id'], job['anime'],
+                    job['episode'].get('No'), job['stage'], job['attempts'])
+        print(f"[worker {number}] {job['anime']} episode {job['episode'].get('No')} ({job['stage']})")
+
+        task = asyncio.create_task(process_job(queue, job))
+        watcher = asyncio.create_task(_watch_state(queue, job['id']))
+        stopper = asyncio.create_task(stop.wait())
+        done, _ = await asyncio.wait({task, watcher, stopper}, return_when=asyncio.FIRST_COMPLETED)
+
+        if task not in done:
+            # Paused, removed or shutting down: drop the download, its segments stay in the work dir
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            if stopper in done:
+                queue.release(job['id'])
+                logger.info("Job %d released for the next run", job['id'])
+            else:
+                logger.info("Job %d stopped (%s)", job['id'], watcher.result() or "removed")
+        else:
+            try:
+                ok = task.result()
+                print(f"[worker {number}] {job['anime']} episode {job['episode'].get('No')}: "
+                      f"{hex_to_rgb('#73FF2E', 'done') if ok else hex_to_rgb('#FF0000', 'failed')}")
+            except Exception as e:
+                logger.error("Job %d crashed: %s", job['id'], e, exc_info=True)
+                queue.fail(job['id'], e)
+
+        for pending in (watcher, stopper):
+            pending.cancel()
+
+
+async def watchlist_loop(queue, stop):
+    """Check the watchlist every watchlist_interval seconds"""
+    while not stop.is_set():
+        try:
+            result = await asyncio.to_thread(watchlist.sync, queue)
+            for title, numbers in result["new"].items():
+                print(f"[watchlist] {title}: new episode(s) {', '.join(numbers)}")
+        except Exception as e:
+            logger.error("Watchlist sync failed: %s", e, exc_info=True)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=watchlist_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def requeue_corrupt(queue, deep=False):
+    """Check the library and put the jobs of every corrupt or unverified episode back in the queue"""
+    library = get_library()
+    damaged = library.verify(deep)
+    requeued = 0
+    # Unverified episodes get another download, which keeps the file if it turns out as long as the playlist
+    for entry in library.episodes(state=CORRUPT) + library.episodes(state=UNVERIFIED):
+        if entry['episode_id'] and entry['needs']:
+            requeued += queue.requeue(entry['episode_id'], entry['needs'])
+    if requeued:
+        logger.info("Requeued %d job(s) with corrupt or unverified files", requeued)
+    return damaged, requeued
+
+
+async def run_daemon(workers):
+    queue = JobQueue(jobs_db, max_attempts=job_attempts)
+    queue.recover()
+    await asyncio.to_thread(requeue_corrupt, queue)
+    stop = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: Ctrl+C still raises KeyboardInterrupt
+            pass
+
+    metrics.REGISTRY.gauge("pyanime_jobs", "Jobs in the daemon queue by state", ("state",),
+                           callback=lambda: {(state,): count for state, count in queue.counts().items()})
+    # Registers the budget gauges even before the first download
+    get_budget()
+    metrics_runner = None
+    if metrics_port:
+        try:
+            metrics_runner = await metrics.serve(metrics_port)
+        except OSError as e:
+            logger.warning("Could not serve metrics on port %d: %s", metrics_port, e)
+
+    counts = queue.counts()
+    print(f"pyanimed: {workers} worker(s), {counts.get(QUEUED, 0)} queued job(s) in {jobs_db}"
+          f"{f', metrics on http://127.0.0.1:{metrics_port}/metrics' if metrics_runner else ''}")
+    logger.info("Daemon started with %d workers", workers)
+    tasks = [worker(number + 1, queue, stop) for number in range(workers)]
+    if watchlist_interval:
+        tasks.append(watchlist_loop(queue, stop))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        queue.close()
+        logger.info("Daemon stopped")
+        print("pyanimed stopped")
+
+
+def enqueue(args):
+    link = normalize_watch_link(args.link)
+    details = getAnimeDetails(link)
+    title = details.get('title') if details else None
+    if not title:
+        print(f"Could not find anime for {args.link}")
+        return 1
+
+    episodes = getanimepisode(link)
+    selected = select_episodes(episodes or [], args.episodes)
+    if not selected:
+        print(f"No episodes of {title} match '{args.episodes}'")
+        return 1
+
+    options = {"window": args.window} if args.window else {}
+    queue = JobQueue(jobs_db, max_attempts=job_attempts)
+    added = 0
+    for episode in selected:
+        job_id, new = queue.enqueue(title, link, episode, args.needs, args.priority, options)
+        added += new
+        if not new:
+            print(f"Episode {episode['No']} already queued as job {job_id}")
+    queue.close()
+    print(f"Enqueued {added} episode(s) of {title}")
+    return 0
+
+
+def follow(args):
+    link = normalize_watch_link(args.link)
+    details = getAnimeDetails(link)
+    title = details.get('title') if details else None
+    if not title:
+        print(f"Could not find anime for {args.link}")
+        return 1
+    episodes, validators = fetch_episode_list(link)
+    watchlist.follow(link, title, episodes, validators, args.needs, args.priority)
+    print(f"Following {title} ({len(episodes)} episodes so far, new ones will be queued)")
+
+    if args.backfill:
+        queue = JobQueue(jobs_db, max_attempts=job_attempts)
+        selected = select_episodes(episodes, args.backfill)
+        for episode in selected:
+            queue.enqueue(title, link, episode, args.needs, args.priority)
+        queue.close()
+        print(f"Enqueued {len(selected)} existing episode(s)")
+    return 0
+
+
+def unfollow(args):
+    if watchlist.unfollow(normalize_watch_link(args.link)):
+        print("Unfollowed")
+        return 0
+    print(f"{args.link} is not on the watchlist")
+    return 1
+
+
+def show_watchlist(args):
+    rows = []
+    for link, entry in watchlist.load_watchlist().items():
+        numbers = [int(n) for n in entry["known"].values() if str(n).isdigit()]
+        rows.append({
+            "Anime": entry["title"][:40],
+            "Link": link,
+            "Needs": entry["needs"],
+            "Episodes": len(entry["known"]),
+            "Latest": max(numbers) if numbers else "-",
+            "Checked": time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["checked"])),
+        })
+    if not rows:
+        print("The watchlist is empty, add series with `pyanimed follow LINK`")
+        return 0
+    print(tabulate(rows, headers="keys", tablefmt="grid"))
+    return 0
+
+
+def sync_watchlist(args):
+    queue = JobQueue(jobs_db, max_attempts=job_attempts)
+    try:
+        result = watchlist.sync(queue)
+    finally:
+        queue.close()
+    for title, numbers in result["new"].items():
+        print(f"{title}: queued episode(s) {', '.join(numbers)}")
+    print(f"Checked {result['checked']} series: {result['unchanged']} unchanged, {result['failed']} failed, "
+          f"{result['enqueued']} new episode(s) queued")
+    return 1 if result["failed"] else 0
+
+
+def verify(args):
+    queue = JobQueue(jobs_db, max_attempts=job_attempts)
+    try:
+        damaged, requeued = requeue_corrupt(queue, args.deep)
+    finally:
+        queue.close()
+    for entry in damaged:
+        print(f"Corrupt: {entry['anime']} / {entry['name']}")
+    counts = get_library().counts()
+    print(f"Library: {counts.get('complete', 0)} complete, {counts.get('partial', 0)} partial, "
+          f"{counts.get(CORRUPT, 0)} corrupt, {counts.get(UNVERIFIED, 0)} unverified; {requeued} job(s) requeued")
+    return 1 if damaged else 0
+
+
+def limit(args):
+    """Show or change the bandwidth limit of every running pyanime process"""
+    shaper = get_shaper()
+    if args.value:
+        if args.value == "auto":
+            shaper.set_override(None)
+        elif args.value in shaper.profiles:
+            shaper.set_override(args.value)
+        else:
+            try:
+                shaper.set_override(parse_rate(args.value))
+            except ValueError as e:
+                print(e)
+                return 1
+    rate, source = shaper.resolve()
+    print(f"Bandwidth limit: {format_rate(rate)} ({source})")
+    return 0
+
+
+def print_status(queue):
+    rows = []
+    for job in queue.jobs():
+        rows.append({
+            "ID": job['id'],
+            "Anime": job['anime'][:40],
+            "Ep": job['episode'].get('No'),
+            "Needs": job['needs'],
+            "Prio": job['priority'],
+            "State": hex_to_rgb(STATE_COLORS.get(job['state'], "#ffffff"), job['state']),
+            "Stage": job['stage'],
+            "Tries": job['attempts'],
+            "Error": (job['error'] or "")[:40],
+        })
+    if rows:
+        print(tabulate(rows, headers="keys", tablefmt="grid"))
+    counts = queue.counts()
+    print("  ".join(f"{state}: {counts.get(state, 0)}" for state in (QUEUED, RUNNING, PAUSED, DONE, FAILED)))
+
+
+def status(args):
+    queue = JobQueue(jobs_db, max_attempts=job_attempts)
+    try:
+        while True:
+            if args.watch:
+                os.system('cls' if os.name == 'nt' else 'clear')
+            print_status(queue)
+            if not args.watch:
+                return 0
+            time.sleep(2)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        queue.close()
+
+
+def control(args):
+    queue = JobQueue(jobs_db, max_attempts=job_attempts)
+    job_id = getattr(args, 'id', None)
+    if args.command == "pause":
+        changed = queue.pause(job_id)
+    elif args.command == "resume":
+        changed = queue.resume(job_id)
+    elif args.command == "retry":
+        changed = queue.retry(job_id)
+    elif args.command == "priority":
+        changed = queue.set_priority(job_id, args.value)
+    else:
+        changed = queue.remove(job_id)
+    queue.close()
+    print(f"{args.command}: {changed} job(s) updated")
+    return 0 if changed else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pyanimed", description="pyanime download daemon and job queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the daemon in the foreground")
+    run_parser.add_argument("-w", "--workers", type=int, default=daemon_workers, help="Episodes downloaded at once")
+    run_parser.add_argument("--trace", metavar="FILE", help="Write a Chrome/Perfetto trace of the run to FILE on exit")
+
+    enqueue_parser = commands.add_parser("enqueue", help="Queue episodes of an anime")
+    enqueue_parser.add_argument("link", help="Anime URL, watch link or slug (e.g. one-piece-100)")
+    enqueue_parser.add_argument("-e", "--episodes", default="all", help="Episodes: 1 / 1,2 / 1-10 / all")
+    enqueue_parser.add_argument("--needs", default=subtitle or "sub", choices=["sub", "dub", "raw"])
+    enqueue_parser.add_argument("-p", "--priority", type=int, default=0, help="Higher runs first")
+    enqueue_parser.add_argument("--window", help='Only download a time window, e.g. "60" or "1:30-2:00"')
+
+    status_parser = commands.add_parser("status", help="Show the job queue")
+    status_parser.add_argument("--watch", action="store_true", help="Refresh every 2 seconds")
+
+    for name, help_text in (("pause", "Pause a job (all queued/running jobs without ID)"),
+                            ("resume", "Resume a paused job (all without ID)"),
+                            ("retry", "Retry a failed job (all without ID)")):
+        control_parser = commands.add_parser(name, help=help_text)
+        control_parser.add_argument("id", type=int, nargs="?")
+
+    priority_parser = commands.add_parser("priority", help="Change the priority of a job")
+    priority_parser.add_argument("id", type=int)
+    priority_parser.add_argument("value", type=int)
+
+    remove_parser = commands.add_parser("remove", help="Remove a job that isn't running")
+    remove_parser.add_argument("id", type=int)
+
+    follow_parser = commands.add_parser("follow", help="Queue new episodes of a series as they come out")
+    follow_parser.add_argument("link", help="Anime URL, watch link or slug")
+    follow_parser.add_argument("--needs", default=subtitle or "sub", choices=["sub", "dub", "raw"])
+    follow_parser.add_argument("-p", "--priority", type=int, default=0, help="Priority of the queued episodes")
+    follow_parser.add_argument("--backfill", help="Also queue these existing episodes (1-10 / all)")
+
+    unfollow_parser = commands.add_parser("unfollow", help="Stop following a series")
+    unfollow_parser.add_argument("link")
+
+    commands.add_parser("watchlist", help="Show followed series")
+    commands.add_parser("sync", help="Check followed series now and queue new episodes")
+
+    verify_parser = commands.add_parser("verify", help="Check the library and requeue corrupt episodes")
+    verify_parser.add_argument("--deep", action="store_true", help="Compare checksums, not just file sizes")
+
+    limit_parser = commands.add_parser("limit", help="Show or change the bandwidth limit (applies within seconds)")
+    limit_parser.add_argument("value", nargs="?", help='e.g. "2M", "500K", "off", a profile name, or "auto" for the schedule')
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        if args.trace:
+            tracing.enable(args.trace)
+        else:
+            tracing.enable_from_config()
+        try:
+            asyncio.run(run_daemon(max(1, args.workers)))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    if args.command == "enqueue":
+        return enqueue(args)
+    if args.command == "status":
+        return status(args)
+    if args.command == "follow":
+        return follow(args)
+    if args.command == "unfollow":
+        return unfollow(args)
+    if args.command == "watchlist":
+        return show_watchlist(args)
+    if args.command == "sync":
+        return sync_watchlist(args)
+    if args.command == "verify":
+        return verify(args)
+    if args.command == "limit":
+        return limit(args)
+    return control(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
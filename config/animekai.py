@@ -4,6 +4,7 @@
 # hianime.py - Configuration for HiAnime 
 # This file contains settings for the HiAnime service, including constants.
 
+import os
 from .logging_config import setup_logging, get_logger
 
 # Setup logging for this module
@@ -36,4 +37,7 @@ player = "vlc"          # Favourite Player (vlc/mpv/iina)
 parallel = 6            # ↑ increase number to get faster speeds (caveats: could get a temporary ip/device ban if continuous request sent)
 timeout = 10            # giving time to parse the media urls 
 proxy_servers = {}      # here we have proxy set but not working just for showpiece (hint: use vpn if u get an ip ban)
-                        # search for "vpngate" or "vpnbook" for using with vpn.
\ No newline at end of file
+                        # search for "vpngate" or "vpnbook" for using with vpn.
+proxy_race = 3          # Routes raced at once when fetching playlists (native IP + best scored proxies)
+cache_dir = os.path.join(os.path.expanduser("~"), ".animecache")  # Where downloaded episodes are saved
+state_dir = os.path.join(cache_dir, ".pyanime")  # Where pyanime keeps its own bookkeeping (probe logs, scores, ...)
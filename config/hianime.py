@@ -4,6 +4,7 @@
 # hianime.py - Configuration for HiAnime 
 # This file contains settings for the HiAnime service, including constants.
 
+import os
 from .logging_config import setup_logging, get_logger
 
 # Setup logging for this module
@@ -31,12 +32,64 @@ proxy_headers = {
 subtitle = "sub"        # Default subtitle language (sub/dub)
 server_type = "hd-2"    # Possible values (hd-1/hd-2) hd-3 will be added in future
 quality = "1080p"       # quality (1080p/720p/360p)
-consume_data = "stream" # What do you want to do with this video (stream/watch)
+consume_data = "download" # What do you want to do with this video (download/stream)
 player = "vlc"          # Favourite Player (vlc/mpv/iina)
 parallel = 6            # ↑ increase number to get faster speeds (caveats: could get a temporary ip/device ban if continuous request sent)
 timeout = 10            # giving time to parse the media urls 
 proxy_servers = {}      # here we have proxy set but not working just for showpiece (hint: use vpn if u get an ip ban)
                         # search for "vpngate" or "vpnbook" for using with vpn.
+proxy_race = 3          # Routes raced at once when fetching playlists (native IP + best scored proxies)
+cache_dir = os.path.join(os.path.expanduser("~"), ".animecache")  # Where downloaded episodes are saved
+plan_policy = "trim"    # What to do when a batch won't fit on disk (trim: drop the last episodes, from the first that does not fit / refuse: download nothing)
+plan_samples = 3        # Segments sampled (HEAD request) per episode to estimate its size
+disk_reserve = 512 * 1024 * 1024    # Bytes always left free on the target volume
+assumed_speed = 2 * 1024 * 1024     # Bytes/s used for ETA estimates until a throughput probe has been logged
+state_dir = os.path.join(cache_dir, ".pyanime")  # Where pyanime keeps its own bookkeeping (probe logs, scores, ...)
+variant_policy = "quality"  # How a variant is picked (quality: match `quality` / throughput: best variant that finishes within target_time)
+target_time = 600       # Seconds one episode download may take under the throughput policy
+probe_segments = 3      # Segments fetched per variant to measure throughput
+server_race = 2         # Servers (hd-1/hd-2) resolved and probed at once per episode, the fastest one is used
+server_race_grace = 5   # Seconds the other servers get to finish their probe once the first one is done
+stripe_servers = True   # Spread an episode's segments over every raced server that has the same segmentation
+host_rate = 0           # Max new segment requests per second per server (0 = no limit)
+stream_prefetch = 8     # Segments fetched ahead of the player when streaming
+stream_persist = True   # Keep downloading while streaming and save the episode to the library afterwards
+stream_port = 0         # Local port the stream is served on (0 = any free port)
+skip_intro_outro = False    # Leave out the segments lying entirely inside the intro/outro (chapters are written either way)
+download_window = None  # Only download a time window of each episode, e.g. "60" (first minute) or "1:30-2:00" (None = whole episode)
+postprocess_workers = 2 # Episodes concatenated/muxed by ffmpeg at once, in the background of the downloads
+batch_lookahead = 1     # Episodes of a batch that prepare (subtitles, temp dir, disk check) while another downloads
+jobs_db = os.path.join(state_dir, "jobs.sqlite3")  # Job queue used by the download daemon (bin/pyanimed.py)
+daemon_workers = 2      # Episodes the daemon downloads at once
+job_attempts = 3        # Times a job is tried before it's marked failed (retry with `pyanimed retry`)
+job_poll = 5            # Seconds the daemon waits before looking at an empty queue again
+watchlist_interval = 6 * 3600  # Seconds between watchlist checks while the daemon runs (0 = only `pyanimed sync`)
+watchlist_concurrency = 8   # Followed series checked at once
+watchlist_rate = 2      # Max episode list requests per second during a check
+subtitle_cache_dir = os.path.join(state_dir, "subtitles")  # Subtitle tracks, shared by every download of an episode
+subtitle_cache_size = 200 * 1024 * 1024     # Bytes of subtitles kept, least recently used tracks are dropped first
+subtitle_revalidate = 24 * 3600             # Seconds a stored track is used before asking the server whether it changed
+library_db = os.path.join(state_dir, "library.sqlite3")  # Index of downloaded episodes with their integrity state
+min_coverage = 1.0      # Share of the episode (by playlist duration) that must be downloaded before it's assembled
+verify_tolerance = 2.0  # Seconds the finished file may be shorter than its playlist before its segments are checked and repaired
+repair_rounds = 2       # Times missing or damaged segments are fetched again before the episode fails
+renew_margin = 30       # Seconds before a signed segment URL expires that its playlist is resolved again
+renew_limit = 5         # Times one playlist may be resolved again during a download
+stall_grace = 3         # Seconds a segment transfer gets before its throughput is judged (also the longest silence allowed)
+stall_floor = 32 * 1024 # Bytes/s below which a segment transfer counts as stalled and is restarted
+hedge_limit = 2         # Duplicate requests for slow segments in flight at once per episode (0 = no hedging)
+hedge_percentile = 95   # A segment slower than this percentile of the ones before it gets a duplicate request
+hedge_min_samples = 10  # Segments timed before hedging starts
+bandwidth_limit = 0     # Bytes/s shared by every download when no profile applies (0 = unlimited)
+bandwidth_profiles = {"day": 0, "night": 0}  # Named limits in bytes/s, e.g. {"day": 2 * 1024 * 1024, "night": 0}
+bandwidth_schedule = []     # When each profile applies, e.g. [("08:00", "day"), ("23:00", "night")]
+memory_budget = 64 * 1024 * 1024    # Bytes of segment data in flight at once across all downloads (0 = no limit), lower it on small hosts
+metrics_port = 9477     # Port of the daemon's Prometheus endpoint (http://127.0.0.1:9477/metrics, 0 = off)
+trace_file = None       # Write a Chrome/Perfetto trace of every run here (also PYANIME_TRACE=path), None = off
+trace_max_events = 500000   # Spans kept in memory per process before new ones are dropped
+segment_trace = False   # Log every segment attempt at TRACE level (also PYANIME_LOG_TRACE=1), very chatty
+segment_log_rate = 10   # Same per-segment warning logged at most this often per segment_log_window, the rest are counted
+segment_log_window = 10 # Seconds
 
 
 # As of the current year 2025 hianime has
@@ -50,3 +103,19 @@ proxy_servers = {}      # here we have proxy set but not working just for showpi
 # If you want to discover more URLs, you can 
 # visit https://everythingmoe.com/ and can change 
 # the baseurl and the providers URL to the one you want to use.
+#
+# The scrapers probe every mirror below, use the fastest healthy one and
+# switch to the next best one whenever it stops answering.
+mirrors = [
+    configure["baseurl"],
+    "https://hianime.to",
+    "https://hianimez.is",
+    "https://hianime.cx",
+    "https://hianime.tv",
+    "https://kaido.to",
+    "https://hianime.nz",
+    "https://aniwatchtv.to",
+    "https://hianime.pe",
+    "https://9animetv.to",
+]
+mirror_ttl = 3600       # Seconds a mirror ranking is trusted before the mirrors are probed again
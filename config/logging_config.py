@@ -5,13 +5,29 @@ Logging configuration for pyanime project.
 Provides centralized logging setup with different log levels and handlers.
 """
 
+import atexit
 import logging
 import logging.handlers
+import functools
+import queue
+import reprlib
 import sys
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
 
 
+# Below DEBUG, for messages about every segment attempt (off unless a logger is set to it)
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+# Arguments of these types can be formatted later, on the writer thread, without changing under it
+_LAZY_ARGS = (str, int, float, bool, type(None))
+
+_listener = None
+
+
 class ColoredFormatter(logging.Formatter):
     """Custom formatter with colors for console output."""
     
@@ -44,6 +60,55 @@ class ColoredFormatter(logging.Formatter):
         return super().format(record_copy)
 
 
+class _LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the writer thread. Only records whose
+    arguments could change before they're written (lists, dicts, objects) are
+    rendered on the calling thread, like the stock QueueHandler does for all.
+    """
+
+    def prepare(self, record):
+        if record.args and not all(isinstance(arg, _LAZY_ARGS) for arg in
+                                   (record.args.values() if isinstance(record.args, dict) else record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `rate` records with the same message template per `per`
+    seconds. The first record after a quiet spell says how many were dropped.
+    TRACE records are never limited, whoever turns them on wants all of them.
+    """
+
+    def __init__(self, rate=10, per=10.0):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self._lock = threading.Lock()
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno <= TRACE or not self.rate:
+            return True
+        key = (record.levelno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.per:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+                return True
+            if window[1] < self.rate:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
 def setup_logging(
     log_level=logging.INFO,
     log_file=None,
@@ -65,12 +130,18 @@ def setup_logging(
         logger: Configured logger instance
     """
     
+    global _listener
+    
     # Create logger
     logger = logging.getLogger('pyanime')
     logger.setLevel(log_level)
     
-    # Clear any existing handlers
+    # Clear any existing handlers, and stop the writer thread of a previous setup
     logger.handlers.clear()
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    handlers = []
     
     # Create formatters
     detailed_formatter = logging.Formatter(
@@ -91,9 +162,8 @@ def setup_logging(
     # Console handler with colored output
     if console_output:
         console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setLevel(log_level)
         console_handler.setFormatter(colored_formatter)
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
     
     # File handler with rotation (no colors in log file)
     if log_file is None:
@@ -112,9 +182,16 @@ def setup_logging(
         backupCount=backup_count,
         encoding='utf-8'
     )
-    file_handler.setLevel(log_level)
     file_handler.setFormatter(detailed_formatter)  # Use detailed formatter without colors
-    logger.addHandler(file_handler)
+    handlers.append(file_handler)
+    
+    # Callers (the download loop among them) only put records on a queue, a background
+    # thread formats them and does the file writes and rotation. Levels are left to the
+    # loggers, so a logger set to TRACE gets through.
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(_LogQueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _listener.start()
     
     # Log the setup
     logger.info("Logging system initialized")
@@ -126,6 +203,17 @@ def setup_logging(
     return logger
 
 
+def stop_logging():
+    """Write out every queued record and stop the writer thread (runs at exit)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
 def get_logger(name=None):
     """
     Get a logger instance for a specific module.
@@ -141,9 +229,15 @@ def get_logger(name=None):
     return logging.getLogger(f'pyanime.{name}')
 
 
+def _summary(value):
+    """Short repr for debug logs, whole episode lists aren't worth rendering"""
+    return reprlib.repr(value)
+
+
 def log_function_call(logger):
     """
-    Decorator to log function calls with parameters and return values.
+    Decorator running each call of a function in a tracing span (see utils/tracing.py),
+    logging entry/exit with shortened arguments and results at debug and failures at error.
     
     Args:
         logger: Logger instance to use
@@ -152,18 +246,22 @@ def log_function_call(logger):
         decorator: Function decorator
     """
     def decorator(func):
+        # Imported here, utils.tracing itself logs through this module
+        from utils import tracing
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            # Log function entry
-            logger.debug("Entering function: %s", func.__name__)
-            logger.debug("Arguments: args=%s, kwargs=%s", args, kwargs)
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                logger.debug("Entering function: %s(%s)", func.__name__,
+                             ", ".join([_summary(arg) for arg in args] + [f"{k}={_summary(v)}" for k, v in kwargs.items()]))
             
             try:
-                # Execute function
-                result = func(*args, **kwargs)
+                with tracing.span(func.__name__, cat=func.__module__):
+                    result = func(*args, **kwargs)
                 
-                # Log successful completion
-                logger.debug("Function %s completed successfully", func.__name__)
-                logger.debug("Return value: %s", result)
+                if debug:
+                    logger.debug("Function %s returned %s", func.__name__, _summary(result))
                 
                 return result
                 
@@ -178,32 +276,18 @@ def log_function_call(logger):
 
 def log_performance(logger):
     """
-    Decorator to log function performance (execution time).
+    Decorator timing each call of a function as a tracing span, the same single timing path
+    log_function_call takes, so stacking both doesn't time a call twice. Use one of them.
     
     Args:
-        logger: Logger instance to use
+        logger: Unused, kept so existing call sites don't change
     
     Returns:
         decorator: Function decorator
     """
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            import time
-            start_time = time.time()
-            
-            try:
-                result = func(*args, **kwargs)
-                execution_time = time.time() - start_time
-                logger.debug("Function %s executed in %.4f seconds", func.__name__, execution_time)
-                return result
-                
-            except Exception as e:
-                execution_time = time.time() - start_time
-                logger.error("Function %s failed after %.4f seconds: %s", func.__name__, execution_time, str(e), exc_info=True)
-                raise
-        
-        return wrapper
-    return decorator
+    # Imported here, utils.tracing itself logs through this module
+    from utils import tracing
+    return tracing.traced()
 
 
 # Initialize default logger
@@ -224,7 +308,6 @@ if __name__ == "__main__":
     @log_function_call(logger)
     @log_performance(logger)
     def test_function(x, y):
-        import time
         time.sleep(0.1)  # Simulate some work
         return x + y
     
@@ -7,7 +7,6 @@ import asyncio
 import aiohttp
 import aiofiles
 import ffmpeg
-import requests
 import os
 import m3u8
 import tempfile
@@ -15,7 +14,10 @@ import shutil
 import random
 import sys
 from urllib.parse import urljoin
-from config.animekai import quality, parallel, logger, timeout, proxy_servers, server_type
+from config.animekai import quality, parallel, logger, timeout, proxy_servers, server_type, state_dir, proxy_race
+from utils.proxy_pool import ProxyPool
+
+_proxy_pool = ProxyPool(os.path.join(state_dir, "proxy_scores_animekai.json"), race_width=proxy_race)
 
 def get_headers(service):
     if service == "hd-1":
@@ -46,33 +48,9 @@ def get_headers(service):
         return hd2_headers
 
 def proxy(url, headers, proxy_servers, timeout):
-    """Try to fetch URL with native IP, then try with proxies if that fails"""
+    """Race the native IP against the best scored proxies and return the first good response"""
     try:
-        logger.debug("Trying native IP for %s", url)
-        response = requests.get(url, headers=headers, timeout=timeout)
-        if response.status_code == 200:
-            logger.debug("Native IP request successful")
-            return response
-        
-        logger.warning("Native IP request failed with status %s, trying proxies", response.status_code)
-        for proxy_server in proxy_servers:
-            try:
-                logger.debug("Trying proxy %s for %s", proxy_server, url)
-                proxies = {
-                    'http': proxy_server,
-                    'https': proxy_server
-                }
-                response = requests.get(url, headers=headers, proxies=proxies, timeout=timeout)
-                if response.status_code == 200:
-                    logger.debug("Proxy request successful with %s", proxy_server)
-                    return response
-                logger.warning("Proxy %s request failed with status %s", proxy_server, response.status_code)
-            except Exception as e:
-                logger.error("Error with proxy %s: %s", proxy_server, e)
-                continue
-        
-        logger.error("All proxy attempts failed for %s", url)
-        return None
+        return _proxy_pool.get(url, headers, proxy_servers, timeout)
     except Exception as e:
         logger.error("Error in proxy function: %s", e)
         return None
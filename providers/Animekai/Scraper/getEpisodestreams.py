@@ -14,7 +14,7 @@ import json
 project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 sys.path.insert(0, project_root)
 
-from config.logging_config import get_logger, log_function_call, log_performance
+from config.logging_config import get_logger, log_function_call
 from config.animekai import configure, proxy_headers, server_type
 
 # Setup logging for this module
@@ -22,7 +22,6 @@ logger = get_logger("scraper.getEpisodestreams")
 
 
 @log_function_call(logger)
-@log_performance(logger)
 def serverextractor(episode):
     logger.info("Extracting servers for episode: %s", episode["Title"])
     headers = {
@@ -147,7 +146,6 @@ def serverextractor(episode):
 
 
 @log_function_call(logger)
-@log_performance(logger)
 def streams(server, id_str):
     hd_1 = 'megaplay.buzz'
     hd_2 = 'vidwish.live'
@@ -10,7 +10,7 @@ from bs4 import BeautifulSoup
 project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 sys.path.insert(0, project_root)
 
-from config.logging_config import get_logger, log_function_call, log_performance
+from config.logging_config import get_logger, log_function_call
 from config.animekai import configure
 
 # Setup logging for this module
@@ -18,7 +18,6 @@ logger = get_logger("scraper.searchAnimedetails")
 
 
 @log_function_call(logger)
-@log_performance(logger)
 def searchAnimeandetails(name):
     logger.info("Searching for anime: %s", name)
     list_of_anime = []
@@ -121,7 +120,6 @@ def searchAnimeandetails(name):
 
 
 @log_function_call(logger)
-@log_performance(logger)
 def getAnimeDetails(watch_link):
     logger.info("Getting anime details for watch link: %s", watch_link)
     
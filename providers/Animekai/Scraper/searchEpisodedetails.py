@@ -12,7 +12,7 @@ from bs4 import BeautifulSoup
 project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 sys.path.insert(0, project_root)
 
-from config.logging_config import get_logger, log_function_call, log_performance
+from config.logging_config import get_logger, log_function_call
 from config.animekai import configure
 
 # Setup logging for this module
@@ -20,7 +20,6 @@ logger = get_logger("scraper.searchEpisodedetails")
 
 
 @log_function_call(logger)
-@log_performance(logger)
 def getanimepisode(watch_link):
     logger.info("Getting episode list for watch link: %s", watch_link)
     response = requests.get(watch_link, verify=False)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# chapters.py - Intro/outro segment skipping, chapter markers and subtitle retiming for the muxed episode
+
+import re
+from config.hianime import logger
+
+_TIMESTAMP = re.compile(r'(?:(\d+):)?(\d{2}):(\d{2})\.(\d{3})')
+
+
+def _range(marker):
+    """(start, end) of an intro/outro marker, None if the source doesn't have one"""
+    if not isinstance(marker, dict):
+        return None
+    try:
+        start, end = float(marker.get("start") or 0), float(marker.get("end") or 0)
+    except (TypeError, ValueError):
+        return None
+    return (start, end) if end > start else None
+
+
+def skipped_segments(playlist):
+    """
+    Indices of the segments lying entirely inside the intro or the outro.
+
+    Segments only partly covered are kept so no episode content is lost.
+
+    Args:
+        playlist (dict): Parsed media playlist with 'durations' and optional 'intro'/'outro' markers
+
+    Returns:
+        set: Segment indices that can be left out
+    """
+    ranges = [r for r in (_range(playlist.get("intro")), _range(playlist.get("outro"))) if r]
+    skipped = set()
+    position = 0.0
+    for index, duration in enumerate(playlist["durations"]):
+        segment_start, segment_end = position, position + duration
+        position = segment_end
+        if duration > 0 and any(start <= segment_start and segment_end <= end for start, end in ranges):
+            skipped.add(index)
+    return skipped
+
+
+def timeline(playlist, skipped):
+    """Map a time of the source episode onto the episode with the skipped segments cut out"""
+    cuts = []
+    position = 0.0
+    for index, duration in enumerate(playlist["durations"]):
+        if index in skipped:
+            cuts.append((position, position + duration))
+        position += duration
+
+    def output_time(t):
+        removed = 0.0
+        for start, end in cuts:
+            if t >= end:
+                removed += end - start
+            elif t > start:
+                # Inside a cut, snap to where the cut lands
+                removed += t - start
+        return t - removed
+
+    return output_time
+
+
+def chapter_marks(playlist, skipped):
+    """
+    Chapters around the intro and outro, on the timeline of the muxed file.
+
+    Returns:
+        list: dicts with 'title', 'start' and 'end' in seconds, empty if the source has no markers
+    """
+    intro = _range(playlist.get("intro"))
+    outro = _range(playlist.get("outro"))
+    if not intro and not outro:
+        return []
+
+    total = playlist["duration"]
+    marks = []
+    position = 0.0
+    if intro:
+        marks += [("Prologue", position, intro[0]), ("Opening", intro[0], intro[1])]
+        position = intro[1]
+    if outro:
+        marks += [("Episode", position, outro[0]), ("Ending", outro[0], outro[1])]
+        position = outro[1]
+    marks.append(("Preview" if outro else "Episode", position, total))
+
+    output_time = timeline(playlist, skipped)
+    chapters = []
+    for title, start, end in marks:
+        start, end = output_time(min(start, total)), output_time(min(end, total))
+        # Drop empty chapters (no prologue, intro cut out completely, ...)
+        if end - start >= 0.5:
+            chapters.append({"title": title, "start": start, "end": end})
+    return chapters
+
+
+def write_ffmetadata(chapters, path):
+    """Write chapters as an ffmpeg metadata file for the mux step"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(";FFMETADATA1\n")
+        for chapter in chapters:
+            f.write("[CHAPTER]\nTIMEBASE=1/1000\n")
+            f.write(f"START={int(chapter['start'] * 1000)}\nEND={int(chapter['end'] * 1000)}\n")
+            f.write(f"title={chapter['title']}\n")
+    return path
+
+
+def _parse_timestamp(match):
+    hours, minutes, seconds, millis = match.groups()
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + int(millis) / 1000
+
+
+def _format_timestamp(t):
+    millis = int(round(max(t, 0.0) * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    seconds, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{millis:03d}"
+
+
+def retime_subtitle(path, output_time, output=None):
+    """
+    Shift the cues of a WebVTT file onto the cut timeline, dropping cues that fall inside a cut
+    (or before the start of a clip).
+
+    Args:
+        path (str): Subtitle file
+        output_time (callable): Mapping returned by timeline()
+        output (str, optional): Where the retimed file is written (default: rewrite path in place)
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        blocks = f.read().replace('\r\n', '\n').split('\n\n')
+
+    kept = []
+    dropped = 0
+    for block in blocks:
+        lines = block.split('\n')
+        cue_line = next((i for i, line in enumerate(lines) if '-->' in line), None)
+        if cue_line is None:
+            kept.append(block)
+            continue
+        start_text, _, rest = lines[cue_line].partition('-->')
+        start_match = _TIMESTAMP.search(start_text)
+        end_match = _TIMESTAMP.search(rest)
+        if not start_match or not end_match:
+            kept.append(block)
+            continue
+        start = max(output_time(_parse_timestamp(start_match)), 0.0)
+        end = max(output_time(_parse_timestamp(end_match)), 0.0)
+        if end - start < 0.05:
+            dropped += 1
+            continue
+        settings = rest[end_match.end():]
+        lines[cue_line] = f"{_format_timestamp(start)} --> {_format_timestamp(end)}{settings}"
+        kept.append('\n'.join(lines))
+
+    with open(output or path, 'w', encoding='utf-8') as f:
+        f.write('\n\n'.join(kept))
+    logger.debug("Retimed %s, dropped %d cues inside skipped ranges", path, dropped)
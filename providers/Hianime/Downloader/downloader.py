@@ -9,13 +9,46 @@ import aiofiles
 import ffmpeg
 import requests
 import os
-import m3u8
 import tempfile
 import shutil
+import subprocess
 import random
 import sys
-from urllib.parse import urljoin
-from config.hianime import quality, parallel, logger, timeout, proxy_servers, server_type
+import json
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qsl
+from config.hianime import (quality, parallel, logger, timeout, proxy_servers, server_type, cache_dir,
+                            state_dir, variant_policy, target_time, probe_segments, proxy_race,
+                            stripe_servers, host_rate, skip_intro_outro, download_window,
+                            postprocess_workers, disk_reserve, min_coverage, verify_tolerance, repair_rounds,
+                            renew_margin, renew_limit, stall_grace, stall_floor, hedge_limit, hedge_percentile,
+                            hedge_min_samples, segment_trace, segment_log_rate, segment_log_window)
+from config.logging_config import get_logger, TRACE, RateLimitFilter
+from providers.Hianime.Downloader import subcache
+from providers.Hianime.Downloader.playlist import parse_master, parse_media, is_master, parse_window, covering_segments
+from providers.Hianime.Downloader.chapters import skipped_segments, timeline, chapter_marks, write_ffmetadata, retime_subtitle
+from utils.proxy_pool import ProxyPool
+from utils.stagegraph import StageGraph, StageFailed
+from utils.library import get_library, probe_duration, COMPLETE, CORRUPT, UNVERIFIED
+from utils.bandwidth import get_shaper
+from utils.budget import get_budget
+from utils import metrics, tracing
+
+# Reserved from the in-flight budget for a segment whose size the server doesn't tell
+UNKNOWN_SEGMENT_SIZE = 2 * 1024 * 1024
+
+# Full (200) answers to a byte-range request before a segment is given up, the server won't honour Range
+RANGE_IGNORED_LIMIT = 3
+
+# Messages about single segments: every attempt at TRACE (off unless asked for), problems sampled
+# so a flaky CDN can't flood the log from inside the download loop
+segment_log = get_logger("downloader.segments")
+segment_log.addFilter(RateLimitFilter(segment_log_rate, segment_log_window))
+if segment_trace or os.environ.get("PYANIME_LOG_TRACE"):
+    segment_log.setLevel(TRACE)
 
 # Conditional import for PyQt6 signals
 try:
@@ -36,6 +69,9 @@ else:
             pass
 
 progress_emitter = None
+# ffmpeg runs in its own process, a thread per job is enough to keep it off the event loop
+_postprocess_pool = ThreadPoolExecutor(max_workers=max(1, postprocess_workers), thread_name_prefix="postprocess")
+_proxy_pool = ProxyPool(os.path.join(state_dir, "proxy_scores_hianime.json"), race_width=proxy_race)
 
 def set_progress_emitter(emitter):
     global progress_emitter
@@ -71,39 +107,190 @@ def get_headers(service):
             'te': 'trailers',
         }
 
+def media_headers(m3u8_dict):
+    """Headers for the host a stream was resolved on, falling back to the configured server type"""
+    host = (m3u8_dict or {}).get("host")
+    if host == 'megaplay.buzz':
+        return get_headers("hd-1")
+    if host == 'vidwish.live':
+        return get_headers("hd-2")
+    return get_headers(server_type)
+
+
 def proxy(url, headers, proxy_servers, timeout):
     try:
-        logger.debug("Trying native IP for %s", url)
-        response = requests.get(url, headers=headers, timeout=timeout)
-        if response.status_code == 200:
-            logger.debug("Native IP request successful")
-            return response
-
-        logger.warning("Native IP request failed with status %s, trying proxies", response.status_code)
-        for proxy_server in proxy_servers:
-            try:
-                logger.debug("Trying proxy %s for %s", proxy_server, url)
-                proxies = {
-                    'http': proxy_server,
-                    'https': proxy_server
-                }
-                response = requests.get(url, headers=headers, proxies=proxies, timeout=timeout)
-                if response.status_code == 200:
-                    logger.debug("Proxy request successful with %s", proxy_server)
-                    return response
-                logger.warning("Proxy %s request failed with status %s", proxy_server, response.status_code)
-            except Exception as e:
-                logger.error("Error with proxy %s: %s", proxy_server, e)
-                continue
+        return _proxy_pool.get(url, headers, proxy_servers, timeout)
+    except Exception as e:
+        logger.error("Error in proxy function: %s", e)
+        return None
+
+
+def _fetch_probe_segment(url, headers):
+    start = time.perf_counter()
+    response = requests.get(url, headers=headers, timeout=timeout)
+    response.raise_for_status()
+    return len(response.content), time.perf_counter() - start
+
+
+def _probe_variant(variant_url, headers, count=probe_segments):
+    """Fetch a variant's media playlist and time its first few segments to measure throughput"""
+    media = proxy(variant_url, headers, proxy_servers, timeout)
+    if not media or media.status_code != 200:
+        logger.warning("Probe could not fetch variant playlist: %s", variant_url)
+        return None
 
-        logger.error("All proxy attempts failed for %s", url)
+    playlist = parse_media(media.text, variant_url)
+    if not playlist["uris"]:
         return None
+
+    urls = playlist["uris"][:count]
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=min(len(urls), parallel)) as pool:
+            results = list(pool.map(lambda url: _fetch_probe_segment(url, headers), urls))
     except Exception as e:
-        logger.error("Error in proxy function: %s", e)
+        logger.warning("Probe of %s failed: %s", variant_url, e)
+        return None
+    elapsed = time.perf_counter() - start
+
+    probed_bytes = sum(size for size, _ in results)
+    probed_duration = sum(playlist["durations"][:count])
+    if not probed_bytes or not probed_duration or not elapsed:
         return None
 
+    throughput = probed_bytes / elapsed
+    expected_bytes = probed_bytes / probed_duration * playlist["duration"]
+    return {
+        "url": variant_url,
+        "playlist": playlist,
+        "throughput": throughput,
+        "bitrate": probed_bytes * 8 / probed_duration,
+        "duration": playlist["duration"],
+        "predicted_time": expected_bytes / throughput,
+    }
 
-def m3u8_parsing(m3u8_dict):
+
+def _log_probe(record):
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        with open(os.path.join(state_dir, "variant_probes.jsonl"), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        logger.warning("Could not record variant probe: %s", e)
+
+
+def _tail_lines(path, count, block=8192):
+    """The last count lines of a file, read backwards from its end so a long log costs a few blocks"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        # One more newline than lines wanted, so the first line kept is whole
+        while position > 0 and data.count(b"\n") <= count:
+            step = min(block, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    return [line.decode('utf-8') for line in data.splitlines()[-count:] if line.strip()]
+
+
+def recent_throughput(samples=5):
+    """Average throughput (bytes/s) of the last logged variant probes, None if nothing was logged yet"""
+    try:
+        lines = _tail_lines(os.path.join(state_dir, "variant_probes.jsonl"), samples)
+        measured = [json.loads(line)["chosen"]["throughput"] for line in lines]
+        return sum(measured) / len(measured) if measured else None
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug("Could not read variant probes: %s", e)
+        return None
+
+
+def _select_by_throughput(variants, headers, quality=quality):
+    """
+    Pick the best variant that can be downloaded within target_time.
+
+    Variants above the configured quality are never considered. Candidates are
+    probed from the highest resolution down and the first one predicted to finish
+    in time wins; if none does, the fastest probed variant is used.
+    """
+    ceiling = int(quality.rstrip('p')) if quality.rstrip('p').isdigit() else None
+    candidates = sorted(
+        (variant for variant in variants if variant["height"] and (ceiling is None or variant["height"] <= ceiling)),
+        key=lambda variant: variant["height"], reverse=True)
+
+    measurements = []
+    chosen = None
+    for variant in candidates:
+        probe = _probe_variant(variant["uri"], headers)
+        if not probe:
+            continue
+        probe["height"] = variant["height"]
+        probe["bandwidth"] = variant["bandwidth"]
+        probe["codecs"] = variant.get("codecs")
+        measurements.append(probe)
+        logger.info("Probed %dp: %.0f KB/s, predicted %.0fs for the episode", probe["height"],
+                    probe["throughput"] / 1024, probe["predicted_time"])
+        if probe["predicted_time"] <= target_time:
+            chosen = probe
+            break
+
+    if not measurements:
+        return None
+    if chosen is None:
+        chosen = min(measurements, key=lambda probe: probe["predicted_time"])
+        logger.warning("No variant finishes within %ds, using the fastest (%dp)", target_time, chosen["height"])
+
+    logger.info("Throughput policy picked %dp (target %ds, requested %s)", chosen["height"], target_time, quality)
+    keys = ("height", "bandwidth", "throughput", "bitrate", "predicted_time")
+    _log_probe({
+        "time": time.time(),
+        "policy": "throughput",
+        "quality": quality,
+        "target_time": target_time,
+        "chosen": {key: chosen[key] for key in keys},
+        "measurements": [{key: probe[key] for key in keys} for probe in measurements],
+    })
+    return chosen
+
+
+def _fetch_variant(variant, headers):
+    media = proxy(variant["uri"], headers, proxy_servers, timeout)
+    if not media or media.status_code != 200:
+        logger.error("Failed to fetch final media: %s", variant["uri"])
+        return None
+    logger.info("Fetched final media: %s | Status: %s", variant["uri"], media.status_code)
+    playlist = parse_media(media.text, variant["uri"])
+    playlist["bandwidth"] = variant["bandwidth"]
+    playlist["height"] = variant["height"]
+    playlist["codecs"] = variant.get("codecs")
+    playlist["headers"] = headers
+    return playlist
+
+
+def _with_markers(playlist, intro, outro):
+    playlist["intro"] = intro
+    playlist["outro"] = outro
+    return playlist
+
+
+@metrics.timed("m3u8_parsing")
+@tracing.traced()
+def m3u8_parsing(m3u8_dict, height=None, quality=quality):
+    """
+    Fetch the master playlist of a stream, pick a variant and parse its media playlist.
+
+    Args:
+        m3u8_dict (dict): Stream sources as returned by streams()
+        height (int, optional): Take exactly this variant (used when resolving a playlist again
+                                mid-download, the new segments have to match the old ones)
+        quality (str, optional): Wanted variant, e.g. "720p" (config quality by default)
+
+    Returns:
+        tuple: (playlist dict from playlist.parse_media or None, episode title, subtitle tracks)
+    """
     try:
         logger.info("Starting m3u8_parsing for: %s", m3u8_dict.get("id", {}).get("Title", "Unknown"))
         url = m3u8_dict["link"]["file"]
@@ -111,57 +298,58 @@ def m3u8_parsing(m3u8_dict):
         intro = m3u8_dict["intro"]
         outro = m3u8_dict["outro"]
         logger.debug("URL: %s | Subtitles: %s | Intro: %s | Outro: %s", url, subtitles, intro, outro)
-        m3u8_data = proxy(url, get_headers(server_type), proxy_servers, timeout)
+        headers = media_headers(m3u8_dict)
+        m3u8_data = proxy(url, headers, proxy_servers, timeout)
         if not m3u8_data or m3u8_data.status_code != 200:
             logger.error("Failed to fetch m3u8 data: %s", url)
             return None, m3u8_dict["id"]["Title"], subtitles
 
         logger.info("Requested m3u8: %s | Status: %s", url, m3u8_data.status_code)
         playlist_str = m3u8_data.text
-        m3u8_obj = m3u8.loads(playlist_str)
         Name = m3u8_dict["id"]["Title"]
 
-        if not m3u8_obj.playlists:
+        if not is_master(playlist_str):
             logger.info("No variant playlists found, using direct media playlist")
-            return playlist_str, Name, subtitles
-
-        for playlist in m3u8_obj.playlists:
-            if not hasattr(playlist.stream_info, 'resolution') or not playlist.stream_info.resolution:
-                continue
-
-            stream_quality = f"{playlist.stream_info.resolution}".strip("()").replace(" ", "").split(",")[1]+"p"
+            playlist = parse_media(playlist_str, url)
+            playlist["bandwidth"] = None
+            playlist["headers"] = headers
+            return _with_markers(playlist, intro, outro), Name, subtitles
+
+        variants = [variant for variant in parse_master(playlist_str, url) if variant["height"]]
+
+        if height:
+            same = [variant for variant in variants if variant["height"] == height]
+            playlist = _fetch_variant(same[0], headers) if same else None
+            if not playlist:
+                logger.error("Variant %dp is gone from %s", height, url)
+                return None, Name, subtitles
+            return _with_markers(playlist, intro, outro), Name, subtitles
+
+        if variant_policy == "throughput":
+            chosen = _select_by_throughput(variants, headers, quality)
+            if chosen:
+                chosen["playlist"]["bandwidth"] = chosen["bandwidth"]
+                chosen["playlist"]["height"] = chosen["height"]
+                chosen["playlist"]["codecs"] = chosen["codecs"]
+                chosen["playlist"]["headers"] = headers
+                return _with_markers(chosen["playlist"], intro, outro), Name, subtitles
+            logger.warning("Throughput probing failed, falling back to quality matching")
+
+        for variant in variants:
+            stream_quality = f"{variant['height']}p"
             logger.debug("Checking stream quality: %s vs target: %s", stream_quality, quality)
             if quality == stream_quality:
-                final_url = m3u8_dict["link"]["file"].replace('/master.m3u8', f'/{playlist.uri}')
-                final_media = proxy(final_url, get_headers(server_type), proxy_servers, timeout)
-                if not final_media or final_media.status_code != 200:
-                    logger.error("Failed to fetch final media: %s", final_url)
-                    continue
-
-                logger.info("Fetched final media: %s | Status: %s", final_url, final_media.status_code)
-                return final_media.text, Name, subtitles
+                playlist = _fetch_variant(variant, headers)
+                if playlist:
+                    return _with_markers(playlist, intro, outro), Name, subtitles
 
         logger.warning("Requested quality %s not found, using highest available", quality)
-        highest_resolution = 0
-        highest_playlist = None
-
-        for playlist in m3u8_obj.playlists:
-            if not hasattr(playlist.stream_info, 'resolution') or not playlist.stream_info.resolution:
-                continue
-
-            resolution = playlist.stream_info.resolution
-            if resolution and len(resolution) >= 2:
-                height = int(resolution[1])
-                if height > highest_resolution:
-                    highest_resolution = height
-                    highest_playlist = playlist
-
-        if highest_playlist:
-            final_url = m3u8_dict["link"]["file"].replace('/master.m3u8', f'/{highest_playlist.uri}')
-            final_media = proxy(final_url, get_headers(server_type), proxy_servers, timeout)
-            if final_media and final_media.status_code == 200:
-                logger.info("Using highest quality: %dp", highest_resolution)
-                return final_media.text, Name, subtitles
+        if variants:
+            highest = max(variants, key=lambda variant: variant["height"])
+            playlist = _fetch_variant(highest, headers)
+            if playlist:
+                logger.info("Using highest quality: %dp", highest["height"])
+                return _with_markers(playlist, intro, outro), Name, subtitles
 
         return None, Name, subtitles
     except Exception as e:
@@ -169,55 +357,185 @@ def m3u8_parsing(m3u8_dict):
         return None, None, None
 
 
-async def _download_segment(session, semaphore, segment_url, segment_index, temp_dir, progress_queue=None):
+async def probe_playlist(playlist, count=probe_segments):
+    """Download the first few segments of a playlist concurrently and return the throughput in bytes/s"""
+    timeout_config = aiohttp.ClientTimeout(total=timeout * 2)
+
+    budget = get_budget()
+
+    async def fetch(session, index):
+        request_headers = None
+        if playlist["byteranges"][index]:
+            length, offset = playlist["byteranges"][index]
+            request_headers = {'Range': f"bytes={offset}-{offset + length - 1}"}
+        async with session.get(playlist["uris"][index], headers=request_headers) as response:
+            response.raise_for_status()
+            if request_headers and response.status != 206:
+                # A 200 is the whole resource, its size says nothing about this segment
+                raise ValueError(f"Server ignored the byte range of segment {index} (status {response.status})")
+            # Probe segments are read into memory whole
+            reserved = response.content_length or UNKNOWN_SEGMENT_SIZE
+            await budget.acquire(reserved)
+            try:
+                return len(await response.read())
+            finally:
+                budget.release(reserved)
+
+    async with aiohttp.ClientSession(timeout=timeout_config, headers=playlist.get("headers") or get_headers(server_type)) as session:
+        start = time.perf_counter()
+        sizes = await asyncio.gather(*[fetch(session, i) for i in range(min(count, len(playlist["uris"])))])
+        elapsed = time.perf_counter() - start
+
+    return sum(sizes) / elapsed if elapsed > 0 else 0.0
+
+
+class _Stalled(Exception):
+    """A segment transfer fell below stall_floor"""
+
+
+class PlaylistExpired(Exception):
+    """A signed segment URL was refused, its playlist has to be resolved again"""
+
+
+def _url_expiry(url):
+    """Unix time a signed URL stops working, if it carries one in its query (expires=, exp=, e=, ...)"""
+    for key, value in parse_qsl(urlparse(url).query):
+        if key.lower() in ("expires", "expire", "exp", "e") and value.isdigit() and len(value) == 10:
+            return int(value)
+    return None
+
+
+async def _download_segment(session, semaphore, segment_url, segment_index, temp_dir, progress_queue=None, byterange=None,
+                            max_attempts=None, raise_expired=False):
+    request_headers = None
+    expected_status = 200
+    shaper = get_shaper()
+    budget = get_budget()
+    if byterange:
+        length, offset = byterange
+        request_headers = {'Range': f"bytes={offset}-{offset + length - 1}"}
+        expected_status = 206
+
     async with semaphore:
         retry_count = 0
+        ranges_ignored = 0
         backoff_time = 1
         max_backoff = 30
 
         while True:
+            if max_attempts is not None and retry_count >= max_attempts:
+                segment_log.warning("Giving up on segment %d from %s after %d attempts", segment_index, segment_url, retry_count)
+                metrics.segments.inc(result="failed")
+                return None, segment_index
             try:
-                logger.debug("Downloading segment %d from URL: %s (attempt %d)", segment_index, segment_url, retry_count + 1)
-                async with session.get(segment_url, headers=get_headers(server_type), timeout=timeout) as response:
-                    if response.status != 200:
-                        logger.warning("Segment %d returned status code %d (attempt %d)", segment_index, response.status, retry_count + 1)
-                        retry_count += 1
-                        backoff_time = min(backoff_time * 1.5, max_backoff) * (0.8 + 0.4 * random.random())
-                        await asyncio.sleep(backoff_time)
-                        continue
-
-                    segment_file = os.path.join(temp_dir, f"segment_{segment_index:06d}.ts")
-
-                    content_length = response.headers.get('Content-Length')
-                    if content_length and int(content_length) == 0:
-                        logger.warning("Segment %d has zero content length (attempt %d)", segment_index, retry_count + 1)
-                        retry_count += 1
-                        await asyncio.sleep(backoff_time)
-                        continue
-
-                    async with aiofiles.open(segment_file, 'wb') as f:
-                        async for chunk in response.content.iter_chunked(8192):
-                            await f.write(chunk)
-
-                    if os.path.exists(segment_file) and os.path.getsize(segment_file) > 0:
-                        logger.debug("Successfully downloaded segment %d", segment_index + 1)
-                        if progress_queue is not None:
-                            await progress_queue.put(("success", segment_index))
-                        return segment_file, segment_index
-                    else:
-                        logger.warning("Segment %d file is empty or not created (attempt %d)", segment_index, retry_count + 1)
-                        retry_count += 1
-                        await asyncio.sleep(backoff_time)
-                        continue
-
+                with tracing.span("segment", index=segment_index, attempt=retry_count + 1) as segment_span:
+                    segment_log.log(TRACE, "Downloading segment %d from URL: %s (attempt %d)", segment_index, segment_url, retry_count + 1)
+                    # No total deadline: time spent waiting on the bandwidth limiter would count against it,
+                    # and a low limit would time out every segment. A dead server is caught by sock_read
+                    # (aiohttp stops it while reading is paused), a slow one by the stall check below.
+                    request_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=stall_grace)
+                    started = time.monotonic()
+                    async with session.get(segment_url, headers=request_headers, timeout=request_timeout) as response:
+                        metrics.request_seconds.observe(time.monotonic() - started, host=urlparse(segment_url).hostname or "unknown")
+                        segment_span.set(status=response.status)
+                        if raise_expired and response.status in (401, 403, 410):
+                            metrics.retries.inc(cause="expired")
+                            raise PlaylistExpired(f"Segment {segment_index} returned {response.status}")
+                        if byterange and response.status == 200:
+                            # The server ignored Range and sends the whole resource, which must not become the segment
+                            ranges_ignored += 1
+                            metrics.retries.inc(cause="range_ignored")
+                            if ranges_ignored >= RANGE_IGNORED_LIMIT:
+                                segment_log.error("Segment %d: %s keeps ignoring the byte range, giving up", segment_index, segment_url)
+                                metrics.segments.inc(result="failed")
+                                return None, segment_index
+                            segment_log.warning("Segment %d returned 200 instead of 206 for its byte range (attempt %d)", segment_index, retry_count + 1)
+                            retry_count += 1
+                            await asyncio.sleep(backoff_time)
+                            continue
+                        if byterange and response.content_length is not None and response.content_length != byterange[0]:
+                            segment_log.warning("Segment %d returned %d bytes for a %d byte range (attempt %d)", segment_index,
+                                                response.content_length, byterange[0], retry_count + 1)
+                            metrics.retries.inc(cause="range_length")
+                            retry_count += 1
+                            await asyncio.sleep(backoff_time)
+                            continue
+                        if response.status != expected_status:
+                            segment_log.warning("Segment %d returned status code %d (attempt %d)", segment_index, response.status, retry_count + 1)
+                            metrics.retries.inc(cause=f"http_{response.status}")
+                            retry_count += 1
+                            backoff_time = min(backoff_time * 1.5, max_backoff) * (0.8 + 0.4 * random.random())
+                            await asyncio.sleep(backoff_time)
+                            continue
+
+                        segment_file = os.path.join(temp_dir, f"segment_{segment_index:06d}.ts")
+
+                        content_length = response.headers.get('Content-Length')
+                        if content_length and int(content_length) == 0:
+                            segment_log.warning("Segment %d has zero content length (attempt %d)", segment_index, retry_count + 1)
+                            metrics.retries.inc(cause="empty")
+                            retry_count += 1
+                            await asyncio.sleep(backoff_time)
+                            continue
+
+                        # Room for the body has to be reserved before it's read, and is given back once it's on disk
+                        reserved = byterange[0] if byterange else int(content_length or 0) or UNKNOWN_SEGMENT_SIZE
+                        throttled = await budget.acquire(reserved)
+
+                        # Written under a unique name first, a hedged duplicate may be fetching the same segment
+                        part_file = f"{segment_file}.{uuid.uuid4().hex}.part"
+                        try:
+                            received = 0
+                            async with aiofiles.open(part_file, 'wb') as f:
+                                async for chunk in response.content.iter_chunked(8192):
+                                    # Every download in the process draws from the same bandwidth budget
+                                    throttled += await shaper.consume(len(chunk))
+                                    await f.write(chunk)
+                                    received += len(chunk)
+                                    # Time spent waiting on the limiter isn't the server's fault
+                                    elapsed = time.monotonic() - started - throttled
+                                    if elapsed > stall_grace and received / elapsed < stall_floor:
+                                        raise _Stalled(f"{received / elapsed / 1024:.0f} KB/s after {elapsed:.1f}s")
+                            if received:
+                                os.replace(part_file, segment_file)
+                        finally:
+                            budget.release(reserved)
+                            if os.path.exists(part_file):
+                                os.remove(part_file)
+
+                        if os.path.exists(segment_file) and os.path.getsize(segment_file) > 0:
+                            segment_log.log(TRACE, "Successfully downloaded segment %d", segment_index + 1)
+                            metrics.segments.inc(result="ok")
+                            metrics.segment_bytes.inc(received)
+                            segment_span.set(bytes=received, throttled=round(throttled, 3))
+                            if progress_queue is not None:
+                                await progress_queue.put(("success", segment_index))
+                            return segment_file, segment_index
+                        else:
+                            segment_log.warning("Segment %d file is empty or not created (attempt %d)", segment_index, retry_count + 1)
+                            metrics.retries.inc(cause="empty")
+                            retry_count += 1
+                            await asyncio.sleep(backoff_time)
+                            continue
+
+            except PlaylistExpired:
+                raise
+            except _Stalled as e:
+                segment_log.warning("Segment %d stalled (%s), restarting it (attempt %d)", segment_index, e, retry_count + 1)
+                metrics.retries.inc(cause="stall")
+                retry_count += 1
+                if progress_queue is not None:
+                    await progress_queue.put(("retry", segment_index))
             except asyncio.TimeoutError:
-                logger.warning("Timeout downloading segment %d (attempt %d)", segment_index, retry_count + 1)
+                segment_log.warning("Timeout downloading segment %d (attempt %d)", segment_index, retry_count + 1)
+                metrics.retries.inc(cause="timeout")
                 retry_count += 1
                 if progress_queue is not None:
                     await progress_queue.put(("retry", segment_index))
                 await asyncio.sleep(backoff_time)
             except Exception as e:
-                logger.error("Error downloading segment %d: %s (attempt %d)", segment_index, e, retry_count + 1)
+                segment_log.error("Error downloading segment %d: %s (attempt %d)", segment_index, e, retry_count + 1)
+                metrics.retries.inc(cause="error")
                 retry_count += 1
                 if progress_queue is not None:
                     await progress_queue.put(("retry", segment_index))
@@ -266,91 +584,290 @@ async def _update_progress_bar(progress_queue, total_segments):
     logger.info(f"Downloaded {total_segments} segments with {retries} retries")
 
 
-async def _download_all_segments(m3u8_url, segments, temp_dir, max_concurrent):
-    semaphore = asyncio.Semaphore(max_concurrent)
+def _equivalent(playlist, other):
+    """
+    Two playlists can be striped (or repaired from one another) if they are the same rendition
+    cut into the same segments. Servers pick their variants independently and renditions are
+    usually segment-aligned, so 1080p on one server and 720p on another would pass on timing
+    alone and the concat copy would mix resolutions.
+    """
+    if playlist.get("height") != other.get("height"):
+        return False
+    for key in ("bandwidth", "codecs"):
+        # Compared when both servers announce it
+        if playlist.get(key) and other.get(key) and playlist[key] != other[key]:
+            return False
+    if len(playlist["uris"]) != len(other["uris"]):
+        return False
+    return all(abs(a - b) < 0.05 for a, b in zip(playlist["durations"], other["durations"]))
 
-    if m3u8_url and not m3u8_url.endswith('/'):
-        base_url = m3u8_url + '/'
-    else:
-        base_url = m3u8_url or ''
 
-    logger.info("Using base URL for segments: %s", base_url)
+async def _throttle(limiter):
+    """Space out request starts on one host to at most host_rate per second"""
+    if not host_rate:
+        return
+    async with limiter["lock"]:
+        now = time.monotonic()
+        wait_time = limiter["next"] - now
+        limiter["next"] = max(now, limiter["next"]) + 1 / host_rate
+    if wait_time > 0:
+        await asyncio.sleep(wait_time)
 
-    connector = aiohttp.TCPConnector(limit=max_concurrent * 2, force_close=False)
-    timeout_config = aiohttp.ClientTimeout(total=timeout * 2)
 
-    progress_queue = asyncio.Queue()
+async def _reresolve(source):
+    playlist = source["playlist"]
+    try:
+        if source["renewals"] >= renew_limit:
+            logger.error("Playlist of %s was already resolved %d times, not trying again", playlist.get("uri"), renew_limit)
+            return False
+        source["renewals"] += 1
+        logger.info("Signed segment URLs expired, resolving the playlist again")
+        fresh = await asyncio.to_thread(playlist["refresh"])
+        if not fresh or not _equivalent(playlist, fresh):
+            logger.error("The playlist resolved again doesn't match the one being downloaded")
+            return False
+        # Same segmentation, so every pending index maps onto the new URL at the same position.
+        # The list objects are updated in place so later repair fetches see the new URLs too.
+        playlist["uris"][:] = fresh["uris"]
+        playlist["byteranges"][:] = fresh["byteranges"]
+        playlist["keys"][:] = fresh["keys"]
+        source["generation"] += 1
+        logger.info("Playlist renewed (%d/%d), continuing with the new URLs", source["renewals"], renew_limit)
+        return True
+    except Exception as e:
+        logger.error("Resolving the playlist again failed: %s", e)
+        return False
+    finally:
+        source["renewal"] = None
 
-    async with aiohttp.ClientSession(
-        connector=connector,
-        timeout=timeout_config,
-        headers=get_headers(server_type)
-    ) as session:
-        tasks = []
-        valid_segments = 0
 
-        for i, segment in enumerate(segments):
-            try:
-                if hasattr(segment, 'uri'):
-                    segment_url = segment.uri
-                elif isinstance(segment, dict) and 'uri' in segment:
-                    segment_url = segment['uri']
-                else:
-                    logger.warning("Segment %d has invalid format: %s", i, segment)
-                    continue
+async def _renew(source, generation):
+    """
+    Get fresh URLs for a source whose signed URLs expired. Every worker that runs into the
+    expiry waits on the same renewal, and requests started before a renewal don't trigger
+    another one.
 
-                if not segment_url or segment_url.strip() == '':
-                    logger.warning("Segment %d has empty URI", i)
-                    continue
+    Returns:
+        bool: True if the source has URLs newer than the ones the request used
+    """
+    if source["generation"] != generation:
+        return True
+    if source["renewal"] is None:
+        source["renewal"] = asyncio.ensure_future(_reresolve(source))
+    return await asyncio.shield(source["renewal"])
 
-                if not segment_url.startswith('http'):
-                    segment_url = urljoin(base_url, segment_url)
 
-                if not segment_url.startswith('http'):
-                    logger.warning("Segment %d has invalid URL: %s", i, segment_url)
+def _hedge_delay(times):
+    """Seconds a segment may take before it's hedged, None while there are too few timings to tell"""
+    if not hedge_limit or len(times) < hedge_min_samples:
+        return None
+    ordered = sorted(times)
+    percentile = ordered[min(len(ordered) - 1, int(len(ordered) * hedge_percentile / 100))]
+    # Never sooner than twice the median, ordinary jitter isn't worth a duplicate request
+    return max(percentile, 2 * ordered[len(ordered) // 2])
+
+
+async def _with_hedge(primary, index, source, sources, temp_dir, progress_queue, hedging):
+    """
+    Wait for a segment download. Once it takes longer than the hedge_percentile of the
+    segments so far, a duplicate request goes to another server (or another connection
+    to the same one) and whichever finishes first is kept, the other one is cancelled.
+    """
+    delay = _hedge_delay(hedging["times"])
+    if delay is None:
+        return await primary
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or hedging["semaphore"].locked():
+        return await primary
+
+    others = [other for other in sources if other is not source and index not in other["failed"]]
+    target = max(others, key=lambda other: other["segments"] / other["seconds"] if other["seconds"] else 0) if others else source
+    hedging["sent"] += 1
+    segment_log.debug("Segment %d is past %.1fs, hedging on %s", index, delay, target["playlist"].get("uri"))
+    hedge = asyncio.ensure_future(_download_segment(
+        target["session"], hedging["semaphore"], target["playlist"]["uris"][index], index, temp_dir,
+        None, target["playlist"]["byteranges"][index], 2))
+
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if hedge in done and not hedge.cancelled() and hedge.exception() is None and hedge.result()[0]:
+                hedging["won"] += 1
+                if progress_queue is not None:
+                    await progress_queue.put(("success", index))
+                return hedge.result()
+            if primary in done:
+                result = primary.result()
+                if result[0] or hedge not in pending:
+                    return result
+        return primary.result()
+    finally:
+        for task in (primary, hedge):
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(primary, hedge, return_exceptions=True)
+
+
+async def _source_worker(source, sources, queue, files, temp_dir, progress_queue, max_attempts, hedging):
+    while True:
+        index = await queue.get()
+        try:
+            if index in source["failed"]:
+                if all(index in other["failed"] for other in sources):
+                    # Every CDN failed this one, start over everywhere
+                    for other in sources:
+                        other["failed"].discard(index)
+                else:
+                    # Leave it for a CDN that hasn't failed it yet
+                    queue.put_nowait(index)
+                    await asyncio.sleep(1)
                     continue
 
-                task = _download_segment(session, semaphore, segment_url, i, temp_dir, progress_queue)
-                tasks.append(task)
-                valid_segments += 1
-            except Exception as e:
-                logger.error("Error processing segment %d: %s", i, e)
+            renewable = source["playlist"].get("refresh") is not None
+            expiry = _url_expiry(source["playlist"]["uris"][index]) if renewable else None
+            if expiry and expiry - time.time() < renew_margin:
+                await _renew(source, source["generation"])
 
-        logger.info("Created %d download tasks out of %d segments", valid_segments, len(segments))
+            await _throttle(source["limiter"])
+            start = time.perf_counter()
+            generation = source["generation"]
+            try:
+                primary = asyncio.ensure_future(_download_segment(
+                    source["session"], source["semaphore"], source["playlist"]["uris"][index], index, temp_dir,
+                    progress_queue, source["playlist"]["byteranges"][index], max_attempts, raise_expired=renewable))
+                segment_file, _ = await _with_hedge(primary, index, source, sources, temp_dir, progress_queue, hedging)
+            except PlaylistExpired as e:
+                logger.warning("%s, the signed URLs have probably expired", e)
+                if not await _renew(source, generation):
+                    # Renewal didn't work out, from now on this source retries like before
+                    source["playlist"]["refresh"] = None
+                queue.put_nowait(index)
+                continue
+            if segment_file:
+                files[index] = segment_file
+                metrics.queue_depth.dec(queue="segments")
+                source["segments"] += 1
+                source["seconds"] += time.perf_counter() - start
+                hedging["times"].append(time.perf_counter() - start)
+            else:
+                # Let another CDN have a go at it
+                source["failures"] += 1
+                source["failed"].add(index)
+                queue.put_nowait(index)
+        finally:
+            queue.task_done()
+
+
+@metrics.timed("download")
+@tracing.traced("download")
+async def _download_all_segments(playlist, temp_dir, max_concurrent, alternates=None, indices=None):
+    """
+    Download every segment of a playlist (or only the given segment indices).
+
+    Segment indices are put on one shared queue. Each source playlist (the main one
+    plus every alternate with identical segmentation) gets its own session,
+    max_concurrent workers and host rate limit. Workers pull the next index as soon
+    as they're free, so the faster CDN naturally takes the larger share of the
+    episode. With several sources, a segment that keeps failing on one CDN goes back
+    on the queue for the others.
+
+    A playlist with a "refresh" callable (returning the same playlist with fresh signed
+    URLs) is resolved again when its segments start getting refused or their URLs are
+    about to expire, and the download carries on with the segments still pending.
+    """
+    sources = [playlist]
+    if stripe_servers:
+        for alternate in alternates or []:
+            if _equivalent(playlist, alternate):
+                sources.append(alternate)
+            else:
+                logger.info("Alternate playlist %s has a different segmentation, not striping", alternate.get("uri"))
 
-        if not tasks:
-            logger.error("No valid segments to download")
-            return []
+    if any(playlist["keys"]):
+        logger.warning("Playlist has encrypted segments, they are saved as-is")
 
-        progress_task = asyncio.create_task(_update_progress_bar(progress_queue, valid_segments))
+    if indices is None:
+        indices = range(len(playlist["uris"]))
+    total = len(indices)
+    if not total:
+        logger.error("No valid segments to download")
+        return []
 
-        print(f"Downloading {valid_segments} segments with {max_concurrent} concurrent connections...")
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+    timeout_config = aiohttp.ClientTimeout(total=timeout * 2)
+    progress_queue = asyncio.Queue()
+    queue = asyncio.Queue()
+    for index in indices:
+        queue.put_nowait(index)
+    metrics.queue_depth.inc(total, queue="segments")
+
+    files = {}
+    max_attempts = 3 if len(sources) > 1 else None
+    # Timings of the latest segments and a separate budget for duplicate requests,
+    # so hedges never wait behind the regular workers
+    hedging = {"times": deque(maxlen=200), "semaphore": asyncio.Semaphore(max(1, hedge_limit)), "sent": 0, "won": 0}
+    workers = []
+    try:
+        for source_playlist in sources:
+            source = {
+                "playlist": source_playlist,
+                "session": aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=max_concurrent * 2, force_close=False),
+                    timeout=timeout_config,
+                    headers=source_playlist.get("headers") or get_headers(server_type)),
+                "semaphore": asyncio.Semaphore(max_concurrent),
+                "limiter": {"lock": asyncio.Lock(), "next": 0.0},
+                "segments": 0,
+                "seconds": 0.0,
+                "failures": 0,
+                "failed": set(),
+                "generation": 0,
+                "renewals": 0,
+                "renewal": None,
+            }
+            workers.append(source)
+
+        tasks = [
+            asyncio.create_task(_source_worker(source, workers, queue, files, temp_dir, progress_queue, max_attempts, hedging))
+            for source in workers for _ in range(max_concurrent)
+        ]
+        progress_task = asyncio.create_task(_update_progress_bar(progress_queue, total))
+
+        print(f"Downloading {total} segments with {max_concurrent} concurrent connections"
+              f"{f' on each of {len(sources)} servers' if len(sources) > 1 else ''}...")
+        await queue.join()
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
         try:
             await progress_task
         except Exception as e:
             logger.error("Error in progress bar: %s", e)
-
-    successful = []
-    failed = 0
-
-    for result in results:
-        if isinstance(result, Exception):
-            logger.error("Task exception: %s", result)
-            failed += 1
-        elif result[0] is None:
-            failed += 1
-        else:
-            successful.append(result)
-
-    logger.info("Downloaded %d/%d segments successfully", len(successful), len(tasks))
-
-    successful.sort(key=lambda x: x[1])
-    return [seg_file for seg_file, _ in successful]
-
-
-async def download_subtitles(subtitles, temp_dir):
+    finally:
+        for source in workers:
+            await source["session"].close()
+        # Whatever was never fetched leaves the queue with this download
+        metrics.queue_depth.dec(total - len(files), queue="segments")
+
+    for source in workers:
+        logger.info("Source %s: %d segments, %d failures, %.2fs busy", source["playlist"].get("uri"),
+                    source["segments"], source["failures"], source["seconds"])
+
+    budget = get_budget().stats()
+    if budget["capacity"]:
+        logger.info("In-flight budget: peak %.1f of %.1f MB, %d waits (%.1fs)", budget["peak"] / 1024 ** 2,
+                    budget["capacity"] / 1024 ** 2, budget["waits"], budget["wait_seconds"])
+    if hedging["sent"]:
+        logger.info("Hedged %d slow segments, the duplicate finished first %d times", hedging["sent"], hedging["won"])
+    logger.info("Downloaded %d/%d segments successfully", len(files), total)
+    return [files[index] for index in sorted(files)]
+
+
+@tracing.traced("subtitles")
+async def download_subtitles(subtitles):
+    """Subtitle tracks of an episode, served from the subtitle store when they haven't changed"""
     downloaded_subs = []
 
     subtitle_tracks = [
@@ -372,52 +889,34 @@ async def download_subtitles(subtitles, temp_dir):
             headers=get_headers(server_type)
         ) as session:
 
-            tasks = []
-            for i, sub in enumerate(subtitle_tracks):
-                subtitle_url = sub['file']
-                label = sub['label']
-
-                safe_label = ''.join(ch for ch in label if ch.isalnum() or ch in '-_ ')
-                subtitle_filename = f"{safe_label}_{i}.vtt"
-                subtitle_path = os.path.join(temp_dir, subtitle_filename)
-
-                task = download_single_subtitle(session, subtitle_url, subtitle_path, label)
-                tasks.append((task, sub, subtitle_path))
-
-            for task, sub_info, subtitle_path in tasks:
-                try:
-                    result = await task
-                    if result:
-                        downloaded_subs.append({
-                            'path': subtitle_path,
-                            'label': sub_info['label'],
-                        })
-                        logger.info("Downloaded subtitle: %s", sub_info['label'])
-                except Exception as e:
-                    logger.error("Failed to download subtitle %s: %s", sub_info['label'], e)
+            results = await asyncio.gather(
+                *(subcache.fetch(session, sub['file'], get_headers(server_type)) for sub in subtitle_tracks),
+                return_exceptions=True)
+
+            for sub_info, result in zip(subtitle_tracks, results):
+                if isinstance(result, Exception) or not result:
+                    logger.error("Failed to download subtitle %s: %s", sub_info['label'], result)
+                    continue
+                downloaded_subs.append({
+                    'path': result,
+                    'label': sub_info['label'],
+                })
+                logger.info("Got subtitle: %s", sub_info['label'])
 
     except Exception as e:
         logger.error("Error in download_subtitles: %s", e)
 
-    logger.info("Downloaded %d subtitle files", len(downloaded_subs))
-    return downloaded_subs
-
-
-async def download_single_subtitle(session, subtitle_url, subtitle_path, label):
     try:
-        async with session.get(subtitle_url, headers=get_headers(server_type)) as response:
-            response.raise_for_status()
-            content = await response.text()
-
-            async with aiofiles.open(subtitle_path, 'w', encoding='utf-8') as f:
-                await f.write(content)
-
-            return True
+        subcache.evict()
     except Exception as e:
-        logger.error("Error downloading subtitle %s: %s", label, e)
-        return False
+        logger.warning("Subtitle cache eviction failed: %s", e)
+
+    logger.info("Downloaded %d subtitle files", len(downloaded_subs))
+    return downloaded_subs
 
 
+@metrics.timed("concat")
+@tracing.traced("concat")
 def _concatenate_segments(segment_files, temp_dir):
     if not segment_files:
         logger.error("No segment files to concatenate")
@@ -467,19 +966,41 @@ def _concatenate_segments(segment_files, temp_dir):
         raise
 
 
-def _mux_with_subtitles(video_file, output_file, downloaded_subs=None):
+def _run_with_chapters(stream, chapters_file, input_count):
+    """Run an ffmpeg-python output with an extra ffmetadata input providing the chapters"""
+    if not chapters_file:
+        stream.run(overwrite_output=True, quiet=True)
+        return
+    # ffmpeg-python maps every input it knows about, and a metadata file has no streams to map,
+    # so the metadata input is spliced into the command line after the media inputs
+    args = stream.compile(overwrite_output=True)
+    after_inputs = max(i for i, arg in enumerate(args) if arg == '-i') + 2
+    args[after_inputs:after_inputs] = ['-f', 'ffmetadata', '-i', chapters_file]
+    args[-2:-2] = ['-map_chapters', str(input_count)]
+    process = subprocess.run(args, capture_output=True)
+    if process.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', process.stdout, process.stderr)
+
+
+@metrics.timed("mux")
+@tracing.traced("mux")
+def _mux_with_subtitles(video_file, output_file, downloaded_subs=None, chapters_file=None, trim=None):
     try:
         if not video_file or not os.path.exists(video_file):
             logger.error("Video file does not exist: %s", video_file)
             raise ValueError(f"Video file does not exist: {video_file}")
 
+        # trim is (offset into the video, length or None) for time-window downloads
+        video_options = {'ss': trim[0]} if trim and trim[0] else {}
+        trim_options = {'t': trim[1]} if trim and trim[1] else {}
+
         if not downloaded_subs:
             logger.info("Muxing video without subtitles")
-            (
+            _run_with_chapters(
                 ffmpeg
-                .input(video_file)
-                .output(output_file, c='copy')
-                .run(overwrite_output=True, quiet=True)
+                .input(video_file, **video_options)
+                .output(output_file, c='copy', **trim_options),
+                chapters_file, 1
             )
             return
 
@@ -500,26 +1021,26 @@ def _mux_with_subtitles(video_file, output_file, downloaded_subs=None):
 
         if not subtitle_paths:
             logger.info("No valid subtitle files found, muxing video only")
-            (
+            _run_with_chapters(
                 ffmpeg
-                .input(video_file)
-                .output(output_file, c='copy')
-                .run(overwrite_output=True, quiet=True)
+                .input(video_file, **video_options)
+                .output(output_file, c='copy', **trim_options),
+                chapters_file, 1
             )
             return
 
         logger.info("Muxing video with %d subtitle tracks", len(subtitle_paths))
-        inputs = [ffmpeg.input(video_file)]
+        inputs = [ffmpeg.input(video_file, **video_options)]
         inputs.extend([ffmpeg.input(sub_path) for sub_path in subtitle_paths])
 
-        output_kwargs = {'c:v': 'copy', 'c:a': 'copy', 'avoid_negative_ts': 'disabled'}
+        output_kwargs = {'c:v': 'copy', 'c:a': 'copy', 'avoid_negative_ts': 'disabled', **trim_options}
         for i in range(len(subtitle_paths)):
             output_kwargs[f'c:s:{i}'] = 'copy'
 
-        (
+        _run_with_chapters(
             ffmpeg
-            .output(*inputs, output_file, **output_kwargs)
-            .run(overwrite_output=True, quiet=True)
+            .output(*inputs, output_file, **output_kwargs),
+            chapters_file, len(inputs)
         )
 
         if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
@@ -533,6 +1054,246 @@ def _mux_with_subtitles(video_file, output_file, downloaded_subs=None):
         raise
 
 
+def _sanitize(name):
+    chars_to_remove = set(r'\\/"?*|')
+    return ''.join(ch for ch in name if ch not in chars_to_remove)
+
+
+def output_path(Name, Anime):
+    return os.path.join(cache_dir, _sanitize(Anime), f"{_sanitize(Name)}.mkv")
+
+
+def segment_cache_path(Name, Anime):
+    """Directory where an episode's segments are kept between runs (streaming, resumable jobs)"""
+    return os.path.join(state_dir, "segments", _sanitize(Anime), _sanitize(Name))
+
+
+def _check_work_dir(work_dir, playlist):
+    """
+    Drop segments left in a work dir by another playlist. A retry can resolve another
+    variant or server with the same segmentation, so the rendition and the host are part
+    of the signature too (not the full URL, signed query strings change on every resolve).
+    """
+    source = playlist.get("uri") or (playlist["uris"][0] if playlist["uris"] else "")
+    signature = {"segments": len(playlist["uris"]), "duration": round(playlist["duration"], 1),
+                 "height": playlist.get("height"), "bandwidth": playlist.get("bandwidth"),
+                 "host": urlparse(source).hostname}
+    signature_file = os.path.join(work_dir, "playlist.json")
+    try:
+        with open(signature_file, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+    except (FileNotFoundError, ValueError):
+        previous = None
+    if previous is not None and previous != signature:
+        logger.warning("Segments in %s belong to another playlist (%s), starting over", work_dir, previous)
+        for filename in os.listdir(work_dir):
+            if filename.startswith("segment_"):
+                os.remove(os.path.join(work_dir, filename))
+    with open(signature_file, 'w', encoding='utf-8') as f:
+        json.dump(signature, f)
+
+
+def clip_name(Name, start, end):
+    """Episode name for a time-window download, so clips never shadow the full episode"""
+    def label(t):
+        minutes, seconds = divmod(int(t), 60)
+        return f"{minutes}m{seconds:02d}s"
+    return f"{Name} [{label(start)}-{label(end) if end is not None else 'end'}]"
+
+
+def _segment_index(segment_file):
+    return int(os.path.basename(segment_file)[len("segment_"):-len(".ts")])
+
+
+def _coverage(playlist, wanted, segment_files):
+    """Share of the wanted playlist duration the downloaded segments cover"""
+    durations = playlist["durations"]
+    total = sum(durations[index] for index in wanted)
+    covered = sum(durations[_segment_index(path)] for path in segment_files)
+    return covered / total if total else 0.0
+
+
+def _expected_duration(playlist, wanted, trim):
+    """Length the finished file should have according to the playlist"""
+    expected = sum(playlist["durations"][index] for index in wanted)
+    if trim:
+        expected -= trim[0]
+        if trim[1] is not None:
+            expected = min(expected, trim[1])
+    return expected
+
+
+def _tail_segments(playlist, wanted, shortfall):
+    """The last segments of wanted that together last at least shortfall seconds"""
+    tail, covered = [], 0.0
+    for index in reversed(wanted):
+        if covered >= shortfall:
+            break
+        tail.append(index)
+        covered += playlist["durations"][index]
+    return sorted(tail)
+
+
+def _damaged_segments(playlist, segment_files):
+    """
+    Segments that are cut short or unreadable: byte-range segments must have their exact length,
+    every other one has to probe to (about) its #EXTINF duration.
+    """
+    damaged = []
+    for segment_file in segment_files:
+        index = _segment_index(segment_file)
+        byterange = playlist["byteranges"][index]
+        try:
+            if byterange and os.path.getsize(segment_file) != byterange[0]:
+                damaged.append(index)
+                continue
+            duration = probe_duration(segment_file)
+        except ffmpeg.Error:
+            damaged.append(index)
+            continue
+        except OSError:
+            damaged.append(index)
+            continue
+        if duration is not None and duration < playlist["durations"][index] - 0.5:
+            damaged.append(index)
+    return damaged
+
+
+async def _refetch(playlist, temp_dir, indices, alternates=None, parallel=parallel):
+    """Fetch some segments again, from an alternate server first when it has the same rendition and segmentation"""
+    for index in indices:
+        try:
+            os.remove(os.path.join(temp_dir, f"segment_{index:06d}.ts"))
+        except FileNotFoundError:
+            pass
+    others = [alternate for alternate in alternates or [] if _equivalent(playlist, alternate)]
+    if others:
+        logger.info("Fetching %d segments again from an alternate server", len(indices))
+        return await _download_all_segments(others[0], temp_dir, parallel, others[1:] + [playlist], indices)
+    logger.info("Fetching %d segments again", len(indices))
+    return await _download_all_segments(playlist, temp_dir, parallel, None, indices)
+
+
+def _free_space(path):
+    # The output folder may not exist yet, look at the closest parent that does
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    try:
+        return shutil.disk_usage(path).free
+    except Exception as e:
+        logger.warning("Could not read free space for %s: %s", path, e)
+        return None
+
+
+def _preflight(playlist, wanted, temp_dir, output_file):
+    """Fail early if the segments (plus their concatenation) or the episode won't fit on disk"""
+    byteranges = [playlist["byteranges"][index] for index in wanted]
+    if byteranges and all(byteranges):
+        needed = sum(length for length, _ in byteranges)
+    elif playlist.get("bandwidth"):
+        needed = int(playlist["bandwidth"] / 8 * sum(playlist["durations"][index] for index in wanted))
+    else:
+        logger.debug("No size estimate for preflight, skipping the disk check")
+        return
+
+    temp_free = _free_space(temp_dir)
+    output_free = _free_space(os.path.dirname(output_file))
+    if temp_free is not None and 2 * needed + disk_reserve > temp_free:
+        raise StageFailed(f"Not enough space for segments in {temp_dir}: need ~{2 * needed} bytes, {temp_free} free")
+    if output_free is not None and needed + disk_reserve > output_free:
+        raise StageFailed(f"Not enough space in {os.path.dirname(output_file)}: need ~{needed} bytes, {output_free} free")
+    logger.debug("Preflight ok: ~%d bytes needed, %s free in temp, %s free in output", needed, temp_free, output_free)
+
+
+def _remove_temp_dir(temp_dir):
+    try:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        logger.debug("Cleaned up temporary directory: %s", temp_dir)
+    except Exception as e:
+        logger.warning("Failed to clean up temporary directory: %s", e)
+
+
+@tracing.traced("postprocess")
+def _assemble(segment_files, temp_dir, output_file, downloaded_subtitles, segments, skipped, clip_start, trim, entry):
+    """Concatenate and mux one episode and record it in the library, runs on the post-processing pool"""
+    _print_progress_step(3, 4, "Concatenating segments")
+    logger.info("Concatenating segments...")
+    try:
+        concatenated_file = _concatenate_segments(segment_files, temp_dir)
+        if not concatenated_file or not os.path.exists(concatenated_file) or os.path.getsize(concatenated_file) == 0:
+            logger.error("Concatenation failed or produced empty file")
+            return 1
+    except Exception as e:
+        logger.error("Error concatenating segments: %s", e)
+        return 1
+
+    _print_progress_step(4, 4, "Muxing final output")
+    logger.info("Muxing final output...")
+    library = get_library()
+    library.start(output_file, **entry)
+    try:
+        chapters_file = None
+        output_time = None
+        if clip_start is not None:
+            # Subtitles are timed from the start of the episode, the clip starts at the window
+            output_time = lambda t: t - clip_start
+        elif skipped:
+            # The cut segments shift everything after them, move the cues along
+            output_time = timeline(segments, skipped)
+        if output_time:
+            # The stored tracks are shared, retimed copies go in the temp dir
+            retimed = []
+            for i, sub in enumerate(downloaded_subtitles):
+                path = os.path.join(temp_dir, f"subtitle_{i}.vtt")
+                retime_subtitle(sub['path'], output_time, path)
+                retimed.append({**sub, 'path': path})
+            downloaded_subtitles = retimed
+        if clip_start is None:
+            chapters = chapter_marks(segments, skipped)
+            chapters_file = write_ffmetadata(chapters, os.path.join(temp_dir, "chapters.txt")) if chapters else None
+        _mux_with_subtitles(concatenated_file, output_file, downloaded_subtitles, chapters_file, trim)
+        if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+            logger.error("Muxing failed or produced empty file")
+            library.mark(output_file, CORRUPT)
+            return 1
+    except Exception as e:
+        logger.error("Error muxing with subtitles: %s", e)
+        library.mark(output_file, CORRUPT)
+        return 1
+    return 0 if library.complete(output_file, **entry) == COMPLETE else 1
+
+
+def _submit_postprocess(func, *args):
+    """Queue a job on the post-processing pool, counted in the postprocess queue depth until it's done"""
+    metrics.queue_depth.inc(queue="postprocess")
+    # The pool's threads don't inherit the caller's context, its spans would start a trace of their own
+    future = _postprocess_pool.submit(tracing.wrap_context(func), *args)
+    future.add_done_callback(lambda _: metrics.queue_depth.dec(queue="postprocess"))
+    return future
+
+
+async def run_postprocess(func, *args):
+    """Run blocking post-processing (ffmpeg) on the post-processing pool without blocking the event loop"""
+    return await asyncio.wrap_future(_submit_postprocess(func, *args))
+
+
+async def _with_spinner(awaitable, message):
+    task = asyncio.ensure_future(awaitable)
+    spinner_chars = ['⣾', '⣽', '⣻', '⢿', '⡿', '⣟', '⣯', '⣷']
+    position = 0
+    while not task.done():
+        sys.stdout.write(f"\r{spinner_chars[position % len(spinner_chars)]} {message}")
+        sys.stdout.flush()
+        position += 1
+        await asyncio.sleep(0.1)
+    sys.stdout.write("\r✓ Adding completed👌!     \n" if not task.exception() and task.result() == 0 else "\r\n")
+    sys.stdout.flush()
+    return task.result()
+
+
 def _print_progress_step(step, total_steps, message):
     global progress_emitter
 
@@ -542,119 +1303,261 @@ def _print_progress_step(step, total_steps, message):
     logger.info(f"Step {step}/{total_steps}: {message}")
 
 
-async def downloading(segments, Name, Anime, subtitles=None, base_url=None):
+@tracing.traced("episode", describe=lambda segments, Name, Anime, *args, **kwargs: {"anime": Anime, "episode": Name})
+async def downloading(segments, Name, Anime, subtitles=None, base_url=None, alternates=None, window=download_window,
+                      work_dir=None, on_stage=None, download_slot=None, episode_id=None, needs=None, lookahead=None,
+                      parallel=parallel):
+    """
+    Download, concatenate and mux one episode into the library.
+
+    Args:
+        segments (dict or str): Parsed media playlist (or raw playlist text resolved against base_url)
+        Name (str): Episode name
+        Anime (str): Anime name
+        subtitles (list, optional): Subtitle tracks from streams()
+        base_url (str, optional): Base URL for raw playlist text
+        alternates (list, optional): Playlists of other servers to stripe segments over
+        window (str or tuple, optional): Only download this time window (see playlist.parse_window)
+        work_dir (str, optional): Keep segments here instead of a temp dir, segments already in it are
+                                  not downloaded again so an interrupted job picks up where it stopped
+        on_stage (callable, optional): Called with "segments" and "assemble" as the download moves on
+        download_slot (asyncio.Semaphore, optional): Held while segments are downloaded only. Episodes sharing
+                                                     a slot download one after another, while the ones already
+                                                     downloaded are concatenated and muxed in the background
+        lookahead (asyncio.Semaphore, optional): Held from the start until the download slot is released. With
+                                                 1 + N permits next to a download slot, only the next N episodes
+                                                 fetch subtitles and check disk space while one downloads
+        episode_id (str, optional): Provider episode ID, recorded in the library index
+        needs (str, optional): sub/dub/raw, recorded in the library index
+        parallel (int, optional): Concurrent segment downloads (config parallel by default)
+
+    Returns:
+        int: 0 for success, 1 for failure
+    """
     temp_dir = None
+    succeeded = False
+    slot_held = False
+    ahead_held = False
+    assembly = None
     try:
+        if lookahead is not None:
+            await lookahead.acquire()
+            ahead_held = True
         total_steps = 4
         current_step = 0
 
+        if window:
+            # Only a time window of the episode, e.g. "60" for a quick quality check
+            window_start, window_end = parse_window(window) if isinstance(window, str) else window
+            Name = clip_name(Name, window_start, window_end)
+
         logger.info("Starting download for %s in %s", Name, Anime)
 
         current_step += 1
         _print_progress_step(current_step, total_steps, "Preparing download")
 
-        chars_to_remove = set(r'\\/"?*|')
-        fixed_Name = ''.join(ch for ch in Name if ch not in chars_to_remove)
-        fixed_Anime = ''.join(ch for ch in Anime if ch not in chars_to_remove)
-
-        home_dir = os.path.expanduser("~")
-        cache = f"{home_dir}/.animecache/{fixed_Anime}"
-        os.makedirs(cache, exist_ok=True)
-        logger.debug("Cache directory created at %s", cache)
-
-        output_file = os.path.join(cache, f"{fixed_Name}.mkv")
-        if os.path.exists(output_file):
-            logger.info("File already exists: %s", output_file)
+        output_file = output_path(Name, Anime)
+        if await asyncio.to_thread(get_library().is_complete, output_file, Anime, Name):
+            logger.info("Already in the library: %s", output_file)
             return 0
 
-        temp_dir = tempfile.mkdtemp()
+        if work_dir:
+            temp_dir = work_dir
+            os.makedirs(temp_dir, exist_ok=True)
+        else:
+            temp_dir = tempfile.mkdtemp()
         logger.debug("Created temporary directory: %s", temp_dir)
 
-        if not segments or not isinstance(segments, str) or len(segments.strip()) == 0:
-            logger.error("Invalid or empty m3u8 content")
-            return 1
-
-        logger.info("Parsing m3u8 segments...")
-        try:
-            playlist = m3u8.loads(segments)
-            segments_list = playlist.segments
-        except Exception as e:
-            logger.error("Failed to parse m3u8 content: %s", e)
-            return 1
+        if isinstance(segments, str):
+            # Raw playlist text, resolve it against the given base URL once
+            if not segments.strip():
+                logger.error("Invalid or empty m3u8 content")
+                return 1
+            logger.info("Parsing m3u8 segments...")
+            segments = parse_media(segments, base_url or '')
 
-        if not segments_list:
+        if not segments or not segments.get("uris"):
             logger.error("No segments found in m3u8 playlist")
             return 1
 
-        logger.info("Found %d segments", len(segments_list))
-
-        if not base_url:
-            first_segment = segments_list[0]
-            if hasattr(first_segment, 'uri') and first_segment.uri.startswith('http'):
-                base_url = '/'.join(first_segment.uri.split('/')[:-1]) + '/'
-                logger.info("Extracted base URL from segment: %s", base_url)
-            else:
-                if hasattr(playlist, 'uri') and playlist.uri and playlist.uri.startswith('http'):
-                    base_url = '/'.join(playlist.uri.split('/')[:-1]) + '/'
-                    logger.info("Extracted base URL from playlist URI: %s", base_url)
-                else:
-                    logger.warning("Could not determine base URL from segments or playlist")
-                    return 1
-
-        current_step += 1
-        _print_progress_step(current_step, total_steps, "Downloading segments")
-        logger.info("Starting async download with %d concurrent downloads...", parallel)
-        segment_files = await _download_all_segments(base_url, segments_list, temp_dir, parallel)
-
-        if not segment_files:
-            logger.error("No segments downloaded successfully")
+        if not segments["uris"][0].startswith('http'):
+            logger.warning("Could not determine base URL from segments or playlist")
             return 1
 
-        min_segments_required = max(5, int(len(segments_list) * 0.1))
-        if len(segment_files) < min_segments_required:
-            logger.error("Too few segments downloaded (%d/%d). Need at least %d segments for a valid video.",
-                        len(segment_files), len(segments_list), min_segments_required)
-            return 1
+        segments_list = segments["uris"]
+        logger.info("Found %d segments", len(segments_list))
 
-        current_step += 1
-        _print_progress_step(current_step, total_steps, "Concatenating segments")
-        logger.info("Concatenating segments...")
-        try:
-            concatenated_file = _concatenate_segments(segment_files, temp_dir)
-            if not concatenated_file or not os.path.exists(concatenated_file) or os.path.getsize(concatenated_file) == 0:
-                logger.error("Concatenation failed or produced empty file")
+        trim = None
+        skipped = set()
+        if window:
+            wanted, first_start = covering_segments(segments, window_start, window_end)
+            if not wanted:
+                logger.error("Window %s is past the end of the episode (%.0fs)", window, segments["duration"])
                 return 1
-        except Exception as e:
-            logger.error("Error concatenating segments: %s", e)
-            return 1
+            trim = (window_start - first_start, None if window_end is None else window_end - window_start)
+            logger.info("Window %s covered by segments %d-%d", window, wanted[0], wanted[-1])
+        else:
+            skipped = skipped_segments(segments) if skip_intro_outro else set()
+            if skipped:
+                skipped_time = sum(segments["durations"][index] for index in skipped)
+                logger.info("Skipping %d intro/outro segments (%.0fs)", len(skipped), skipped_time)
+                print(f"Skipping intro/outro: {len(skipped)} segments ({skipped_time:.0f}s)")
+            wanted = [index for index in range(len(segments_list)) if index not in skipped]
+
+        # A file the library couldn't vouch for is kept if it is as long as this playlist says
+        expected = _expected_duration(segments, wanted, trim)
+        if await asyncio.to_thread(get_library().confirm, output_file, expected - verify_tolerance, episode_id, needs):
+            logger.info("Already in the library: %s", output_file)
+            succeeded = True
+            return 0
 
-        current_step += 1
-        _print_progress_step(current_step, total_steps, "Muxing final output")
-        logger.info("Muxing final output...")
+        async def preflight(results):
+            _preflight(segments, wanted, temp_dir, output_file)
+
+        async def prepare_paths(results):
+            cache = os.path.dirname(output_file)
+            os.makedirs(cache, exist_ok=True)
+            logger.debug("Cache directory created at %s", cache)
+
+        async def fetch_subtitles(results):
+            if not subtitles:
+                return []
+            downloaded_subtitles = await download_subtitles(subtitles)
+            if not downloaded_subtitles:
+                logger.warning("No subtitles downloaded, proceeding without subtitles")
+            return downloaded_subtitles
+
+        async def fetch_segments(results):
+            nonlocal slot_held, ahead_held
+            if download_slot is not None:
+                await download_slot.acquire()
+                slot_held = True
+            try:
+                _print_progress_step(2, total_steps, "Downloading segments")
+                if on_stage:
+                    on_stage("segments")
+
+                cached = {}
+                if work_dir:
+                    _check_work_dir(temp_dir, segments)
+                    for index in wanted:
+                        segment_file = os.path.join(temp_dir, f"segment_{index:06d}.ts")
+                        if os.path.exists(segment_file) and os.path.getsize(segment_file) > 0:
+                            cached[index] = segment_file
+                    if cached:
+                        logger.info("Resuming with %d/%d segments already downloaded", len(cached), len(wanted))
+                    metrics.cache_requests.inc(len(cached), cache="segments", result="hit")
+                    metrics.cache_requests.inc(len(wanted) - len(cached), cache="segments", result="miss")
+                missing = [index for index in wanted if index not in cached]
+
+                logger.info("Starting async download with %d concurrent downloads...", parallel)
+                fetched = await _download_all_segments(segments, temp_dir, parallel, alternates, missing) if missing else []
+                segment_files = sorted(list(cached.values()) + fetched)
+            finally:
+                if slot_held:
+                    # The next episode can start downloading while this one is assembled
+                    download_slot.release()
+                    slot_held = False
+                if ahead_held:
+                    lookahead.release()
+                    ahead_held = False
+
+            # Fill the holes by playlist duration, only the missing indices are fetched again
+            for repair_round in range(1, repair_rounds + 1):
+                if _coverage(segments, wanted, segment_files) >= min_coverage:
+                    break
+                have = {_segment_index(segment_file) for segment_file in segment_files}
+                gaps = [index for index in wanted if index not in have]
+                logger.warning("%d segments missing, fetching them again (round %d/%d)", len(gaps), repair_round, repair_rounds)
+                segment_files = sorted(segment_files + await _refetch(segments, temp_dir, gaps, alternates, parallel))
+
+            coverage = _coverage(segments, wanted, segment_files)
+            if coverage < min_coverage:
+                raise StageFailed(f"Only {coverage:.1%} of the episode downloaded "
+                                  f"({len(segment_files)}/{len(wanted)} segments, need {min_coverage:.0%})")
+            return segment_files
+
+        entry = {"anime": Anime, "name": Name, "episode_id": episode_id, "needs": needs,
+                 "variant": f"{segments['height']}p" if segments.get("height") else None}
+
+        async def run_assembly(segment_files, downloaded_subtitles):
+            nonlocal assembly
+            assembly = _submit_postprocess(_assemble, segment_files, temp_dir, output_file,
+                                           downloaded_subtitles, segments, skipped,
+                                           window_start if window else None, trim, entry)
+            if download_slot is None:
+                code = await _with_spinner(asyncio.wrap_future(assembly), "Processing file...")
+            else:
+                code = await asyncio.wrap_future(assembly)
+            if code != 0:
+                raise StageFailed("Concatenating or muxing failed")
+
+        async def assemble(results):
+            if on_stage:
+                on_stage("assemble")
+            await run_assembly(results["segments"], results["subtitles"])
+
+        async def verify(results):
+            # The muxed file has to be as long as the playlist says, otherwise find the
+            # damaged segments, fetch just those again and assemble from what's on disk
+            expected = _expected_duration(segments, wanted, trim)
+            segment_files = results["segments"]
+            tail_tried = False
+            unexplained = False
+            for repair_round in range(repair_rounds + 1):
+                stored = get_library().get(output_file)
+                duration = stored["duration"] if stored else None
+                if duration is None:
+                    logger.debug("No duration for %s (ffprobe missing?), not verifying", Name)
+                    return
+                if duration >= expected - verify_tolerance:
+                    logger.info("Verified %s: %.1fs of %.1fs", Name, duration, expected)
+                    return
+                logger.warning("%s is %.1fs long, its playlist %.1fs", Name, duration, expected)
+                if repair_round == repair_rounds:
+                    break
+                damaged = await run_postprocess(_damaged_segments, segments, segment_files)
+                unexplained = not damaged
+                if unexplained:
+                    if tail_tried:
+                        break
+                    # Every segment checks out, so the end went missing: fetch the segments covering it again
+                    damaged = _tail_segments(segments, wanted, expected - duration)
+                    tail_tried = True
+                    print(f"Fetching the last {len(damaged)} segment(s) again...")
+                else:
+                    print(f"Repairing {len(damaged)} damaged segment(s)...")
+                refetched = await _refetch(segments, temp_dir, damaged, alternates, parallel)
+                if len(refetched) < len(damaged):
+                    break
+                segment_files = sorted({path for path in segment_files if _segment_index(path) not in damaged} | set(refetched))
+                await run_assembly(segment_files, results["subtitles"])
+
+            if unexplained:
+                # Nothing to point at, the file is kept but not vouched for
+                get_library().mark(output_file, UNVERIFIED)
+                logger.warning("%s is %.1fs long but its playlist has %.1fs and no damaged segment was found, "
+                               "keeping it as unverified", Name, duration, expected)
+                print(f"Warning: {Name} is {expected - duration:.1f}s shorter than its playlist, kept as unverified")
+                return
+            get_library().mark(output_file, CORRUPT)
+            raise StageFailed(f"The file is {duration:.1f}s long but the playlist has {expected:.1f}s, repair failed")
+
+        # Everything but assembling is independent, subtitles and checks run alongside the segments
+        graph = StageGraph(Name)
+        graph.add("preflight", preflight)
+        graph.add("paths", prepare_paths)
+        graph.add("subtitles", fetch_subtitles)
+        graph.add("segments", fetch_segments)
+        graph.add("assemble", assemble, needs=("preflight", "paths", "subtitles", "segments"))
+        graph.add("verify", verify, needs=("assemble",))
         try:
-            downloaded_subtitles = []
-            if subtitles:
-                downloaded_subtitles = await download_subtitles(subtitles, temp_dir)
-                if not downloaded_subtitles:
-                    logger.warning("No subtitles downloaded, proceeding without subtitles")
-            _mux_with_subtitles(concatenated_file, output_file, downloaded_subtitles)
-            if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
-                logger.error("Muxing failed or produced empty file")
-                return 1
-        except Exception as e:
-            logger.error("Error muxing with subtitles: %s", e)
+            await graph.run()
+        except StageFailed as e:
+            logger.error("Download of %s failed: %s", Name, e)
             return 1
 
-        print("Adding Subtitles", end="")
-        spinner_chars = ['⣾', '⣽', '⣻', '⢿', '⡿', '⣟', '⣯', '⣷']
-        for _ in range(20):
-            for char in spinner_chars:
-                sys.stdout.write(f"\r{char} Processing file...")
-                sys.stdout.flush()
-                await asyncio.sleep(0.1)
-        sys.stdout.write("\r✓ Adding completed👌!     \n")
-        sys.stdout.flush()
-
+        succeeded = True
         return 0
 
     except Exception as e:
@@ -662,9 +1565,14 @@ async def downloading(segments, Name, Anime, subtitles=None, base_url=None):
         return 1
 
     finally:
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir, ignore_errors=True)
-                logger.debug("Cleaned up temporary directory: %s", temp_dir)
-            except Exception as e:
-                logger.warning("Failed to clean up temporary directory: %s", e)
+        if slot_held:
+            download_slot.release()
+        if ahead_held:
+            lookahead.release()
+        # A work dir is kept on failure so the next attempt can reuse its segments
+        if temp_dir and os.path.exists(temp_dir) and (succeeded or not work_dir):
+            if assembly is not None and not assembly.done():
+                # Cancelled while ffmpeg still works in the temp dir, clean up once it's finished
+                assembly.add_done_callback(lambda _: _remove_temp_dir(temp_dir))
+            else:
+                _remove_temp_dir(temp_dir)
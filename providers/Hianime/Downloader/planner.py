@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# planner.py - Pre-flight size, duration and disk-space estimates for batch downloads
+
+import asyncio
+import aiohttp
+import os
+import shutil
+import tempfile
+from config.hianime import logger, timeout, parallel, server_type, plan_policy, plan_samples, disk_reserve, assumed_speed
+from providers.Hianime.Downloader.downloader import get_headers, output_path, recent_throughput
+from utils.library import get_library
+
+
+def _sample_indices(count, samples):
+    if count <= samples:
+        return list(range(count))
+    step = count / samples
+    return sorted({int(step * i + step / 2) for i in range(samples)})
+
+
+def _free_bytes(path):
+    # Walk up until we find something that exists, the cache dir may not be created yet
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    try:
+        return shutil.disk_usage(path).free
+    except Exception as e:
+        logger.warning("Could not read free space for %s: %s", path, e)
+        return None
+
+
+async def _head_size(session, url, headers):
+    try:
+        async with session.head(url, headers=headers, allow_redirects=True) as response:
+            if response.status != 200:
+                logger.debug("HEAD %s returned status %d", url, response.status)
+                return None
+            content_length = response.headers.get('Content-Length')
+            return int(content_length) if content_length else None
+    except Exception as e:
+        logger.debug("HEAD %s failed: %s", url, e)
+        return None
+
+
+async def estimate_episode(session, job, samples=plan_samples):
+    """
+    Estimate size, duration and ETA for one resolved episode.
+
+    Args:
+        session (aiohttp.ClientSession): Session used for the sampled HEAD requests
+        job (dict): Resolved episode with 'segments' (parsed media playlist), 'name' and 'anime'
+        samples (int): Number of segments to HEAD-sample
+
+    Returns:
+        dict: duration (s), bytes, eta (s), segments, source of the estimate and whether it's already in the library
+    """
+    estimate = {"segments": 0, "duration": 0.0, "bytes": None, "eta": None, "source": None, "exists": False}
+
+    if await asyncio.to_thread(get_library().is_complete, output_path(job['name'], job['anime']), job['anime'], job['name']):
+        estimate.update(bytes=0, eta=0, source="in library", exists=True)
+        return estimate
+
+    playlist = job['segments']
+    durations = playlist["durations"]
+    estimate["segments"] = len(durations)
+    estimate["duration"] = playlist["duration"]
+
+    indices = _sample_indices(len(durations), samples)
+    byteranges = playlist["byteranges"]
+    if all(byteranges[i] for i in indices):
+        # Byte-range playlists already tell us the segment sizes
+        sizes = [byteranges[i][0] for i in indices]
+    else:
+        headers = playlist.get("headers") or get_headers(server_type)
+        sizes = await asyncio.gather(*[_head_size(session, playlist["uris"][i], headers) for i in indices])
+
+    sampled = [(size, durations[i]) for size, i in zip(sizes, indices) if size and durations[i] > 0]
+    bandwidth = playlist.get('bandwidth')
+
+    if sampled:
+        bytes_per_second = sum(size for size, _ in sampled) / sum(duration for _, duration in sampled)
+        estimate["bytes"] = int(bytes_per_second * estimate["duration"])
+        estimate["source"] = f"{len(sampled)} sampled segments"
+    elif bandwidth:
+        estimate["bytes"] = int(bandwidth / 8 * estimate["duration"])
+        estimate["source"] = "playlist BANDWIDTH"
+    else:
+        logger.warning("No size information available for %s", job['name'])
+
+    if estimate["bytes"] is not None:
+        estimate["eta"] = estimate["bytes"] / (recent_throughput() or assumed_speed)
+
+    logger.info("Estimated %s: %d segments, %.0fs, %s bytes (%s)", job['name'], estimate["segments"],
+                estimate["duration"], estimate["bytes"], estimate["source"])
+    return estimate
+
+
+async def plan_batch(jobs, policy=plan_policy, parallel=parallel):
+    """
+    Estimate every job of a batch and drop what won't fit on the target volume.
+
+    Segments and the concatenated stream are kept in the temp directory until the
+    episode is muxed, so the temp volume must hold about twice the largest episode
+    while the cache volume must hold every finished episode.
+
+    Args:
+        jobs (list): Resolved episodes (see estimate_episode)
+        policy (str): "trim" drops the episodes from the first one that doesn't fit on, so the kept ones have
+                      no gaps; "refuse" keeps nothing if any of them doesn't fit
+        parallel (int): Concurrent requests while estimating
+
+    Returns:
+        dict: kept and dropped jobs (each with an 'estimate' key), totals and free space
+    """
+    connector = aiohttp.TCPConnector(limit=parallel)
+    timeout_config = aiohttp.ClientTimeout(total=timeout)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout_config) as session:
+        estimates = await asyncio.gather(*[estimate_episode(session, job) for job in jobs])
+
+    for job, estimate in zip(jobs, estimates):
+        job['estimate'] = estimate
+
+    target_dir = os.path.dirname(output_path("", jobs[0]['anime'])) if jobs else None
+    target_free = _free_bytes(target_dir) if target_dir else None
+    temp_free = _free_bytes(tempfile.gettempdir())
+    same_volume = target_dir is not None and _same_volume(target_dir, tempfile.gettempdir())
+
+    kept = []
+    dropped = []
+    used = 0
+    largest = 0
+    for job in jobs:
+        size = job['estimate']['bytes'] or 0
+        needed_target = used + size
+        needed_temp = 2 * max(largest, size)
+        if same_volume:
+            needed_target += needed_temp
+            fits = target_free is None or needed_target + disk_reserve <= target_free
+        else:
+            fits = ((target_free is None or needed_target + disk_reserve <= target_free) and
+                    (temp_free is None or needed_temp + disk_reserve <= temp_free))
+        # Once an episode doesn't fit every later one is dropped too, a smaller one must not skip ahead of it
+        if fits and not dropped:
+            kept.append(job)
+            used += size
+            largest = max(largest, size)
+        else:
+            dropped.append(job)
+
+    if dropped and policy == "refuse":
+        logger.error("Batch needs more space than available, refusing all %d episodes", len(jobs))
+        dropped = list(jobs)
+        kept = []
+    elif dropped:
+        logger.warning("Trimmed %d episodes that would not fit on disk", len(dropped))
+
+    plan = {
+        "kept": kept,
+        "dropped": dropped,
+        "bytes": sum(job['estimate']['bytes'] or 0 for job in kept),
+        "duration": sum(job['estimate']['duration'] for job in kept),
+        "eta": sum(job['estimate']['eta'] or 0 for job in kept),
+        "target_free": target_free,
+        "temp_free": temp_free,
+    }
+    logger.info("Plan: %d kept, %d dropped, %d bytes, eta %.0fs, free %s", len(kept), len(dropped),
+                plan["bytes"], plan["eta"], target_free)
+    return plan
+
+
+def _same_volume(path_a, path_b):
+    def device(path):
+        while path and not os.path.exists(path):
+            path = os.path.dirname(path)
+        return os.stat(path).st_dev
+    try:
+        return device(path_a) == device(path_b)
+    except Exception:
+        return False
+
+
+def format_bytes(size):
+    if size is None:
+        return "?"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
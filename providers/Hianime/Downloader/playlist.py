@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# playlist.py - Single-pass HLS playlist parser producing the playlist dict used by the download pipeline
+
+import re
+import bisect
+from urllib.parse import urljoin
+
+_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def _attributes(line):
+    attributes = {}
+    for key, value in _ATTRIBUTE.findall(line[line.index(':') + 1:]):
+        attributes[key] = value[1:-1] if value.startswith('"') else value
+    return attributes
+
+
+def parse_master(text, url):
+    """
+    Parse a master playlist into its variants.
+
+    Args:
+        text (str): Playlist content
+        url (str): URL the playlist was fetched from, variant URIs are resolved against it
+
+    Returns:
+        list: One dict per variant with resolved 'uri', 'bandwidth', 'resolution', 'height' and 'codecs'
+    """
+    variants = []
+    pending = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXT-X-STREAM-INF'):
+            attributes = _attributes(line)
+            resolution = attributes.get('RESOLUTION')
+            width, height = (int(n) for n in resolution.split('x')) if resolution and 'x' in resolution else (0, 0)
+            pending = {
+                "bandwidth": int(attributes.get('BANDWIDTH', 0) or 0),
+                "resolution": (width, height) if height else None,
+                "height": height,
+                "codecs": attributes.get('CODECS'),
+            }
+        elif not line.startswith('#') and pending is not None:
+            pending["uri"] = urljoin(url, line)
+            variants.append(pending)
+            pending = None
+    return variants
+
+
+def parse_media(text, url):
+    """
+    Parse a media playlist once, resolving every segment URI up front.
+
+    Segment data is kept in parallel lists indexed by segment number so the
+    downloader never touches the playlist text again.
+
+    Args:
+        text (str): Playlist content
+        url (str): URL the playlist was fetched from, segment URIs are resolved against it
+
+    Returns:
+        dict: uri, media_sequence, target_duration, duration (s) and per-segment
+              'uris', 'durations', 'byteranges' ((length, offset) or None) and 'keys' (dict or None)
+    """
+    uris = []
+    durations = []
+    byteranges = []
+    keys = []
+
+    media_sequence = 0
+    target_duration = None
+    duration = None
+    byterange = None
+    key = None
+    next_offset = {}
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] != '#':
+            segment_uri = urljoin(url, line)
+            if byterange is not None:
+                length, offset = byterange
+                if offset is None:
+                    offset = next_offset.get(segment_uri, 0)
+                next_offset[segment_uri] = offset + length
+                byterange = (length, offset)
+            uris.append(segment_uri)
+            durations.append(duration or 0.0)
+            byteranges.append(byterange)
+            keys.append(key)
+            duration = None
+            byterange = None
+        elif line.startswith('#EXTINF:'):
+            duration = float(line[8:].split(',', 1)[0] or 0)
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            length, _, offset = line[17:].partition('@')
+            byterange = (int(length), int(offset) if offset else None)
+        elif line.startswith('#EXT-X-KEY:'):
+            attributes = _attributes(line)
+            if attributes.get('METHOD', 'NONE') == 'NONE':
+                key = None
+            else:
+                key = {
+                    "method": attributes['METHOD'],
+                    "uri": urljoin(url, attributes['URI']) if 'URI' in attributes else None,
+                    "iv": attributes.get('IV'),
+                }
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            media_sequence = int(line[22:])
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(line[22:])
+
+    return {
+        "uri": url,
+        "media_sequence": media_sequence,
+        "target_duration": target_duration,
+        "duration": sum(durations),
+        "uris": uris,
+        "durations": durations,
+        "byteranges": byteranges,
+        "keys": keys,
+    }
+
+
+def parse_window(text):
+    """
+    Parse a time window such as "60" (the first minute), "90-120" or "1:30-2:00".
+
+    Returns:
+        tuple: (start, end) in seconds, end is None for an open window ("20:00-")
+    """
+    def seconds(value):
+        total = 0.0
+        for part in value.strip().split(':'):
+            total = total * 60 + float(part)
+        return total
+
+    start, dash, end = str(text).strip().partition('-')
+    if not dash:
+        return 0.0, seconds(start)
+    start = seconds(start) if start.strip() else 0.0
+    end = seconds(end) if end.strip() else None
+    if end is not None and end <= start:
+        raise ValueError(f"Empty time window: {text}")
+    return start, end
+
+
+def covering_segments(playlist, start, end=None):
+    """
+    Segments needed to cover a time window, from the cumulative #EXTINF durations.
+
+    Args:
+        playlist (dict): Parsed media playlist
+        start (float): Window start in seconds
+        end (float, optional): Window end in seconds, None for the end of the episode
+
+    Returns:
+        tuple: (list of segment indices, start time of the first of them), ([], None) past the end
+    """
+    offsets = [0.0]
+    for duration in playlist["durations"]:
+        offsets.append(offsets[-1] + duration)
+    if start >= offsets[-1]:
+        return [], None
+    end = offsets[-1] if end is None else min(end, offsets[-1])
+
+    first = max(bisect.bisect_right(offsets, start) - 1, 0)
+    last = max(bisect.bisect_left(offsets, end) - 1, first)
+    return list(range(first, last + 1)), offsets[first]
+
+
+def is_master(text):
+    return '#EXT-X-STREAM-INF' in text
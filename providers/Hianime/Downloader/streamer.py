@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# streamer.py - Local HLS proxy that feeds an episode to the configured player while prefetching segments
+
+import asyncio
+import aiohttp
+import os
+import shutil
+from aiohttp import web
+from utils.library import get_library
+from config.hianime import logger, parallel, timeout, server_type, player, stream_prefetch, stream_persist, stream_port
+from providers.Hianime.Downloader.downloader import (_download_segment, _concatenate_segments, _mux_with_subtitles,
+                                                     _check_work_dir, download_subtitles, get_headers, output_path, segment_cache_path,
+                                                     run_postprocess)
+
+PLAYERS = {
+    "vlc": (["vlc", "--play-and-exit"], "--sub-file={}"),
+    "mpv": (["mpv"], "--sub-file={}"),
+    "iina": (["iina", "--no-stdin"], "--mpv-sub-file={}"),
+}
+
+
+def _segment_file(seg_dir, index):
+    return os.path.join(seg_dir, f"segment_{index:06d}.ts")
+
+
+def _local_playlist(playlist):
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{int(playlist['target_duration'] or max(playlist['durations'], default=10)) + 1}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for index, duration in enumerate(playlist["durations"]):
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(f"seg/{index}.ts")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+class _StreamState:
+    """Segment fetches for one streamed episode, shared by the HTTP handlers and the prefetcher"""
+
+    def __init__(self, playlist, seg_dir, session):
+        self.playlist = playlist
+        self.seg_dir = seg_dir
+        self.session = session
+        self.semaphore = asyncio.Semaphore(parallel)
+        self.fetches = {}
+        self.playhead = 0
+
+    def cached(self, index):
+        path = _segment_file(self.seg_dir, index)
+        return os.path.exists(path) and os.path.getsize(path) > 0
+
+    def fetch(self, index):
+        """Start (or join) the download of one segment"""
+        if index not in self.fetches:
+            if self.cached(index):
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(_segment_file(self.seg_dir, index))
+                self.fetches[index] = future
+            else:
+                self.fetches[index] = asyncio.ensure_future(self._fetch(index))
+        return self.fetches[index]
+
+    async def _fetch(self, index):
+        segment_file, _ = await _download_segment(
+            self.session, self.semaphore, self.playlist["uris"][index], index, self.seg_dir,
+            byterange=self.playlist["byteranges"][index])
+        return segment_file
+
+    def prefetch(self, index):
+        for ahead in range(index, min(index + stream_prefetch + 1, len(self.playlist["uris"]))):
+            self.fetch(ahead)
+
+    async def fill(self):
+        """Fetch the whole episode a little behind the prefetch window so it can be saved afterwards"""
+        for index in range(len(self.playlist["uris"])):
+            # Stay out of the way of what the player needs right now
+            while index > self.playhead + stream_prefetch * 4:
+                await asyncio.sleep(1)
+            await self.fetch(index)
+
+
+async def _serve(state):
+    async def playlist_handler(request):
+        return web.Response(text=_local_playlist(state.playlist), content_type="application/vnd.apple.mpegurl")
+
+    async def segment_handler(request):
+        index = int(request.match_info["index"])
+        if not 0 <= index < len(state.playlist["uris"]):
+            raise web.HTTPNotFound()
+        state.playhead = index
+        state.prefetch(index)
+        segment_file = await state.fetch(index)
+        if not segment_file:
+            raise web.HTTPBadGateway()
+        return web.FileResponse(segment_file, headers={"Content-Type": "video/mp2t"})
+
+    app = web.Application()
+    app.router.add_get("/playlist.m3u8", playlist_handler)
+    app.router.add_get("/seg/{index:\\d+}.ts", segment_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", stream_port)
+    await site.start()
+    # stream_port 0 picks a free port, the one actually bound is in the runner's addresses
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/playlist.m3u8"
+
+
+async def streaming(playlist, Name, Anime, subtitles=None, persist=stream_persist):
+    """
+    Play an episode through a local HLS proxy.
+
+    The player gets a rewritten playlist pointing at a local server. Segments are
+    served from the segment cache when present, otherwise fetched on demand while
+    the next stream_prefetch segments are fetched ahead of the playhead. With
+    persist the rest of the episode keeps downloading in the background and is
+    muxed into the library once the player exits.
+
+    Args:
+        playlist (dict): Parsed media playlist from m3u8_parsing
+        Name (str): Episode name
+        Anime (str): Anime name
+        subtitles (list, optional): Subtitle tracks from streams()
+        persist (bool): Save the episode to the library after playback
+
+    Returns:
+        int: 0 for success, 1 for failure
+    """
+    if not playlist or not playlist.get("uris"):
+        logger.error("Nothing to stream for %s", Name)
+        return 1
+
+    command, sub_flag = PLAYERS.get(player, ([player], None))
+    if not shutil.which(command[0]):
+        logger.error("Player %s not found in PATH", command[0])
+        print(f"Player '{command[0]}' not found, install it or change `player` in config/hianime.py")
+        return 1
+
+    seg_dir = segment_cache_path(Name, Anime)
+    os.makedirs(seg_dir, exist_ok=True)
+    # The cache is shared with downloads of the episode, segments of another rendition or host must not be served
+    _check_work_dir(seg_dir, playlist)
+
+    timeout_config = aiohttp.ClientTimeout(total=timeout * 2)
+    connector = aiohttp.TCPConnector(limit=parallel * 2)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout_config,
+                                     headers=playlist.get("headers") or get_headers(server_type)) as session:
+        state = _StreamState(playlist, seg_dir, session)
+        state.prefetch(0)
+        filler = asyncio.ensure_future(state.fill()) if persist else None
+
+        downloaded_subs = []
+        if subtitles:
+            downloaded_subs = await download_subtitles(subtitles)
+
+        runner, url = await _serve(state)
+        logger.info("Streaming %s at %s", Name, url)
+        print(f"Streaming {Name} with {command[0]} ({url})")
+
+        args = list(command)
+        if sub_flag:
+            args += [sub_flag.format(sub['path']) for sub in downloaded_subs[:1]]
+        args.append(url)
+
+        try:
+            process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL,
+                                                           stderr=asyncio.subprocess.DEVNULL)
+            await process.wait()
+            logger.info("Player exited with code %s", process.returncode)
+
+            if not persist:
+                return 0
+
+            print("Player closed, finishing the download in the background...")
+            state.playhead = len(playlist["uris"])
+            await filler
+        finally:
+            if filler and not filler.done():
+                filler.cancel()
+            for fetch in state.fetches.values():
+                if not fetch.done():
+                    fetch.cancel()
+            await runner.cleanup()
+
+    segment_files = [_segment_file(seg_dir, index) for index in range(len(playlist["uris"])) if state.cached(index)]
+    output_file = output_path(Name, Anime)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    try:
+        concatenated_file = await run_postprocess(_concatenate_segments, segment_files, seg_dir)
+        await run_postprocess(_mux_with_subtitles, concatenated_file, output_file, downloaded_subs)
+        await run_postprocess(get_library().complete, output_file, Anime, Name)
+    except Exception as e:
+        logger.error("Could not save streamed episode %s: %s", Name, e)
+        return 1
+
+    shutil.rmtree(seg_dir, ignore_errors=True)
+    logger.info("Saved streamed episode to %s", output_file)
+    return 0
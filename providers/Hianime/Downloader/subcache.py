@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# subcache.py - Content-addressed subtitle store shared by every download of an episode (sub/dub, other qualities, retries).
+
+import sys
+import os
+import json
+import time
+import hashlib
+import threading
+import uuid
+import aiofiles
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.insert(0, project_root)
+
+from config.hianime import logger, subtitle_cache_dir, subtitle_cache_size, subtitle_revalidate
+from utils import metrics
+
+_index_file = os.path.join(subtitle_cache_dir, "index.json")
+_lock = threading.Lock()
+
+
+def _blob_path(digest):
+    return os.path.join(subtitle_cache_dir, digest[:2], f"{digest}.vtt")
+
+
+def _load_index():
+    try:
+        with open(_index_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning("Could not read subtitle cache index: %s", e)
+        return {}
+
+
+def _save_index(index):
+    os.makedirs(subtitle_cache_dir, exist_ok=True)
+    tmp_file = f"{_index_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_file, _index_file)
+
+
+def _update(url, **fields):
+    with _lock:
+        index = _load_index()
+        entry = index.setdefault(url, {})
+        entry.update(fields)
+        entry["used"] = time.time()
+        _save_index(index)
+
+
+def lookup(url):
+    """Stored entry of a track URL (hash, validators, last check) if its file is still there"""
+    with _lock:
+        entry = _load_index().get(url)
+    if entry and os.path.exists(_blob_path(entry["hash"])):
+        return entry
+    return None
+
+
+async def fetch(session, url, headers=None):
+    """
+    Path of a subtitle track in the store, downloading it only when it's new or has changed.
+
+    An entry checked within subtitle_revalidate seconds is used as is, an older one is
+    revalidated with a conditional request (ETag / Last-Modified). Tracks are stored by
+    the hash of their content, so the same file behind several URLs is kept once.
+
+    Args:
+        session (aiohttp.ClientSession): Session to download with
+        url (str): Track URL
+        headers (dict, optional): Request headers
+
+    Returns:
+        str: Path of the stored track (raises if it couldn't be downloaded and no copy is stored)
+    """
+    entry = lookup(url)
+    if entry and time.time() - entry.get("checked", 0) < subtitle_revalidate:
+        _update(url)
+        logger.debug("Subtitle cache hit: %s", url)
+        metrics.cache_requests.inc(cache="subtitles", result="hit")
+        return _blob_path(entry["hash"])
+
+    request_headers = dict(headers or {})
+    if entry:
+        if entry.get("etag"):
+            request_headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            request_headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        async with session.get(url, headers=request_headers) as response:
+            if response.status == 304 and entry:
+                _update(url, checked=time.time())
+                logger.debug("Subtitle unchanged: %s", url)
+                metrics.cache_requests.inc(cache="subtitles", result="revalidated")
+                return _blob_path(entry["hash"])
+            response.raise_for_status()
+            content = await response.read()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    except Exception as e:
+        if entry:
+            # A stale copy beats no subtitles
+            logger.warning("Revalidating subtitle failed, using the stored copy: %s", e)
+            metrics.cache_requests.inc(cache="subtitles", result="stale")
+            return _blob_path(entry["hash"])
+        raise
+
+    digest = hashlib.sha256(content).hexdigest()
+    path = _blob_path(digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = f"{path}.{uuid.uuid4().hex}.tmp"
+        async with aiofiles.open(tmp_file, 'wb') as f:
+            await f.write(content)
+        os.replace(tmp_file, path)
+    _update(url, hash=digest, size=len(content), etag=etag, last_modified=last_modified, checked=time.time())
+    metrics.cache_requests.inc(cache="subtitles", result="miss")
+    return path
+
+
+def evict(limit=None):
+    """
+    Drop the least recently used tracks until the store fits in `limit` bytes
+    (subtitle_cache_size by default).
+
+    Returns:
+        int: Number of files removed
+    """
+    limit = subtitle_cache_size if limit is None else limit
+    with _lock:
+        index = _load_index()
+        # A file can be shared by several URLs, it was last used when any of them was
+        blobs = {}
+        for url, entry in index.items():
+            blob = blobs.setdefault(entry["hash"], {"size": entry.get("size", 0), "used": 0, "urls": []})
+            blob["used"] = max(blob["used"], entry.get("used", 0))
+            blob["urls"].append(url)
+
+        total = sum(blob["size"] for blob in blobs.values())
+        removed = 0
+        for digest, blob in sorted(blobs.items(), key=lambda item: item[1]["used"]):
+            if total <= limit:
+                break
+            try:
+                os.remove(_blob_path(digest))
+            except FileNotFoundError:
+                pass
+            for url in blob["urls"]:
+                index.pop(url, None)
+            total -= blob["size"]
+            removed += 1
+
+        # Files no URL points at anymore (the track changed since it was stored), recent
+        # ones may belong to a download that hasn't updated the index yet
+        for folder, _, files in os.walk(subtitle_cache_dir):
+            for name in files:
+                path = os.path.join(folder, name)
+                if name.endswith(".vtt") and name[:-4] not in blobs and time.time() - os.path.getmtime(path) > 3600:
+                    os.remove(path)
+
+        if removed:
+            _save_index(index)
+            logger.info("Evicted %d subtitle files from the cache", removed)
+    return removed
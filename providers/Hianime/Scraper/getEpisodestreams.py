@@ -13,23 +13,25 @@ import re
 project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 sys.path.insert(0, project_root)
 
-from config.logging_config import get_logger, log_function_call, log_performance
-from config.hianime import configure, proxy_headers, server_type
+from config.logging_config import get_logger, log_function_call
+from config.hianime import configure, server_type
+from providers.Hianime.Scraper.mirrors import mirror_get, site_headers
+from utils import metrics
 
 # Setup logging for this module
 logger = get_logger("scraper.getEpisodestreams")
 
 
 @log_function_call(logger)
-@log_performance(logger)
+@metrics.timed("serverextractor")
 def serverextractor(episode):
     logger.info("Extracting servers for episode: %s", episode.get('Episode ID', 'Unknown'))
     class_lists = [['ps_-block-sub', 'servers-sub'], ['ps_-block-sub', 'servers-dub'],['ps_-block-sub', 'servers-raw']]
-    url = f"{configure['baseurl']}/ajax/v2/episode/servers?episodeId={episode['Episode ID']}"
-    proxy_headers["Referer"] = f"{configure['baseurl']}{episode['URL']}"
-    logger.info("Fetching servers from URL: %s", url)
+    path = f"/ajax/v2/episode/servers?episodeId={episode['Episode ID']}"
+    headers = site_headers(f"{configure['baseurl']}{episode['URL']}")
+    logger.info("Fetching servers from URL: %s%s", configure['baseurl'], path)
     try:
-        http = requests.get(url, headers=proxy_headers)
+        http = mirror_get(path, headers=headers)
         http.raise_for_status()
         data = http.json()
         logger.debug("Server response status: %d", http.status_code)
@@ -74,7 +76,7 @@ def serverextractor(episode):
 
 
 @log_function_call(logger)
-@log_performance(logger)
+@metrics.timed("streams")
 def streams(server, id_str):
     hd_1 = 'megaplay.buzz'
     hd_2 = 'vidwish.live'
@@ -82,8 +84,8 @@ def streams(server, id_str):
     try:
         logger.info("Starting streams extraction for episode %s on server %s", id_str.get("Episode ID"), server.get("label"))
 
-        proxy_headers["Referer"] = f"{configure['baseurl']}/watch/{id_str['URL']}"
-        sources_resp = requests.get(f"{configure['baseurl']}/ajax/v2/episode/sources?id={server['data_id']}", headers=proxy_headers)
+        headers = site_headers(f"{configure['baseurl']}/watch/{id_str['URL']}")
+        sources_resp = mirror_get(f"/ajax/v2/episode/sources?id={server['data_id']}", headers=headers)
         sources_resp.raise_for_status()
         sources_data = sources_resp.json()
         logger.debug("Sources response status: %d", sources_resp.status_code)
@@ -110,12 +112,12 @@ def streams(server, id_str):
         raw_source_data = {}
         
         fallback = hd_1 if server['label'].lower() == server_type else hd_2
-        proxy_headers["Referer"] = f"https://{fallback}/"
+        headers = {**headers, 'referer': f"https://{fallback}/"}
         if server['data_type'] == 'raw':
             root = f"https://{fallback}/stream/s-2/{id_str['Episode ID']}/sub"
         else:
             root = f"https://{fallback}/stream/s-2/{id_str['Episode ID']}/{server['data_type']}"
-        html = requests.get(root, headers=proxy_headers).text
+        html = requests.get(root, headers=headers).text
         data_id_match = re.search(r'data-id=["\'](\d+)["\']', html)
         real_id = data_id_match.group(1) if data_id_match else None
         if not real_id:
@@ -136,7 +138,8 @@ def streams(server, id_str):
         logger.info("Extraction successful")
         return {
         "id": id_str,
-        "server": server_type.upper(),
+        "server": (server.get("label") or server_type).upper(),
+        "host": fallback,
         "type": server["data_type"],
         "link": {
             "file": decrypted_sources[0]["file"] if decrypted_sources and decrypted_sources[0].get("file") else "",
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mirrors.py - Health checks, ranking and transparent failover across the HiAnime mirror domains.
+
+import sys
+import os
+import json
+import time
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.insert(0, project_root)
+
+from config.logging_config import get_logger
+from config.hianime import configure, proxy_headers, mirrors, mirror_ttl, state_dir, timeout
+
+# Setup logging for this module
+logger = get_logger("scraper.mirrors")
+
+_ranking_file = os.path.join(state_dir, "mirrors.json")
+_lock = threading.Lock()
+_ranking = None     # {"time": probed at, "mirrors": {url: {"latency", "success", "ok"}}}
+
+# Statuses that mean "this mirror is not serving us", anything else is the site's own answer
+_BAD_STATUS = {403, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524}
+
+
+def _probe(url):
+    start = time.perf_counter()
+    try:
+        response = requests.get(url, headers=configure['headers'], timeout=timeout)
+        latency = time.perf_counter() - start
+        ok = response.status_code not in _BAD_STATUS
+        logger.debug("Mirror %s answered %d in %.3fs", url, response.status_code, latency)
+        return url, ok, latency
+    except Exception as e:
+        logger.debug("Mirror %s failed: %s", url, e)
+        return url, False, None
+
+
+def _load_ranking():
+    try:
+        with open(_ranking_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Could not read mirror ranking: %s", e)
+        return None
+
+
+def _save_ranking(ranking):
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        tmp_file = _ranking_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(ranking, f, indent=2)
+        os.replace(tmp_file, _ranking_file)
+    except Exception as e:
+        logger.warning("Could not save mirror ranking: %s", e)
+
+
+def _fresh(ranking):
+    return bool(ranking) and time.time() - ranking.get("time", 0) < mirror_ttl
+
+
+def _ordered(ranking):
+    def key(url):
+        entry = ranking["mirrors"].get(url, {})
+        latency = entry.get("latency")
+        return (not entry.get("ok", False), -entry.get("success", 0.5), latency if latency is not None else float('inf'))
+    return sorted(mirrors, key=key)
+
+
+def rank_mirrors(force=False):
+    """
+    Probe every configured mirror concurrently and rank them.
+
+    The ranking is cached in memory and in state_dir/mirrors.json for mirror_ttl
+    seconds. Success rates carry over between probes so a flaky mirror stays
+    behind a steady one even when it happens to answer.
+
+    Args:
+        force (bool): Probe again even if the cached ranking is still fresh
+
+    Returns:
+        list: Mirror URLs, best first
+    """
+    global _ranking
+    with _lock:
+        ranking = _ranking if _fresh(_ranking) else (_load_ranking() or _ranking)
+        if not force and _fresh(ranking):
+            _ranking = ranking
+            return _ordered(ranking)
+
+        logger.info("Probing %d mirrors", len(mirrors))
+        with ThreadPoolExecutor(max_workers=len(mirrors)) as pool:
+            results = list(pool.map(_probe, mirrors))
+
+        previous = (ranking or {}).get("mirrors", {})
+        entries = {}
+        for url, ok, latency in results:
+            success = previous.get(url, {}).get("success", 0.5)
+            entries[url] = {
+                "ok": ok,
+                "latency": latency,
+                "success": 0.7 * success + 0.3 * (1.0 if ok else 0.0),
+            }
+        _ranking = {"time": time.time(), "mirrors": entries}
+        _save_ranking(_ranking)
+
+    ordered = _ordered(_ranking)
+    logger.info("Mirror ranking: %s", ", ".join(ordered))
+    return ordered
+
+
+def use_mirror(url):
+    """Point the scrapers at another mirror"""
+    if configure['baseurl'] == url:
+        return
+    logger.warning("Switching mirror from %s to %s", configure['baseurl'], url)
+    configure['baseurl'] = url
+
+
+def site_headers(referer=None):
+    """
+    Request headers for the current mirror, a new dict on every call: scrapers run in
+    several threads at once (server racing) and must not see each other's Referer.
+    """
+    base = configure['baseurl']
+    return {**proxy_headers, 'origin': base, 'referer': referer or f'{base}/'}
+
+
+def _demote(url):
+    with _lock:
+        if _ranking and url in _ranking["mirrors"]:
+            entry = _ranking["mirrors"][url]
+            entry["ok"] = False
+            entry["success"] = 0.7 * entry["success"]
+            _save_ranking(_ranking)
+
+
+def _rebase_headers(headers, old_base, new_base):
+    if not headers or old_base == new_base:
+        return headers
+    return {key: value.replace(old_base, new_base, 1) if isinstance(value, str) and value.startswith(old_base) else value
+            for key, value in headers.items()}
+
+
+def mirror_get(path, **kwargs):
+    """
+    GET a path on the current mirror, failing over to the next best mirror.
+
+    On the first call of a session, and whenever the ranking is older than
+    mirror_ttl, the mirrors are ranked and the best one is selected. Header values that point at the current mirror (Referer, Origin)
+    are rewritten for the mirror actually used.
+
+    Args:
+        path (str): Path including the query string, e.g. "/ajax/v2/episode/list/123"
+        **kwargs: Passed on to requests.get
+
+    Returns:
+        requests.Response: The first response that isn't a mirror failure (the last response if all fail)
+    """
+    if not _fresh(_ranking):
+        ordered = rank_mirrors()
+        if ordered and _ranking["mirrors"].get(ordered[0], {}).get("ok"):
+            use_mirror(ordered[0])
+
+    current = configure['baseurl']
+    candidates = [current] + [url for url in _ordered(_ranking) if url != current]
+    kwargs.setdefault('timeout', timeout)
+    headers = kwargs.pop('headers', None)
+
+    last_error = None
+    last_response = None
+    for base in candidates:
+        try:
+            response = requests.get(f"{base}{path}", headers=_rebase_headers(headers, current, base), **kwargs)
+            if response.status_code not in _BAD_STATUS:
+                use_mirror(base)
+                return response
+            logger.warning("Mirror %s answered %d for %s", base, response.status_code, path)
+            last_response = response
+        except requests.exceptions.RequestException as e:
+            logger.warning("Mirror %s failed for %s: %s", base, path, e)
+            last_error = e
+        _demote(base)
+
+    if last_response is not None:
+        return last_response
+    raise last_error
@@ -3,22 +3,21 @@
 
 import sys
 import os
-import requests
 from bs4 import BeautifulSoup
 
 # Add the project root to the Python path
 project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 sys.path.insert(0, project_root)
 
-from config.logging_config import get_logger, log_function_call, log_performance
+from config.logging_config import get_logger, log_function_call
 from config.hianime import configure
+from providers.Hianime.Scraper.mirrors import mirror_get
 
 # Setup logging for this module
 logger = get_logger("scraper.searchAnimedetails")
 
 
 @log_function_call(logger)
-@log_performance(logger)
 def searchAnimeandetails(name):
     logger.info("Searching for anime: %s", name)
     list_of_anime = []
@@ -27,7 +26,7 @@ def searchAnimeandetails(name):
     
     try:
         logger.debug("Making request to: %s/search?keyword=%s", url, name)
-        html = requests.get(f'{url}/search?keyword={name}'.format(search=name), auth=('user', 'pass'))
+        html = mirror_get(f'/search?keyword={name}', auth=('user', 'pass'))
         logger.debug("Response status: %d", html.status_code)
         
         soup = BeautifulSoup(html.text, 'html.parser')
@@ -105,7 +104,6 @@ def searchAnimeandetails(name):
 
 
 @log_function_call(logger)
-@log_performance(logger)
 def getAnimeDetails(watch_link):
     logger.info("Getting anime details for watch link: %s", watch_link)
     watch_link = watch_link.replace('/watch/', '/')
@@ -113,7 +111,7 @@ def getAnimeDetails(watch_link):
     
     try:
         logger.debug("Making request to: %s%s", url, watch_link)
-        html = requests.get(f'{url}{watch_link}', auth=('user', 'pass'))
+        html = mirror_get(watch_link, auth=('user', 'pass'))
         logger.debug("Response status: %d", html.status_code)
         
         soup = BeautifulSoup(html.text, 'html.parser')
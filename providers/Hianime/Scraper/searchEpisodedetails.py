@@ -5,70 +5,101 @@
 
 import sys
 import os
-import requests
 from bs4 import BeautifulSoup
 
 # Add the project root to the Python path
 project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 sys.path.insert(0, project_root)
 
-from config.logging_config import get_logger, log_function_call, log_performance
+from config.logging_config import get_logger, log_function_call
 from config.hianime import configure
+from providers.Hianime.Scraper.mirrors import mirror_get
 
 # Setup logging for this module
 logger = get_logger("scraper.searchEpisodedetails")
 
 
-@log_function_call(logger)
-@log_performance(logger)
-def getanimepisode(watch_link):
-    logger.info("Getting episode list for watch link: %s", watch_link)
+def parse_episode_list(html):
+    """Episodes from the HTML snippet returned by the episode list API"""
+    junk = BeautifulSoup(html, 'html.parser')
+    episodes = []
+
+    episode_elements = junk.select('a.ssl-item.ep-item')
+    logger.info("Found %d episode elements", len(episode_elements))
+
+    for a_tag in episode_elements:
+        ep = {}
+        ep['No'] = a_tag.get('data-number', '').strip()
+        ep['Title'] = a_tag.get('title', '').strip()
+        ep_name_div = a_tag.select_one('div.ep-name.e-dynamic-name')
+        if ep_name_div:
+            ep['Episode Name'] = ep_name_div.get_text(strip=True).replace('\u2019', "'")  # fix encoded apostrophe
+            ep['Japanese name'] = ep_name_div.get('data-jname', '').strip()
+        else:
+            ep['Episode Name'] = ''
+            ep['Japanese Name'] = ''
+        ep['URL'] = a_tag.get('href', '').strip()
+        ep['Episode ID'] = a_tag.get('data-id', '').strip()
+
+        logger.debug("Extracted episode: %s (ID: %s)", ep['Title'], ep['Episode ID'])
+        episodes.append(ep)
+
+    return episodes
+
+
+def fetch_episode_list(watch_link, validators=None):
+    """
+    Fetch the episode list of an anime, revalidating a previous copy when possible.
+
+    Args:
+        watch_link (str): Watch link of the anime, e.g. "/watch/one-piece-100"
+        validators (dict, optional): 'etag'/'last_modified' from an earlier fetch
+
+    Returns:
+        tuple: (episodes, or None when the server says the list is unchanged (304),
+                validators to send next time)
+    """
     episodeid = watch_link.replace('/watch/', '').split("-")[-1]
     logger.debug("Extracted episode ID: %s", episodeid)
-    
+
     url = configure['baseurl']
-    episodeurlapi = f"{url}/ajax/v2/episode/list/{episodeid}"
     headers = {
         "X-Requested-With": "XMLHttpRequest",
         "Referer": f"{url}{watch_link}"
     }
-    
+    validators = validators or {}
+    if validators.get('etag'):
+        headers["If-None-Match"] = validators['etag']
+    if validators.get('last_modified'):
+        headers["If-Modified-Since"] = validators['last_modified']
+
+    logger.debug("Making request to episode API: %s/ajax/v2/episode/list/%s", url, episodeid)
+    response = mirror_get(f"/ajax/v2/episode/list/{episodeid}", headers=headers)
+    logger.debug("Response status: %d", response.status_code)
+
+    if response.status_code == 304:
+        logger.info("Episode list of %s unchanged", watch_link)
+        return None, validators
+
+    response.raise_for_status()
+    new_validators = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+    data = response.json()
+    if 'html' not in data:
+        raise ValueError(f"No HTML content in response for episode ID: {episodeid}")
+    return parse_episode_list(data['html']), new_validators
+
+
+@log_function_call(logger)
+def getanimepisode(watch_link):
+    logger.info("Getting episode list for watch link: %s", watch_link)
     try:
-        logger.debug("Making request to episode API: %s", episodeurlapi)
-        response = requests.get(episodeurlapi, headers=headers)
-        logger.debug("Response status: %d", response.status_code)
-        
-        data = response.json()
-        if 'html' not in data:
-            logger.error("No HTML content in response for episode ID: %s", episodeid)
-            return 0
-            
-        junk = BeautifulSoup(data['html'], 'html.parser')
-        episodes = []
-        
-        episode_elements = junk.select('a.ssl-item.ep-item')
-        logger.info("Found %d episode elements", len(episode_elements))
-        
-        for a_tag in episode_elements:
-            ep = {}
-            ep['No'] = a_tag.get('data-number', '').strip()
-            ep['Title'] = a_tag.get('title', '').strip()
-            ep_name_div = a_tag.select_one('div.ep-name.e-dynamic-name')
-            if ep_name_div:
-                ep['Episode Name'] = ep_name_div.get_text(strip=True).replace('\u2019', "'")  # fix encoded apostrophe
-                ep['Japanese name'] = ep_name_div.get('data-jname', '').strip()
-            else:
-                ep['Episode Name'] = ''
-                ep['Japanese Name'] = ''
-            ep['URL'] = a_tag.get('href', '').strip()
-            ep['Episode ID'] = a_tag.get('data-id', '').strip()
-            
-            logger.debug("Extracted episode: %s (ID: %s)", ep['Title'], ep['Episode ID'])
-            episodes.append(ep)
-            
+        episodes, _ = fetch_episode_list(watch_link)
         logger.info("Successfully extracted %d episodes", len(episodes))
         return episodes
-        
+
     except Exception as e:
         logger.error("Error getting episode list: %s", str(e), exc_info=True)
         return []
@@ -8,14 +8,13 @@ from bs4 import BeautifulSoup, Comment
 project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 sys.path.insert(0, project_root)
 
-from config.logging_config import get_logger, log_function_call, log_performance
+from config.logging_config import get_logger, log_function_call
 from config.hianime import configure
 
 # Setup logging for this module
 logger = get_logger("scraper.tokenextractor")
 
 @log_function_call(logger)
-@log_performance(logger)
 def extract_token(url):
     logger.info("Extracting token from URL: %s", url)
     try:
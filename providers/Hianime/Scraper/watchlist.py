@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# watchlist.py - Followed series, checked for new episodes with conditional requests and queued for the daemon.
+
+import sys
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.insert(0, project_root)
+
+from config.logging_config import get_logger
+from config.hianime import state_dir, watchlist_concurrency, watchlist_rate
+from providers.Hianime.Scraper.searchEpisodedetails import fetch_episode_list
+
+# Setup logging for this module
+logger = get_logger("scraper.watchlist")
+
+_watchlist_file = os.path.join(state_dir, "watchlist.json")
+_lock = threading.Lock()
+
+
+def load_watchlist():
+    try:
+        with open(_watchlist_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning("Could not read watchlist: %s", e)
+        return {}
+
+
+def save_watchlist(watchlist):
+    os.makedirs(state_dir, exist_ok=True)
+    tmp_file = _watchlist_file + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(watchlist, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, _watchlist_file)
+
+
+def follow(link, title, episodes, validators, needs, priority=0):
+    """Start following a series, the episodes it has now count as known"""
+    with _lock:
+        watchlist = load_watchlist()
+        watchlist[link] = {
+            "title": title,
+            "needs": needs,
+            "priority": priority,
+            "known": {ep['Episode ID']: ep['No'] for ep in episodes},
+            "validators": validators or {},
+            "checked": time.time(),
+        }
+        save_watchlist(watchlist)
+    logger.info("Following %s (%d episodes known)", title, len(episodes))
+
+
+def unfollow(link):
+    with _lock:
+        watchlist = load_watchlist()
+        removed = watchlist.pop(link, None)
+        save_watchlist(watchlist)
+    return removed is not None
+
+
+class _HostLimiter:
+    """Spaces out request starts so the episode API sees at most `rate` requests per second"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def _check(link, entry, limiter):
+    limiter.wait()
+    try:
+        episodes, validators = fetch_episode_list(link, entry.get("validators"))
+    except Exception as e:
+        logger.warning("Checking %s failed: %s", entry["title"], e)
+        return link, None, None, str(e)
+    if episodes is None:
+        return link, [], validators, None
+    new = [ep for ep in episodes if ep['Episode ID'] and ep['Episode ID'] not in entry["known"]]
+    return link, new, validators, None
+
+
+def sync(queue):
+    """
+    Check every followed series and queue the episodes that weren't there last time.
+
+    Series are checked concurrently (watchlist_concurrency at once) while the
+    request starts are spaced to watchlist_rate per second. Each check is one
+    conditional request, a 304 answer costs next to nothing.
+
+    Args:
+        queue (JobQueue): Queue the new episodes are added to
+
+    Returns:
+        dict: checked, unchanged, failed and enqueued counts plus the new episodes per series
+    """
+    watchlist = load_watchlist()
+    result = {"checked": 0, "unchanged": 0, "failed": 0, "enqueued": 0, "new": {}}
+    if not watchlist:
+        return result
+
+    limiter = _HostLimiter(watchlist_rate)
+    with ThreadPoolExecutor(max_workers=max(1, watchlist_concurrency)) as pool:
+        checks = list(pool.map(lambda item: _check(item[0], item[1], limiter), watchlist.items()))
+
+    with _lock:
+        # Reload so follow/unfollow calls made while we were checking aren't lost
+        current = load_watchlist()
+        for link, new, validators, error in checks:
+            result["checked"] += 1
+            entry = current.get(link)
+            if entry is None:
+                continue
+            if error:
+                result["failed"] += 1
+                continue
+            entry["checked"] = time.time()
+            entry["validators"] = validators or {}
+            if not new:
+                result["unchanged"] += 1
+                continue
+            for episode in new:
+                queue.enqueue(entry["title"], link, episode, entry["needs"], entry.get("priority", 0))
+                entry["known"][episode['Episode ID']] = episode['No']
+            result["enqueued"] += len(new)
+            result["new"][entry["title"]] = [episode['No'] for episode in new]
+            logger.info("%s: %d new episode(s) queued", entry["title"], len(new))
+        save_watchlist(current)
+
+    logger.info("Watchlist sync: %d checked, %d unchanged, %d failed, %d episodes queued",
+                result["checked"], result["unchanged"], result["failed"], result["enqueued"])
+    return result
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bandwidth limiter for pyanime.
+One token bucket shared by every segment download in the process, with a day/night schedule and a
+runtime override that other processes (the CLI, the GUI) can change through a small state file.
+"""
+
+import sys
+import os
+import json
+import time
+import asyncio
+import threading
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from config.logging_config import get_logger
+
+# Setup logging for this module
+logger = get_logger("utils.bandwidth")
+
+_UNITS = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2, "G": 1024 ** 3, "GB": 1024 ** 3}
+
+
+def parse_rate(text):
+    """
+    Bytes per second from "2M", "500K", "1.5MB" or a plain number. "off", "0" and
+    "unlimited" mean no limit (0).
+    """
+    value = str(text).strip().upper().removesuffix("/S")
+    if value in ("OFF", "UNLIMITED", "NONE"):
+        return 0
+    number = value.rstrip("KMGB")
+    unit = value[len(number):]
+    try:
+        return int(float(number) * _UNITS[unit])
+    except (KeyError, ValueError):
+        raise ValueError(f"Not a rate: {text} (use e.g. 2M, 500K or off)") from None
+
+
+def format_rate(rate):
+    if not rate:
+        return "unlimited"
+    for unit, size in (("MB", 1024 ** 2), ("KB", 1024)):
+        if rate >= size:
+            return f"{rate / size:.1f} {unit}/s"
+    return f"{rate} B/s"
+
+
+class TokenBucket:
+    """
+    Token bucket in bytes. Callers take what they read and sleep off any deficit,
+    so the average rate holds whatever the number of connections, while a full
+    bucket lets up to `burst` seconds worth of data through at once. Thread safe,
+    usable from several event loops (GUI thread, daemon) at the same time.
+    """
+
+    def __init__(self, rate=0, burst=1.0):
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._rate = 0
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self.set_rate(rate)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._rate = max(0, int(rate or 0))
+            self._tokens = min(self._tokens, self._rate * self.burst)
+            self._stamp = time.monotonic()
+
+    def take(self, amount):
+        """Take `amount` bytes, returns the seconds the caller has to wait before using them"""
+        with self._lock:
+            if not self._rate:
+                return 0.0
+            now = time.monotonic()
+            self._tokens = min(self._rate * self.burst, self._tokens + (now - self._stamp) * self._rate)
+            self._stamp = now
+            self._tokens -= amount
+            return -self._tokens / self._rate if self._tokens < 0 else 0.0
+
+    async def consume(self, amount):
+        """Async take(), returns the seconds spent waiting"""
+        wait = self.take(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+class Shaper:
+    """
+    The process-wide limit: an override (set here or in the state file) wins, otherwise
+    the schedule says which profile is active. Re-checked every few seconds, so a limit
+    changed by another process reaches a running download within `refresh` seconds.
+    """
+
+    def __init__(self, state_file, profiles, schedule, default=0, refresh=5):
+        self.state_file = state_file
+        self.profiles = profiles
+        self.schedule = sorted(schedule)
+        self.default = default
+        self.refresh = refresh
+        self.bucket = TokenBucket()
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._current = None
+        self.local = None
+
+    def _scheduled(self, now=None):
+        """Profile name the schedule has for the current time of day (None without a schedule)"""
+        if not self.schedule:
+            return None
+        clock = time.strftime("%H:%M", time.localtime(now))
+        active = self.schedule[-1][1]
+        for start, name in self.schedule:
+            if start <= clock:
+                active = name
+        return active
+
+    def override(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f).get("limit")
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Could not read bandwidth override: %s", e)
+            return None
+
+    def set_override(self, limit):
+        """
+        Change the limit of every pyanime process on this machine.
+
+        Args:
+            limit: Bytes per second (0 = unlimited), a profile name, or None to follow the schedule again
+        """
+        if isinstance(limit, str) and limit not in self.profiles:
+            raise ValueError(f"Unknown bandwidth profile: {limit} (profiles: {', '.join(self.profiles) or 'none'})")
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({"limit": limit, "set": time.time()}, f)
+        os.replace(tmp_file, self.state_file)
+        self._checked = 0.0
+        self.update()
+
+    def set_local(self, rate):
+        """Limit for this process only (e.g. a command line option), None to drop it"""
+        self.local = rate
+        self._checked = 0.0
+        self.update()
+
+    def resolve(self):
+        """(rate in bytes/s, where it comes from)"""
+        if self.local is not None:
+            return self.local, "this run"
+        limit = self.override()
+        if limit is not None:
+            if isinstance(limit, str):
+                return self.profiles.get(limit, self.default), f"profile {limit} (set by hand)"
+            return int(limit), "set by hand"
+        profile = self._scheduled()
+        if profile is not None:
+            return self.profiles.get(profile, self.default), f"profile {profile} (schedule)"
+        return self.default, "config"
+
+    def update(self):
+        with self._lock:
+            if time.monotonic() - self._checked < self.refresh:
+                return
+            self._checked = time.monotonic()
+        rate, source = self.resolve()
+        if (rate, source) != self._current:
+            self._current = (rate, source)
+            self.bucket.set_rate(rate)
+            logger.info("Bandwidth limit: %s (%s)", format_rate(rate), source)
+
+    async def consume(self, amount):
+        self.update()
+        return await self.bucket.consume(amount)
+
+
+_shaper = None
+_shaper_lock = threading.Lock()
+
+
+def get_shaper():
+    """Process-wide Shaper built from config.hianime, created on first use"""
+    global _shaper
+    with _shaper_lock:
+        if _shaper is None:
+            from config.hianime import state_dir, bandwidth_limit, bandwidth_profiles, bandwidth_schedule
+            _shaper = Shaper(os.path.join(state_dir, "bandwidth.json"), bandwidth_profiles, bandwidth_schedule,
+                             bandwidth_limit)
+        return _shaper
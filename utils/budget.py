@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-flight byte budget for pyanime.
+Caps the segment data being received at once across every download in the process: a transfer reserves
+its size before reading the body and gives it back once the bytes are on disk.
+"""
+
+import sys
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from config.logging_config import get_logger
+from utils import metrics
+
+# Setup logging for this module
+logger = get_logger("utils.budget")
+
+
+class ByteBudget:
+    """
+    Process-wide budget of in-flight bytes with first come, first served waiting.
+
+    Reservations larger than the whole budget are let through once nothing else is
+    in flight, so one oversized segment can't block forever. Waiters may live on
+    different event loops (GUI thread, daemon), they're woken thread-safely.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def _fits(self, amount):
+        return not self.capacity or self.in_use == 0 or self.in_use + amount <= self.capacity
+
+    async def acquire(self, amount):
+        """Reserve `amount` bytes, waiting while the budget is used up. Returns the seconds waited."""
+        with self._lock:
+            if not self._waiters and self._fits(amount):
+                self._grant(amount)
+                return 0.0
+            future = asyncio.get_running_loop().create_future()
+            waiter = [amount, future]
+            self._waiters.append(waiter)
+            self.waits += 1
+
+        start = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # Granted while being cancelled, hand it back
+            self.release(amount)
+            raise
+        waited = time.monotonic() - start
+        with self._lock:
+            self.wait_seconds += waited
+        return waited
+
+    def _grant(self, amount):
+        self.in_use += amount
+        self.peak = max(self.peak, self.in_use)
+
+    def release(self, amount):
+        with self._lock:
+            self.in_use = max(0, self.in_use - amount)
+            # Wake waiters in order for as long as the next one fits
+            while self._waiters and self._fits(self._waiters[0][0]):
+                waiting, future = self._waiters.popleft()
+                self._grant(waiting)
+                future.get_loop().call_soon_threadsafe(_resolve, future)
+
+    def utilization(self):
+        return self.in_use / self.capacity if self.capacity else 0.0
+
+    def stats(self):
+        """Snapshot for logs and metrics"""
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "in_use": self.in_use,
+                "utilization": self.in_use / self.capacity if self.capacity else 0.0,
+                "peak": self.peak,
+                "waiting": len(self._waiters),
+                "waits": self.waits,
+                "wait_seconds": self.wait_seconds,
+            }
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def get_budget():
+    """Process-wide ByteBudget of config.hianime.memory_budget bytes, created on first use"""
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            from config.hianime import memory_budget
+            _budget = ByteBudget(memory_budget)
+            metrics.REGISTRY.gauge("pyanime_budget", "In-flight byte budget (bytes, utilization, waits)", ("stat",),
+                                   callback=lambda: {(stat,): value for stat, value in _budget.stats().items()})
+        return _budget
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent job queue for pyanime.
+Keeps episode download jobs in SQLite so they survive restarts and can be paused, resumed and retried.
+"""
+
+import sys
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from config.logging_config import get_logger
+
+# Setup logging for this module
+logger = get_logger("utils.jobqueue")
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+PAUSED = "paused"
+DONE = "done"
+FAILED = "failed"
+
+# Stages a job walks through, in order. A restarted job continues at the stage it was in.
+STAGES = ["resolve", "segments", "assemble", "done"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    anime       TEXT NOT NULL,
+    watch_link  TEXT NOT NULL,
+    episode     TEXT NOT NULL,
+    episode_id  TEXT NOT NULL,
+    needs       TEXT NOT NULL,
+    options     TEXT NOT NULL DEFAULT '{}',
+    priority    INTEGER NOT NULL DEFAULT 0,
+    state       TEXT NOT NULL DEFAULT 'queued',
+    stage       TEXT NOT NULL DEFAULT 'resolve',
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    error       TEXT,
+    not_before  REAL NOT NULL DEFAULT 0,
+    created     REAL NOT NULL,
+    updated     REAL NOT NULL,
+    UNIQUE (episode_id, needs)
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, priority DESC, id);
+"""
+
+
+class JobQueue:
+    """
+    SQLite backed queue of episode jobs.
+
+    Every method opens its own short transaction so the daemon and any number
+    of CLI invocations can share the database file. Jobs are claimed highest
+    priority first, then in the order they were enqueued.
+    """
+
+    def __init__(self, db_path, max_attempts=3, retry_delay=30):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    @staticmethod
+    def _job(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["episode"] = json.loads(job["episode"])
+        job["options"] = json.loads(job["options"])
+        return job
+
+    def enqueue(self, anime, watch_link, episode, needs, priority=0, options=None):
+        """
+        Add an episode to the queue, unless the same episode (and sub/dub) is already in it.
+
+        Args:
+            anime (str): Anime title, used for the output folder
+            watch_link (str): Watch link of the anime, e.g. "/watch/one-piece-100"
+            episode (dict): Episode as returned by getanimepisode
+            needs (str): sub/dub/raw
+            priority (int): Higher runs first
+            options (dict, optional): Per-job download options (e.g. window)
+
+        Returns:
+            tuple: (job id, True if it was newly added)
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO jobs (anime, watch_link, episode, episode_id, needs, options, priority, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (anime, watch_link, json.dumps(episode), episode["Episode ID"], needs, json.dumps(options or {}),
+                 priority, now, now))
+            if cursor.rowcount:
+                logger.info("Enqueued job %d: %s episode %s (%s)", cursor.lastrowid, anime, episode.get("No"), needs)
+                return cursor.lastrowid, True
+            row = self._db.execute("SELECT id FROM jobs WHERE episode_id = ? AND needs = ?",
+                                   (episode["Episode ID"], needs)).fetchone()
+            return row["id"], False
+
+    def claim(self):
+        """Mark the next queued job as running and return it (None if nothing is queued)"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT * FROM jobs WHERE state = ? AND not_before <= ? ORDER BY priority DESC, id LIMIT 1",
+                    (QUEUED, time.time())).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                                     (RUNNING, time.time(), row["id"]))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = self._job(row)
+        job["state"] = RUNNING
+        job["attempts"] += 1
+        return job
+
+    def get(self, job_id):
+        return self._job(self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def jobs(self, states=None):
+        if states:
+            marks = ",".join("?" * len(states))
+            rows = self._execute(f"SELECT * FROM jobs WHERE state IN ({marks}) ORDER BY id", tuple(states)).fetchall()
+        else:
+            rows = self._execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        return [self._job(row) for row in rows]
+
+    def counts(self):
+        return {row["state"]: row["n"] for row in self._execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")}
+
+    def set_stage(self, job_id, stage):
+        self._execute("UPDATE jobs SET stage = ?, updated = ? WHERE id = ?", (stage, time.time(), job_id))
+
+    def finish(self, job_id):
+        self._execute("UPDATE jobs SET state = ?, stage = ?, error = NULL, updated = ? WHERE id = ?",
+                      (DONE, "done", time.time(), job_id))
+        logger.info("Job %d done", job_id)
+
+    def fail(self, job_id, error):
+        """Record a failure, the job goes back in the queue (after a growing delay) until it has used up max_attempts"""
+        job = self.get(job_id)
+        if job is None:
+            return
+        state = QUEUED if job["attempts"] < self.max_attempts else FAILED
+        # A job paused while running stays paused
+        if job["state"] == PAUSED:
+            state = PAUSED
+        now = time.time()
+        self._execute("UPDATE jobs SET state = ?, error = ?, not_before = ?, updated = ? WHERE id = ?",
+                      (state, str(error), now + self.retry_delay * job["attempts"], now, job_id))
+        logger.warning("Job %d failed (attempt %d/%d): %s", job_id, job["attempts"], self.max_attempts, error)
+
+    def release(self, job_id):
+        """Put a running job back in the queue without counting the attempt (daemon shutdown)"""
+        self._execute("UPDATE jobs SET state = ?, attempts = MAX(attempts - 1, 0), updated = ? WHERE id = ? AND state = ?",
+                      (QUEUED, time.time(), job_id, RUNNING))
+
+    def recover(self):
+        """Requeue jobs left running by a daemon that didn't shut down cleanly"""
+        cursor = self._execute("UPDATE jobs SET state = ?, updated = ? WHERE state = ?", (QUEUED, time.time(), RUNNING))
+        if cursor.rowcount:
+            logger.info("Recovered %d interrupted jobs", cursor.rowcount)
+        return cursor.rowcount
+
+    def _transition(self, job_id, from_states, to_state, extra=""):
+        marks = ",".join("?" * len(from_states))
+        sql = f"UPDATE jobs SET state = ?{extra}, updated = ? WHERE state IN ({marks})"
+        params = [to_state, time.time(), *from_states]
+        if job_id is not None:
+            sql += " AND id = ?"
+            params.append(job_id)
+        return self._execute(sql, tuple(params)).rowcount
+
+    def pause(self, job_id=None):
+        """Pause one job (or every queued/running job when job_id is None)"""
+        return self._transition(job_id, (QUEUED, RUNNING), PAUSED)
+
+    def resume(self, job_id=None):
+        return self._transition(job_id, (PAUSED,), QUEUED, extra=", not_before = 0")
+
+    def retry(self, job_id=None):
+        """Give failed jobs a fresh set of attempts"""
+        return self._transition(job_id, (FAILED,), QUEUED, extra=", attempts = 0, error = NULL, not_before = 0")
+
+    def requeue(self, episode_id, needs):
+        """Queue a finished (or failed) episode again, e.g. because its file turned out to be corrupt"""
+        return self._execute(
+            "UPDATE jobs SET state = ?, stage = ?, attempts = 0, error = NULL, not_before = 0, updated = ? "
+            "WHERE episode_id = ? AND needs = ? AND state IN (?, ?)",
+            (QUEUED, STAGES[0], time.time(), episode_id, needs, DONE, FAILED)).rowcount
+
+    def set_priority(self, job_id, priority):
+        return self._execute("UPDATE jobs SET priority = ?, updated = ? WHERE id = ?",
+                             (priority, time.time(), job_id)).rowcount
+
+    def remove(self, job_id):
+        return self._execute("DELETE FROM jobs WHERE id = ? AND state != ?", (job_id, RUNNING)).rowcount
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Library index for pyanime.
+Keeps every downloaded episode in SQLite with its size, duration, variant, checksum and integrity state,
+so "is it downloaded?" is one indexed lookup instead of a walk over the cache directory.
+"""
+
+import sys
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import ffmpeg
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from config.logging_config import get_logger
+from utils import metrics
+
+# Setup logging for this module
+logger = get_logger("utils.library")
+
+# Episode states
+COMPLETE = "complete"
+PARTIAL = "partial"
+CORRUPT = "corrupt"
+UNVERIFIED = "unverified"   # Readable, but not (yet) as long as its playlist: found on disk unindexed, or left short
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS episodes (
+    path        TEXT PRIMARY KEY,
+    anime       TEXT NOT NULL,
+    name        TEXT NOT NULL,
+    episode_id  TEXT,
+    needs       TEXT,
+    variant     TEXT,
+    size        INTEGER NOT NULL DEFAULT 0,
+    duration    REAL,
+    checksum    TEXT,
+    state       TEXT NOT NULL DEFAULT 'partial',
+    added       REAL NOT NULL,
+    verified    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS episodes_anime ON episodes (anime);
+CREATE INDEX IF NOT EXISTS episodes_episode ON episodes (episode_id, needs);
+CREATE INDEX IF NOT EXISTS episodes_state ON episodes (state);
+"""
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def probe_duration(path):
+    """
+    Duration of a media file according to ffprobe.
+
+    Returns:
+        float: Seconds, or None if ffprobe isn't installed (the file can't be judged)
+
+    Raises:
+        ffmpeg.Error: ffprobe could not read the file
+    """
+    try:
+        info = ffmpeg.probe(path)
+    except FileNotFoundError:
+        logger.debug("ffprobe not found, duration of %s unknown", path)
+        return None
+    duration = info.get("format", {}).get("duration")
+    return float(duration) if duration else None
+
+
+class Library:
+    """
+    SQLite index of the episodes in cache_dir.
+
+    Rows are keyed by output path. An episode is recorded as partial while it is
+    assembled and as complete (with size, duration and checksum) once the file is
+    finished. Files found on disk without a row are unverified until a download
+    confirms them against their playlist. A complete (or unverified) row whose
+    file changed size or disappeared is marked corrupt the next time it's looked at.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    def get(self, path):
+        row = self._execute("SELECT * FROM episodes WHERE path = ?", (path,)).fetchone()
+        return dict(row) if row else None
+
+    def episodes(self, anime=None, state=None):
+        sql, params = "SELECT * FROM episodes WHERE 1 = 1", []
+        if anime:
+            sql += " AND anime = ?"
+            params.append(anime)
+        if state:
+            sql += " AND state = ?"
+            params.append(state)
+        return [dict(row) for row in self._execute(sql + " ORDER BY anime, name", tuple(params)).fetchall()]
+
+    def find(self, episode_id, needs=None):
+        """Rows of an episode (any quality or window), by provider episode ID"""
+        if needs:
+            rows = self._execute("SELECT * FROM episodes WHERE episode_id = ? AND needs = ?", (episode_id, needs))
+        else:
+            rows = self._execute("SELECT * FROM episodes WHERE episode_id = ?", (episode_id,))
+        return [dict(row) for row in rows.fetchall()]
+
+    def counts(self):
+        return {row["state"]: row["n"] for row in self._execute("SELECT state, COUNT(*) AS n FROM episodes GROUP BY state")}
+
+    def start(self, path, anime, name, episode_id=None, needs=None, variant=None):
+        """Record an episode as partial while its file is being written"""
+        now = time.time()
+        self._execute(
+            "INSERT INTO episodes (path, anime, name, episode_id, needs, variant, state, added, verified) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (path) DO UPDATE SET anime = excluded.anime, name = excluded.name, "
+            "episode_id = COALESCE(excluded.episode_id, episode_id), needs = COALESCE(excluded.needs, needs), "
+            "variant = COALESCE(excluded.variant, variant), state = excluded.state, size = 0, duration = NULL, "
+            "checksum = NULL, verified = excluded.verified",
+            (path, anime, name, episode_id, needs, variant, PARTIAL, now, now))
+
+    def complete(self, path, anime, name, episode_id=None, needs=None, variant=None, confirmed=True):
+        """
+        Measure a finished file and record it.
+
+        The file is complete if ffprobe can read it (or ffprobe isn't installed and
+        the file isn't empty), corrupt otherwise. Without confirmed (nothing says how
+        long it should be) a readable file is only recorded as unverified.
+
+        Returns:
+            str: The state recorded
+        """
+        self.start(path, anime, name, episode_id, needs, variant)
+        state, size, duration, checksum = CORRUPT, 0, None, None
+        try:
+            size = os.path.getsize(path)
+            duration = probe_duration(path)
+            checksum = file_checksum(path)
+            state = (COMPLETE if confirmed else UNVERIFIED) if size > 0 else CORRUPT
+        except ffmpeg.Error as e:
+            logger.warning("ffprobe could not read %s: %s", path, e.stderr.decode(errors='replace')[-200:] if e.stderr else e)
+        except OSError as e:
+            logger.warning("Could not read %s: %s", path, e)
+        self._execute("UPDATE episodes SET state = ?, size = ?, duration = ?, checksum = ?, verified = ? WHERE path = ?",
+                      (state, size, duration, checksum, time.time(), path))
+        logger.info("Library: %s is %s (%d bytes, %s s)", name, state, size, f"{duration:.0f}" if duration else "?")
+        return state
+
+    def confirm(self, path, min_duration, episode_id=None, needs=None):
+        """
+        Promote an unverified episode to complete once a playlist says how long it should be.
+
+        Returns:
+            bool: Whether the file is at least min_duration seconds long and now complete
+        """
+        entry = self.get(path)
+        if not entry or entry["state"] != UNVERIFIED or entry["duration"] is None or not self._stat_ok(entry):
+            return False
+        if entry["duration"] < min_duration:
+            logger.info("%s is %.0fs long, its playlist needs %.0fs, not confirming it", path, entry["duration"], min_duration)
+            return False
+        self._execute("UPDATE episodes SET state = ?, episode_id = COALESCE(?, episode_id), needs = COALESCE(?, needs), "
+                      "verified = ? WHERE path = ?", (COMPLETE, episode_id, needs, time.time(), path))
+        logger.info("Library: confirmed %s against its playlist", path)
+        return True
+
+    def mark(self, path, state):
+        return self._execute("UPDATE episodes SET state = ?, verified = ? WHERE path = ?",
+                             (state, time.time(), path)).rowcount
+
+    def forget(self, path):
+        return self._execute("DELETE FROM episodes WHERE path = ?", (path,)).rowcount
+
+    def _stat_ok(self, entry):
+        try:
+            return os.path.getsize(entry["path"]) == entry["size"]
+        except OSError:
+            return False
+
+    def is_complete(self, path, anime=None, name=None):
+        """
+        Whether the episode at path is in the library and intact. Only the file
+        size is compared, so this stays a stat call however big the library is.
+
+        A file that exists but was never indexed (downloaded before the index
+        existed) is measured and recorded on first sight when anime/name are given,
+        as unverified: a truncated file usually still probes fine, so it only counts
+        once a download confirms its length against the playlist (see confirm).
+        """
+        found = self._lookup(path, anime, name)
+        metrics.cache_requests.inc(cache="library", result="hit" if found else "miss")
+        return found
+
+    def _lookup(self, path, anime, name):
+        entry = self.get(path)
+        if entry is None:
+            if anime and os.path.exists(path):
+                logger.info("Indexing existing file %s as unverified", path)
+                self.complete(path, anime, name or os.path.splitext(os.path.basename(path))[0], confirmed=False)
+            return False
+        if entry["state"] != COMPLETE:
+            return False
+        if not self._stat_ok(entry):
+            logger.warning("%s changed size or disappeared, marking it corrupt", path)
+            self.mark(path, CORRUPT)
+            return False
+        return True
+
+    def verify(self, deep=False):
+        """
+        Check every complete or unverified episode, marking the ones whose file is gone, truncated
+        or (deep) no longer matches its checksum as corrupt.
+
+        Returns:
+            list: Rows that were marked corrupt
+        """
+        corrupt = []
+        for entry in self.episodes(state=COMPLETE) + self.episodes(state=UNVERIFIED):
+            ok = self._stat_ok(entry)
+            if ok and deep and entry["checksum"]:
+                try:
+                    ok = file_checksum(entry["path"]) == entry["checksum"]
+                except OSError:
+                    ok = False
+            if not ok:
+                self.mark(entry["path"], CORRUPT)
+                corrupt.append(entry)
+        if corrupt:
+            logger.warning("Library verify: %d corrupt episode(s)", len(corrupt))
+        return corrupt
+
+
+_library = None
+_library_lock = threading.Lock()
+
+
+def get_library():
+    """Process-wide Library on config.hianime.library_db, opened on first use"""
+    global _library
+    with _library_lock:
+        if _library is None:
+            from config.hianime import library_db
+            _library = Library(library_db)
+        return _library
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Metrics for pyanime.
+Counters, gauges and histograms kept in-process, rendered in the Prometheus text format for the daemon's
+/metrics endpoint and as a plain dict snapshot for the GUI.
+"""
+
+import sys
+import os
+import time
+import asyncio
+import threading
+import functools
+from contextlib import contextmanager
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from config.logging_config import get_logger
+
+# Setup logging for this module
+logger = get_logger("utils.metrics")
+
+# Seconds, from a cached subtitle to a slow episode mux
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key)) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    # Counters of bytes outgrow the 6 digits of %g, integers are written out in full
+    if isinstance(value, bool) or (isinstance(value, float) and value.is_integer()):
+        value = int(value)
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, None, value) for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, or a callback returning {label tuple: value} read at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback:
+            try:
+                values = self.callback()
+            except Exception as e:
+                logger.debug("Gauge %s callback failed: %s", self.name, e)
+                values = {}
+            return [(self.name, tuple(str(part) for part in key), None, value) for key, value in values.items()]
+        with self._lock:
+            return [(self.name, key, None, value) for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][i] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, entry in self._values.items():
+                for bound, count in zip(self.buckets, entry["counts"]):
+                    samples.append((f"{self.name}_bucket", key, ("le", f"{bound:g}"), count))
+                samples.append((f"{self.name}_bucket", key, ("le", "+Inf"), entry["count"]))
+                samples.append((f"{self.name}_sum", key, None, entry["sum"]))
+                samples.append((f"{self.name}_count", key, None, entry["count"]))
+        return samples
+
+    def summary(self):
+        """{label tuple: (count, sum)} for snapshots"""
+        with self._lock:
+            return {key: (entry["count"], entry["sum"]) for key, entry in self._values.items()}
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, help_text, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered differently")
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._get(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=(), callback=None):
+        gauge = self._get(Gauge, name, help_text, labelnames)
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, extra, value in metric.samples():
+                lines.append(f"{name}{_format_labels(metric.labelnames, key, [extra] if extra else None)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Plain values for the GUI.
+
+        Returns:
+            dict: metric name -> {label string: value}; histograms give {"count", "sum", "avg"}
+        """
+        result = {}
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            values = {}
+            if isinstance(metric, Histogram):
+                for key, (count, total) in metric.summary().items():
+                    values[",".join(key)] = {"count": count, "sum": total, "avg": total / count if count else 0.0}
+            else:
+                for _, key, _, value in metric.samples():
+                    values[",".join(key)] = value
+            result[metric.name] = values
+        return result
+
+
+REGISTRY = Registry()
+
+# The hot paths, shared by the downloader, the scrapers and the daemon
+segments = REGISTRY.counter("pyanime_segments_total", "Segment downloads by result", ("result",))
+segment_bytes = REGISTRY.counter("pyanime_segment_bytes_total", "Segment bytes written to disk")
+retries = REGISTRY.counter("pyanime_segment_retries_total", "Segment retries by cause", ("cause",))
+request_seconds = REGISTRY.histogram("pyanime_request_seconds", "Time to response headers per host", ("host",))
+stage_seconds = REGISTRY.histogram("pyanime_stage_seconds", "Time spent per pipeline stage", ("stage",))
+cache_requests = REGISTRY.counter("pyanime_cache_requests_total", "Cache lookups by cache and result", ("cache", "result"))
+queue_depth = REGISTRY.gauge("pyanime_queue_depth", "Items waiting per queue", ("queue",))
+
+
+def timed(stage):
+    """Decorator recording how long a function (sync or async) takes under pyanime_stage_seconds{stage}"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage_seconds.time(stage=stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_seconds.time(stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """Current values of every metric, for the GUI"""
+    return REGISTRY.snapshot()
+
+
+async def serve(port, host="127.0.0.1"):
+    """
+    Serve REGISTRY in the Prometheus text format on http://host:port/metrics from the running event loop.
+
+    Returns:
+        aiohttp.web.AppRunner: Call cleanup() on it to stop serving
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return runner
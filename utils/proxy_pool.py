@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Proxy pool for pyanime.
+Races the native route against the best scored proxies and keeps per-route health scores between runs.
+"""
+
+import sys
+import os
+import json
+import time
+import atexit
+import tempfile
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from config.logging_config import get_logger
+
+# Setup logging for this module
+logger = get_logger("utils.proxy_pool")
+
+NATIVE = "native"
+
+
+class ProxyPool:
+    """
+    Route racing with persistent health scores.
+
+    Every route (the native IP or a proxy URL) keeps an exponentially weighted
+    success rate and latency. A fetch races the native route and the best
+    scored proxies at once; the first 200 response wins and the rest stop
+    reading. If the whole wave fails the next best routes are raced.
+    Scores are written at most every save_interval seconds and on exit.
+    """
+
+    def __init__(self, scores_file, race_width=3, decay=0.3, save_interval=30):
+        self.scores_file = scores_file
+        self.race_width = max(1, race_width)
+        self.decay = decay
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._scores = self._load()
+        self._saved_at = time.monotonic()
+        self._dirty = False
+        atexit.register(self.save)
+
+    def _load(self):
+        try:
+            with open(self.scores_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning("Could not read proxy scores from %s: %s", self.scores_file, e)
+            return {}
+
+    def save(self):
+        """Write the scores, keeping routes another process updated more recently than this one"""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            self._saved_at = time.monotonic()
+            tmp_file = None
+            try:
+                scores = self._load()
+                for route, entry in self._scores.items():
+                    if entry.get("last", 0) >= scores.get(route, {}).get("last", 0):
+                        scores[route] = entry
+                directory = os.path.dirname(self.scores_file)
+                os.makedirs(directory, exist_ok=True)
+                with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, suffix=".tmp",
+                                                 prefix=os.path.basename(self.scores_file) + ".", delete=False) as f:
+                    tmp_file = f.name
+                    json.dump(scores, f, indent=2)
+                os.replace(tmp_file, self.scores_file)
+            except Exception as e:
+                logger.warning("Could not save proxy scores to %s: %s", self.scores_file, e)
+                if tmp_file and os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+    def _save_if_due(self):
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def record(self, route, ok, latency):
+        with self._lock:
+            entry = self._scores.setdefault(route, {"success": 0.5, "latency": None, "attempts": 0})
+            entry["success"] = (1 - self.decay) * entry["success"] + self.decay * (1.0 if ok else 0.0)
+            if ok:
+                entry["latency"] = latency if entry["latency"] is None else (1 - self.decay) * entry["latency"] + self.decay * latency
+            entry["attempts"] += 1
+            entry["last"] = time.time()
+            self._dirty = True
+
+    def score(self, route, timeout):
+        with self._lock:
+            entry = self._scores.get(route)
+            if not entry:
+                # Unknown routes get a middling score so they get tried eventually
+                return 0.5 / (timeout / 2)
+            latency = entry["latency"] if entry["latency"] is not None else timeout
+            return entry["success"] / max(latency, 0.001)
+
+    def ranked(self, proxy_servers, timeout):
+        """Proxies of proxy_servers sorted best first"""
+        return sorted(proxy_servers, key=lambda route: self.score(route, timeout), reverse=True)
+
+    def _attempt(self, route, url, headers, timeout, lost):
+        """
+        One route's fetch. The body is read in chunks so a route stops once another one has won
+        (lost is set) or it has run past the timeout in total, not just per socket read.
+        """
+        start = time.perf_counter()
+        try:
+            proxies = None if route == NATIVE else {'http': route, 'https': route}
+            with requests.get(url, headers=headers, proxies=proxies, timeout=timeout, stream=True) as response:
+                if response.status_code == 200:
+                    body = []
+                    for chunk in response.iter_content(64 * 1024):
+                        if lost.is_set():
+                            # Not this route's fault, its score is left alone
+                            return route, None, None
+                        if time.perf_counter() - start > timeout:
+                            raise requests.exceptions.Timeout(f"Body not read within {timeout}s")
+                        body.append(chunk)
+                    # The body is read, the response works as if it hadn't been streamed
+                    response._content = b"".join(body)
+            latency = time.perf_counter() - start
+            ok = response.status_code == 200
+            self.record(route, ok, latency)
+            if not ok:
+                logger.warning("Route %s returned status %s for %s", route, response.status_code, url)
+            return route, response if ok else None, latency
+        except Exception as e:
+            self.record(route, False, time.perf_counter() - start)
+            logger.warning("Route %s failed for %s: %s", route, url, e)
+            return route, None, None
+
+    def get(self, url, headers, proxy_servers, timeout):
+        """
+        Fetch url through the fastest healthy route.
+
+        Args:
+            url (str): URL to fetch
+            headers (dict): Request headers
+            proxy_servers (iterable): Proxy URLs to consider next to the native route
+            timeout (int): Per-attempt timeout in seconds
+
+        Returns:
+            requests.Response or None: First 200 response, None if every route failed
+        """
+        proxies = self.ranked(list(proxy_servers or []), timeout)
+        waves = [[NATIVE] + proxies[:self.race_width - 1]]
+        rest = proxies[self.race_width - 1:]
+        while rest:
+            waves.append(rest[:self.race_width])
+            rest = rest[self.race_width:]
+
+        try:
+            for wave in waves:
+                logger.debug("Racing %s for %s", wave, url)
+                pool = ThreadPoolExecutor(max_workers=len(wave))
+                lost = threading.Event()
+                pending = {pool.submit(self._attempt, route, url, headers, timeout, lost) for route in wave}
+                try:
+                    while pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            route, response, latency = future.result()
+                            if response is not None:
+                                logger.debug("Route %s won for %s in %.3fs", route, url, latency)
+                                return response
+                finally:
+                    # Losers still waiting for headers give up within timeout, the ones reading a body stop now
+                    lost.set()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                logger.warning("All routes in %s failed for %s", wave, url)
+
+            logger.error("All proxy attempts failed for %s", url)
+            return None
+        finally:
+            self._save_if_due()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stage graph for pyanime.
+Runs the stages of a job as a small dependency graph: every stage starts as soon as the stages it needs are done.
+"""
+
+import sys
+import os
+import time
+import asyncio
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from config.logging_config import get_logger
+from utils import tracing
+
+# Setup logging for this module
+logger = get_logger("utils.stagegraph")
+
+
+class StageFailed(Exception):
+    """Raised by a stage that can't continue, the message is reported as the reason"""
+
+
+class StageGraph:
+    """
+    Dependency graph of async stages.
+
+    Each stage is an async callable taking the results dict (stage name -> result
+    of every finished stage) and runs once all of its dependencies have finished.
+    If a stage fails every stage still waiting or running is cancelled and the
+    error is raised from run(). Start offset and duration of every stage are kept
+    in timings.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.results = {}
+        self.timings = {}
+
+    def add(self, name, func, needs=()):
+        for dependency in needs:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} needs unknown stage {dependency}")
+        self.stages[name] = (func, tuple(needs))
+        return self
+
+    async def _run_stage(self, name, tasks, origin):
+        func, needs = self.stages[name]
+        if needs:
+            await asyncio.gather(*(tasks[dependency] for dependency in needs))
+        start = time.perf_counter()
+        try:
+            with tracing.span(name, cat="stage"):
+                result = await func(self.results)
+        finally:
+            self.timings[name] = (start - origin, time.perf_counter() - start)
+        self.results[name] = result
+        return result
+
+    async def run(self):
+        """
+        Run every stage.
+
+        Returns:
+            dict: stage name -> result
+        """
+        origin = time.perf_counter()
+        tasks = {}
+        # Stages can only need stages added before them, so insertion order is a topological order
+        for name in self.stages:
+            tasks[name] = asyncio.ensure_future(self._run_stage(name, tasks, origin))
+
+        try:
+            done, pending = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+            return self.results
+        finally:
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            logger.info("Stages of %s: %s", self.name, self.report())
+
+    def report(self):
+        """Timings as "stage +start/duration" for the log"""
+        return ", ".join(f"{name} +{start:.2f}s/{duration:.2f}s"
+                         for name, (start, duration) in sorted(self.timings.items(), key=lambda item: item[1][0]))
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Span tracing for pyanime.
+Nested, perf_counter_ns timed spans that follow an episode across asyncio tasks and worker threads, exported as
+Chrome trace JSON (chrome://tracing, https://ui.perfetto.dev). Off unless enabled, a disabled span costs one check.
+"""
+
+import sys
+import os
+import json
+import time
+import atexit
+import asyncio
+import itertools
+import threading
+import functools
+import contextvars
+
+# Add the project root to the Python path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from config.logging_config import get_logger
+
+# Setup logging for this module
+logger = get_logger("utils.tracing")
+
+_enabled = False
+_path = None
+_max_events = 0
+_events = []
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_tracks = {}
+_dropped = 0
+_origin = time.perf_counter_ns()
+# The innermost open span of the current task or thread, copied into tasks created under it
+_current = contextvars.ContextVar("pyanime_span", default=None)
+
+
+class _Noop:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NOOP = _Noop()
+
+
+class Span:
+    """One timed region. Top-level spans are roots, every root gets its own process row in the trace."""
+    __slots__ = ("name", "cat", "args", "id", "root", "start", "_token")
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def set(self, **args):
+        """Attach more arguments (results, sizes) before the span ends"""
+        self.args.update(args)
+
+    def __enter__(self):
+        parent = _current.get()
+        self.id = next(_ids)
+        self.root = parent.root if parent else self.id
+        if parent:
+            self.args.setdefault("parent", parent.name)
+        else:
+            _name_track(self.root, 0, "process_name", _label(self))
+        self._token = _current.set(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.args["error"] = f"{exc_type.__name__}: {exc}"
+        _record({"name": self.name, "cat": self.cat, "ph": "X", "pid": self.root, "tid": _track(self.root),
+                 "ts": (self.start - _origin) / 1000, "dur": (end - self.start) / 1000, "args": self.args})
+        return False
+
+
+def _label(span):
+    detail = span.args.get("episode") or span.args.get("anime")
+    return f"{span.name} {detail}" if detail else span.name
+
+
+def _track(root):
+    """Row of the current task (or thread) within a root's process, so concurrent spans don't overlap"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    owner = task if task is not None else threading.current_thread()
+    key = (root, id(owner))
+    track = _tracks.get(key)
+    if track is None:
+        with _lock:
+            track = _tracks.setdefault(key, len(_tracks) + 1)
+        _name_track(root, track, "thread_name", owner.get_name() if task is not None else owner.name)
+    return track
+
+
+def _name_track(pid, tid, kind, name):
+    _record({"name": kind, "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+
+
+def _record(event):
+    global _dropped
+    with _lock:
+        if _max_events and len(_events) >= _max_events:
+            if not _dropped:
+                logger.warning("Trace buffer full (%d events), dropping new spans", _max_events)
+            _dropped += 1
+            return
+        _events.append(event)
+
+
+def enabled():
+    return _enabled
+
+
+def enable(path=None, max_events=None):
+    """
+    Start recording spans.
+
+    Args:
+        path (str, optional): Trace file written when the process exits (or on export())
+        max_events (int, optional): Events kept in memory before new ones are dropped (trace_max_events by default)
+    """
+    global _enabled, _path, _max_events
+    if max_events is None:
+        from config.hianime import trace_max_events
+        max_events = trace_max_events
+    _path = path or _path
+    _max_events = max_events
+    if not _enabled and _path:
+        atexit.register(export)
+    _enabled = True
+    logger.info("Tracing enabled%s", f", writing {_path} on exit" if _path else "")
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def span(name, cat="pyanime", **args):
+    """
+    Context manager timing a block as a span, nested under the span that is open in the current
+    task or thread. Works the same in coroutines: tasks started inside it inherit it as their parent.
+    """
+    if not _enabled:
+        return _NOOP
+    return Span(name, cat, args)
+
+
+def traced(name=None, cat="pyanime", describe=None):
+    """
+    Decorator running every call of a function (sync or async) in a span named after it.
+
+    Args:
+        name (str, optional): Span name (the function name by default)
+        cat (str, optional): Trace category
+        describe (callable, optional): Called with the function's arguments, returns the span's args dict
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        def start(args, kwargs):
+            return Span(span_name, cat, describe(*args, **kwargs) if describe else {})
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await func(*args, **kwargs)
+                with start(args, kwargs):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with start(args, kwargs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def wrap_context(func):
+    """func bound to the current span, for work handed to a thread pool that doesn't copy contextvars"""
+    if not _enabled:
+        return func
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def events():
+    with _lock:
+        return list(_events)
+
+
+def export(path=None):
+    """
+    Write the recorded spans as Chrome trace JSON.
+
+    Returns:
+        str: The file written, None when there was nothing to write
+    """
+    path = path or _path
+    if not path:
+        return None
+    recorded = events()
+    if not recorded:
+        return None
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({"traceEvents": recorded, "displayTimeUnit": "ms",
+                   "otherData": {"dropped": _dropped}}, f, default=str)
+    os.replace(tmp_file, path)
+    logger.info("Wrote %d trace events to %s", len(recorded), path)
+    return path
+
+
+def enable_from_config():
+    """Turn tracing on when PYANIME_TRACE (a file path) or config.hianime.trace_file asks for it"""
+    from config.hianime import trace_file
+    path = os.environ.get("PYANIME_TRACE") or trace_file
+    if path and not _enabled:
+        enable(path)
+    return _enabled